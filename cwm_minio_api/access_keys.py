@@ -1,9 +1,12 @@
 from . import db, common, config
 
 
-async def get_access_key(exit_stack=None):
-    for try_num in range(20):
-        async with db.connection_cursor() as (conn, cur):
+async def get_access_key(exit_stack=None, cur=None):
+    # when called with a cursor the access key is inserted in its transaction (without using another pool connection),
+    # so it's committed / rolled back together with the caller's changes
+    in_transaction = cur is not None
+    async with db.connection_cursor(cur) as (conn, cur):
+        for try_num in range(20):
             access_key = common.generate_key(config.ACCESS_KEY_LENGTH)
             await cur.execute('''
                 insert into access_keys (access_key) values (%s)
@@ -11,16 +14,21 @@ async def get_access_key(exit_stack=None):
                 RETURNING access_key
             ''', (access_key,))
             if await cur.fetchone():
-                if exit_stack:
-                    exit_stack.push_async_callback(delete_access_key, access_key)
+                if not in_transaction:
+                    await conn.commit()
+                    if exit_stack:
+                        exit_stack.push_async_callback(delete_access_key, access_key)
                 return access_key
     raise Exception('Failed to get unique access key after 20 tries')
 
 
-async def delete_access_key(access_key):
-    async with db.connection_cursor() as (conn, cur):
+async def delete_access_key(access_key, cur=None):
+    # when called with a cursor the delete is committed with the caller's transaction
+    in_transaction = cur is not None
+    async with db.connection_cursor(cur) as (conn, cur):
         await cur.execute('''
             DELETE FROM access_keys
             WHERE access_key = %s
         ''', (access_key,))
-        await conn.commit()
+        if not in_transaction:
+            await conn.commit()
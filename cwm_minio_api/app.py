@@ -1,18 +1,34 @@
+import time
+import asyncio
 import logging
 import traceback
+from contextlib import asynccontextmanager
 
 from fastapi import FastAPI, logger, Request
 from fastapi.responses import ORJSONResponse
 
 from .version import VERSION
 from .router import router
-from . import config, common
+from . import config, common, db
+from .minio import api as minio_api, http_backend as minio_http_backend
+from .buckets import usage as buckets_usage
+from .outbox import api as outbox_api
+from .jobs import api as jobs_api
+
+
+def is_server_overloaded(exc):
+    # exceptions of concurrent operations are raised in exception groups
+    if isinstance(exc, BaseExceptionGroup):
+        return exc.subgroup(common.ServerOverloadedException) is not None
+    return isinstance(exc, common.ServerOverloadedException)
 
 
 async def global_exception_handler(request: Request, exc: Exception):
     status_code = 500
-    if isinstance(exc, common.ServerOverloadedException):
+    if is_server_overloaded(exc):
         status_code = 503
+    elif isinstance(exc, common.BadRequestException):
+        status_code = 400
     return ORJSONResponse(
         status_code=status_code,
         content={
@@ -22,16 +38,49 @@ async def global_exception_handler(request: Request, exc: Exception):
     )
 
 
+async def request_context_middleware(request: Request, call_next):
+    # MinIO retry budget and deadline of the request, the header can only shorten the default deadline
+    minio_api.start_retry_budget()
+    try:
+        request_timeout = float(request.headers.get('x-request-timeout') or 0)
+    except ValueError:
+        # exceptions raised in the middleware are not handled by the app exception handlers
+        return await global_exception_handler(request, common.BadRequestException('Invalid x-request-timeout header'))
+    timeouts = [t for t in (config.REQUEST_TIMEOUT_SECONDS, request_timeout) if t > 0]
+    if timeouts:
+        common.request_deadline.set(time.monotonic() + min(timeouts))
+    return await call_next(request)
+
+
+@asynccontextmanager
+async def lifespan(app_: FastAPI):
+    background_tasks = []
+    if config.BUCKETS_USAGE_COLLECTOR_INTERVAL_SECONDS > 0:
+        background_tasks.append(asyncio.create_task(buckets_usage.collector_loop()))
+    if config.MINIO_OUTBOX_ENABLED:
+        background_tasks.extend(asyncio.create_task(outbox_api.worker_loop()) for _ in range(config.MINIO_OUTBOX_WORKERS))
+    background_tasks.extend(asyncio.create_task(jobs_api.worker_loop()) for _ in range(config.JOBS_WORKERS))
+    yield
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    await minio_http_backend.close()
+    await db.close_pool()
+
+
 def app():
     app_ = FastAPI(
         version=VERSION,
         title='CWM MinIO API',
+        lifespan=lifespan,
     )
     if config.CWM_ENV_TYPE == 'docker':
         logging.basicConfig(level=getattr(logging, config.CWM_LOG_LEVEL), handlers=logging.getLogger("gunicorn.error").handlers)
     else:
         logging.basicConfig(level=getattr(logging, config.CWM_LOG_LEVEL), handlers=logger.logger.handlers)
     app_.add_exception_handler(Exception, global_exception_handler)
+    app_.add_exception_handler(common.BadRequestException, global_exception_handler)
+    app_.middleware('http')(request_context_middleware)
     app_.include_router(router)
     logging.info('App initialized')
     return app_
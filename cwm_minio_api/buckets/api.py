@@ -1,11 +1,12 @@
-import traceback
 from textwrap import dedent
-from contextlib import AsyncExitStack
 
-from .. import db, common
+from .. import db, common, config
 from ..credentials import api as credentials_api
-from ..instances.api import get as get_instance
+from ..instances.api import get as get_instance, get_block_strategy as get_instance_block_strategy, BLOCK_STRATEGY_USERS as INSTANCE_BLOCK_STRATEGY_USERS
 from ..minio import api as minio_api
+from ..minio.compensation import CompensationStack
+from ..outbox import api as outbox_api
+from ..jobs import api as jobs_api
 
 
 # https://docs.min.io/community/minio-object-store/administration/identity-access-management/policy-based-access-control.html
@@ -74,6 +75,13 @@ BUCKET_POLICY_DELETE_TEMPLATE = dedent('''
 ''')
 
 
+IAM_MODE_POLICIES = 'policies'
+IAM_MODE_GROUPS = 'groups'
+
+BUCKET_PERMISSIONS = ('read', 'write', 'delete')
+
+
+@outbox_api.deferred
 async def create(instance_id, bucket_name, public=False):
     common.check_bucket_name(bucket_name)
     async with db.connection_cursor() as (conn, cur):
@@ -82,58 +90,131 @@ async def create(instance_id, bucket_name, public=False):
             raise Exception('Instance not found')
         if instance['blocked']:
             raise Exception('Instance is blocked')
+        iam_mode = config.BUCKETS_IAM_MODE
+        assert iam_mode in (IAM_MODE_POLICIES, IAM_MODE_GROUPS), f'Invalid IAM mode: {iam_mode}'
         await cur.execute('''
-            INSERT INTO buckets (instance_id, name, public, blocked)
-            VALUES (%s, %s, %s, False)
+            INSERT INTO buckets (instance_id, name, public, blocked, iam_mode)
+            VALUES (%s, %s, %s, False, %s)
             ON CONFLICT DO NOTHING
             RETURNING name
-        ''', (instance_id, bucket_name, public))
+        ''', (instance_id, bucket_name, public, iam_mode))
         assert await cur.fetchone(), 'Bucket already exists'
-        async with AsyncExitStack() as exit_stack:
-            await minio_api.create_bucket(bucket_name, exit_stack=exit_stack)
-            if public:
-                await minio_api.bucket_anonymous_set_download(bucket_name, exit_stack=exit_stack)
-            await common.async_run_batches([
-                minio_api.create_policy(policy, template.replace('__BUCKET_NAME__', bucket_name), exit_stack=exit_stack)
-                for policy, template in [
-                    (f'{bucket_name}_read', BUCKET_POLICY_READ_TEMPLATE),
-                    (f'{bucket_name}_write', BUCKET_POLICY_WRITE_TEMPLATE),
-                    (f'{bucket_name}_delete', BUCKET_POLICY_DELETE_TEMPLATE),
-                ]
-            ])
-            instance_access_key = instance['access_key']
-            await common.async_run_batches([
-                minio_api.attach_policy_to_user(policy, instance_access_key, exit_stack=exit_stack)
-                for policy in [
-                    f'{bucket_name}_read',
-                    f'{bucket_name}_write',
-                    f'{bucket_name}_delete',
-                ]
-            ])
-            await conn.commit()
+        async with CompensationStack() as exit_stack:
+            await create_minio_bucket(bucket_name, public, iam_mode, instance['access_key'], exit_stack=exit_stack)
+            await outbox_api.commit(conn, cur, instance_id)
             exit_stack.pop_all()
         return await get(instance_id, bucket_name, cur=cur)
 
 
+async def create_minio_bucket(bucket_name, public, iam_mode, instance_access_key, exit_stack):
+    await minio_api.create_bucket(bucket_name, exit_stack=exit_stack)
+    if public:
+        await minio_api.bucket_anonymous_set_download(bucket_name, exit_stack=exit_stack)
+    await common.async_run_batches([
+        minio_api.create_policy(policy, template.replace('__BUCKET_NAME__', bucket_name), exit_stack=exit_stack)
+        for policy, template in [
+            (f'{bucket_name}_read', BUCKET_POLICY_READ_TEMPLATE),
+            (f'{bucket_name}_write', BUCKET_POLICY_WRITE_TEMPLATE),
+            (f'{bucket_name}_delete', BUCKET_POLICY_DELETE_TEMPLATE),
+        ]
+    ])
+    if iam_mode == IAM_MODE_GROUPS:
+        await common.async_run_batches([
+            create_group(bucket_name, permission, [instance_access_key], exit_stack=exit_stack)
+            for permission in BUCKET_PERMISSIONS
+        ])
+    else:
+        await minio_api.attach_policies_to_user(get_credential_policies(bucket_name), instance_access_key, exit_stack=exit_stack)
+
+
+async def _bulk_create_minio_bucket(bucket_name, public, iam_mode, instance_access_key):
+    # each bucket has its own exit stack, so a failed bucket is rolled back without affecting the others
+    exit_stack = CompensationStack()
+    try:
+        await create_minio_bucket(bucket_name, public, iam_mode, instance_access_key, exit_stack=exit_stack)
+    except BaseException:
+        await exit_stack.aclose()
+        raise
+    return exit_stack
+
+
+@outbox_api.deferred
+async def bulk_create(instance_id, buckets):
+    # buckets is a list of dicts with bucket_name and public keys, returns the result of each bucket
+    bucket_names = [b['bucket_name'] for b in buckets]
+    for bucket_name in bucket_names:
+        common.check_bucket_name(bucket_name)
+    assert len(set(bucket_names)) == len(bucket_names), 'Duplicate bucket names'
+    async with db.connection_cursor() as (conn, cur):
+        instance = await get_instance(instance_id, cur=cur)
+        if instance is None:
+            raise Exception('Instance not found')
+        if instance['blocked']:
+            raise Exception('Instance is blocked')
+        iam_mode = config.BUCKETS_IAM_MODE
+        assert iam_mode in (IAM_MODE_POLICIES, IAM_MODE_GROUPS), f'Invalid IAM mode: {iam_mode}'
+        await cur.execute('''
+            INSERT INTO buckets (instance_id, name, public, blocked, iam_mode)
+            SELECT %s, name, public, False, %s
+            FROM unnest(%s::text[], %s::bool[]) AS b(name, public)
+            ON CONFLICT DO NOTHING
+            RETURNING name
+        ''', (instance_id, iam_mode, bucket_names, [bool(b.get('public')) for b in buckets]))
+        inserted = {row['name'] for row in await cur.fetchall()}
+        results = {
+            b['bucket_name']: {'bucket_name': b['bucket_name'], 'public': bool(b.get('public')), 'created': False, 'error': 'Bucket already exists'}
+            for b in buckets
+        }
+        to_create = [b for b in buckets if b['bucket_name'] in inserted]
+        exit_stacks = await common.async_run_window((
+            _bulk_create_minio_bucket(b['bucket_name'], bool(b.get('public')), iam_mode, instance['access_key'])
+            for b in to_create
+        ), return_exceptions=True)
+        failed = []
+        for b, exit_stack in zip(to_create, exit_stacks):
+            result = results[b['bucket_name']]
+            if isinstance(exit_stack, Exception):
+                failed.append(b['bucket_name'])
+                result['error'] = common.format_error(exit_stack)
+            else:
+                result.update(created=True, error=None)
+        exit_stacks = [exit_stack for exit_stack in exit_stacks if not isinstance(exit_stack, Exception)]
+        try:
+            if failed:
+                await cur.execute('DELETE FROM buckets WHERE instance_id = %s AND name = ANY(%s)', (instance_id, failed))
+            await outbox_api.commit(conn, cur, instance_id)
+        except BaseException:
+            await common.async_run_window(exit_stack.aclose() for exit_stack in exit_stacks)
+            raise
+        for exit_stack in exit_stacks:
+            exit_stack.pop_all()
+        return [results[bucket_name] for bucket_name in bucket_names]
+
+
 async def update_block(instance_id, bucket_name, blocked):
     bucket = await get(instance_id, bucket_name)
     return await update(instance_id, bucket_name, public=bucket['public'], blocked=blocked)
 
 
+@outbox_api.deferred
 async def update(instance_id, bucket_name, public, blocked):
     async with db.connection_cursor() as (conn, cur):
         instance = await get_instance(instance_id, cur=cur)
         if instance is None:
             raise Exception('Instance not found')
+        if instance['blocked'] and await get_instance_block_strategy(instance_id, cur=cur) == INSTANCE_BLOCK_STRATEGY_USERS:
+            # the bucket anonymous access is restored when the instance is unblocked
+            raise Exception('Instance is blocked')
         bucket = await get(instance_id, bucket_name, cur=cur)
         if bucket is None:
             raise Exception('Bucket not found')
+        iam_mode = await get_iam_mode(instance_id, bucket_name, cur=cur)
         await cur.execute('''
             UPDATE buckets
             SET public = %s, blocked = %s
             WHERE instance_id = %s AND name = %s
         ''', (public, blocked, instance_id, bucket_name))
-        async with AsyncExitStack() as stack:
+        async with CompensationStack() as stack:
             action_block_bucket = blocked and not bucket['blocked']
             action_unblock_bucket = not blocked and bucket['blocked']
             action_public_bucket = public and not bucket['public']
@@ -142,47 +223,123 @@ async def update(instance_id, bucket_name, public, blocked):
                 await minio_api.bucket_anonymous_set_download(bucket_name, exit_stack=stack)
             if action_private_bucket or (action_block_bucket and public):
                 await minio_api.bucket_anonymous_set_none(bucket_name, exit_stack=stack)
-            if action_block_bucket:
-                await update_instance_access_key(bucket_name, instance['access_key'], None)
-                credentials = [c async for c in credentials_list_iterator(instance_id, bucket_name, cur=cur)]
+            if iam_mode == IAM_MODE_GROUPS:
+                # group members are kept, the bucket groups are disabled / enabled regardless of the number of credentials
+                if action_block_bucket or action_unblock_bucket:
+                    await common.async_run_batches([
+                        minio_api.set_group_status(f'{bucket_name}_{permission}', action_unblock_bucket, exit_stack=stack)
+                        for permission in BUCKET_PERMISSIONS
+                    ])
+            else:
+                if action_block_bucket:
+                    await update_instance_access_key(bucket_name, instance['access_key'], None)
+                    await common.async_run_window(
+                        credentials_detach(bucket_name, c['access_key'], exit_stack=stack)
+                        async for c in credentials_list_iterator(instance_id, bucket_name, cur=cur)
+                    )
+                if action_unblock_bucket:
+                    await update_instance_access_key(bucket_name, None, instance['access_key'])
+                    await common.async_run_window(
+                        credentials_attach(bucket_name, c['access_key'], c['permission_read'], c['permission_write'], c['permission_delete'], exit_stack=stack)
+                        async for c in credentials_list_iterator(instance_id, bucket_name, cur=cur)
+                    )
+            await outbox_api.commit(conn, cur, instance_id)
+            stack.pop_all()
+        return await get(instance_id, bucket_name, cur=cur)
+
+
+async def update_instance_block(instance, blocked, cur, exit_stack):
+    # set-based version of update_block for all buckets of the instance, runs in the caller's transaction
+    instance_id = instance['instance_id']
+    instance_access_key = instance['access_key']
+    await cur.execute('''
+        UPDATE buckets
+        SET blocked = %s
+        WHERE instance_id = %s AND blocked != %s
+        RETURNING name, public, iam_mode
+    ''', (blocked, instance_id, blocked))
+    buckets = sorted(await cur.fetchall(), key=lambda b: b['name'])
+    # groups mode bucket credentials stay in the groups
+    await cur.execute('''
+        SELECT bucket_name, access_key, permission_read, permission_write, permission_delete
+        FROM bucket_credentials
+        WHERE instance_id = %s AND bucket_name = ANY(%s)
+        ORDER BY bucket_name, access_key
+    ''', (instance_id, [b['name'] for b in buckets if b['iam_mode'] != IAM_MODE_GROUPS]))
+    credentials = await cur.fetchall()
+    # plan of all the MinIO operations, same as update_block does for each bucket,
+    # policies are attached / detached with one call per user
+    plan = []
+    user_policies = {}
+    for bucket in buckets:
+        bucket_name = bucket['name']
+        if bucket['public']:
+            plan.append((minio_api.bucket_anonymous_set_none if blocked else minio_api.bucket_anonymous_set_download, bucket_name))
+        if bucket['iam_mode'] == IAM_MODE_GROUPS:
+            plan.extend(
+                (minio_api.set_group_status, f'{bucket_name}_{permission}', not blocked)
+                for permission in BUCKET_PERMISSIONS
+            )
+        elif instance_access_key:
+            user_policies.setdefault(instance_access_key, []).extend(get_credential_policies(bucket_name))
+    for c in credentials:
+        if blocked:
+            policies = get_credential_policies(c['bucket_name'])
+        else:
+            policies = get_credential_policies(c['bucket_name'], c['permission_read'], c['permission_write'], c['permission_delete'])
+        user_policies.setdefault(c['access_key'], []).extend(policies)
+    plan.extend(
+        (minio_api.detach_policies_from_user if blocked else minio_api.attach_policies_to_user, policies, user_name)
+        for user_name, policies in user_policies.items()
+    )
+    await common.async_run_window(
+        func(*args, exit_stack=exit_stack)
+        for func, *args in plan
+    )
+    return [b['name'] for b in buckets]
+
+
+async def update_instance_anonymous_access(instance_id, blocked, cur, exit_stack):
+    # removes / restores anonymous access of the public buckets which are not blocked, used by the users block strategy
+    await cur.execute('''
+        SELECT name FROM buckets
+        WHERE instance_id = %s AND public AND NOT blocked
+    ''', (instance_id,))
+    await common.async_run_window(
+        (minio_api.bucket_anonymous_set_none if blocked else minio_api.bucket_anonymous_set_download)(row['name'], exit_stack=exit_stack)
+        for row in await cur.fetchall()
+    )
+
+
+async def update_instance_access_key(bucket_name, old_access_key, new_access_key, iam_mode=IAM_MODE_POLICIES):
+    if iam_mode == IAM_MODE_GROUPS:
+        groups = [f'{bucket_name}_{permission}' for permission in BUCKET_PERMISSIONS]
+        async with CompensationStack() as stack:
+            # new member is added first so that the groups are never empty
+            if new_access_key:
                 await common.async_run_batches([
-                    credentials_detach(bucket_name, c['access_key'], exit_stack=stack)
-                    for c in credentials
+                    minio_api.add_users_to_group(group, [new_access_key], exit_stack=stack)
+                    for group in groups
                 ])
-            if action_unblock_bucket:
-                await update_instance_access_key(bucket_name, None, instance['access_key'])
-                credentials = [c async for c in credentials_list_iterator(instance_id, bucket_name, cur=cur)]
+            if old_access_key:
                 await common.async_run_batches([
-                    credentials_attach(bucket_name, c['access_key'], c['permission_read'], c['permission_write'], c['permission_delete'], exit_stack=stack)
-                    for c in credentials
+                    minio_api.remove_users_from_group(group, [old_access_key], exit_stack=stack)
+                    for group in groups
                 ])
-            await conn.commit()
             stack.pop_all()
-        return await get(instance_id, bucket_name, cur=cur)
-
-
-async def update_instance_access_key(bucket_name, old_access_key, new_access_key):
-    policies = [
-        f'{bucket_name}_read',
-        f'{bucket_name}_write',
-        f'{bucket_name}_delete',
-    ]
-    async with AsyncExitStack() as stack:
+        return
+    policies = get_credential_policies(bucket_name)
+    async with CompensationStack() as stack:
         tasks = []
         if old_access_key:
-            tasks.extend([
-                minio_api.detach_policy_from_user(policy, old_access_key, exit_stack=stack)
-                for policy in policies
-            ])
+            tasks.append(minio_api.detach_policies_from_user(policies, old_access_key, exit_stack=stack))
         if new_access_key:
-            tasks.extend([
-                minio_api.attach_policy_to_user(policy, new_access_key, exit_stack=stack)
-                for policy in policies
-            ])
+            tasks.append(minio_api.attach_policies_to_user(policies, new_access_key, exit_stack=stack))
         await common.async_run_batches(tasks)
         stack.pop_all()
 
 
+@outbox_api.deferred
 async def delete(instance_id, bucket_name):
     async with db.connection_cursor() as (conn, cur):
         instance = await get_instance(instance_id, cur=cur)
@@ -191,8 +348,9 @@ async def delete(instance_id, bucket_name):
         bucket = await get(instance_id, bucket_name, cur=cur)
         if bucket is None:
             raise Exception('Bucket not found')
+        iam_mode = await get_iam_mode(instance_id, bucket_name, cur=cur)
         credentials = [c async for c in credentials_list_iterator(instance_id, bucket_name, cur=cur)]
-        async with AsyncExitStack() as stack:
+        async with CompensationStack() as stack:
             await cur.execute('''
                 DELETE FROM bucket_credentials
                 WHERE instance_id = %s AND bucket_name = %s
@@ -201,11 +359,21 @@ async def delete(instance_id, bucket_name):
                 DELETE FROM buckets
                 WHERE instance_id = %s AND name = %s
             ''', (instance_id, bucket_name))
-            await update_instance_access_key(bucket_name, instance['access_key'], None)
-            await common.async_run_batches([
-                credentials_detach(bucket_name, c['access_key'], exit_stack=stack)
-                for c in credentials
-            ])
+            await cur.execute('DELETE FROM bucket_usage WHERE bucket_name = %s', (bucket_name,))
+            if iam_mode == IAM_MODE_GROUPS:
+                await common.async_run_batches([
+                    minio_api.delete_group(f'{bucket_name}_{permission}', [
+                        instance['access_key'],
+                        *[c['access_key'] for c in credentials if c[f'permission_{permission}']],
+                    ])
+                    for permission in BUCKET_PERMISSIONS
+                ])
+            else:
+                await update_instance_access_key(bucket_name, instance['access_key'], None)
+                await common.async_run_batches([
+                    credentials_detach(bucket_name, c['access_key'], exit_stack=stack)
+                    for c in credentials
+                ])
             await common.async_run_batches([
                 minio_api.delete_policy(policy)
                 for policy in [
@@ -215,26 +383,36 @@ async def delete(instance_id, bucket_name):
                 ]
             ])
             await minio_api.delete_bucket(bucket_name)
-            await conn.commit()
+            await outbox_api.commit(conn, cur, instance_id)
             stack.pop_all()
+    await jobs_api.progress_advance()
 
 
 async def list_iterator(instance_id, cur=None, with_size=False):
+    # sizes are served from bucket_usage cache, see usage.py
     total_size = 0
+    max_size_age_seconds = None
     async with db.connection_cursor(cur) as (conn, cur):
-        await cur.execute('SELECT name FROM buckets WHERE instance_id = %s', (instance_id,))
+        if with_size:
+            await cur.execute('''
+                SELECT buckets.name, bucket_usage.size_bytes,
+                       extract(epoch FROM now() - bucket_usage.updated_at)::float AS size_age_seconds
+                FROM buckets
+                LEFT JOIN bucket_usage ON bucket_usage.bucket_name = buckets.name
+                WHERE buckets.instance_id = %s
+            ''', (instance_id,))
+        else:
+            await cur.execute('SELECT name FROM buckets WHERE instance_id = %s', (instance_id,))
         async for row in cur:
             if with_size:
-                try:
-                    size = await minio_api.get_bucket_size(row['name'])
-                except:
-                    traceback.print_exc()
-                    size = None
-                if size:
-                    total_size += size
+                if row['size_bytes']:
+                    total_size += row['size_bytes']
+                if row['size_age_seconds'] is not None and (max_size_age_seconds is None or row['size_age_seconds'] > max_size_age_seconds):
+                    max_size_age_seconds = row['size_age_seconds']
                 yield {
                     'name': row['name'],
-                    'size_bytes': size,
+                    'size_bytes': row['size_bytes'],
+                    'size_age_seconds': row['size_age_seconds'],
                 }
             else:
                 yield row['name']
@@ -242,15 +420,18 @@ async def list_iterator(instance_id, cur=None, with_size=False):
         yield {
             'name': '*',
             'size_bytes': total_size,
+            'size_age_seconds': max_size_age_seconds,
         }
 
 
 async def get(instance_id, bucket_name, cur=None, with_size=False):
     async with db.connection_cursor(cur) as (conn, cur):
         await cur.execute('''
-            SELECT public, blocked
+            SELECT buckets.public, buckets.blocked, bucket_usage.size_bytes,
+                   extract(epoch FROM now() - bucket_usage.updated_at)::float AS size_age_seconds
             FROM buckets
-            WHERE name = %s AND instance_id = %s
+            LEFT JOIN bucket_usage ON bucket_usage.bucket_name = buckets.name
+            WHERE buckets.name = %s AND buckets.instance_id = %s
         ''', (bucket_name,instance_id))
         row = await cur.fetchone()
         if row is None:
@@ -263,15 +444,100 @@ async def get(instance_id, bucket_name, cur=None, with_size=False):
                 'blocked': row['blocked']
             }
             if with_size:
-                try:
-                    size = await minio_api.get_bucket_size(bucket_name)
-                except:
-                    traceback.print_exc()
-                    size = None
-                res['size_bytes'] = size
+                res['size_bytes'] = row['size_bytes']
+                res['size_age_seconds'] = row['size_age_seconds']
             return res
 
 
+async def get_iam_mode(instance_id, bucket_name, cur=None):
+    async with db.connection_cursor(cur) as (conn, cur):
+        await cur.execute('''
+            SELECT iam_mode
+            FROM buckets
+            WHERE name = %s AND instance_id = %s
+        ''', (bucket_name, instance_id))
+        row = await cur.fetchone()
+        return row['iam_mode'] if row else None
+
+
+async def get_iam_modes(instance_id, cur=None):
+    # bucket name: iam mode of all the instance buckets
+    async with db.connection_cursor(cur) as (conn, cur):
+        await cur.execute('''
+            SELECT name, iam_mode
+            FROM buckets
+            WHERE instance_id = %s
+        ''', (instance_id,))
+        return {row['name']: row['iam_mode'] for row in await cur.fetchall()}
+
+
+async def create_group(bucket_name, permission, access_keys, enabled=True, exit_stack=None):
+    group = f'{bucket_name}_{permission}'
+    await minio_api.create_group(group, access_keys, exit_stack=exit_stack)
+    if not enabled:
+        # group is disabled before the policy is attached so its members never get access
+        await minio_api.set_group_status(group, False)
+    await minio_api.attach_policy_to_group(f'{bucket_name}_{permission}', group, exit_stack=exit_stack)
+
+
+async def migrate_iam_groups(instance_id=None):
+    async with db.connection_cursor() as (conn, cur):
+        if instance_id:
+            await cur.execute('SELECT instance_id, name FROM buckets WHERE iam_mode = %s AND instance_id = %s', (IAM_MODE_POLICIES, instance_id))
+        else:
+            await cur.execute('SELECT instance_id, name FROM buckets WHERE iam_mode = %s', (IAM_MODE_POLICIES,))
+        buckets = await cur.fetchall()
+    # migrate as many buckets as possible and only then fail on errors
+    errors = [
+        res for res in await common.async_run_window((
+            migrate_bucket_iam_groups(bucket['instance_id'], bucket['name'])
+            for bucket in buckets
+        ), return_exceptions=True)
+        if isinstance(res, Exception)
+    ]
+    if errors:
+        raise ExceptionGroup('Migrate IAM groups: failed to migrate buckets', errors)
+    return {'migrated_buckets': len(buckets)}
+
+
+@outbox_api.deferred
+async def migrate_bucket_iam_groups(instance_id, bucket_name):
+    async with db.connection_cursor() as (conn, cur):
+        await cur.execute('''
+            SELECT blocked, iam_mode
+            FROM buckets
+            WHERE instance_id = %s AND name = %s
+            FOR UPDATE
+        ''', (instance_id, bucket_name))
+        bucket = await cur.fetchone()
+        if bucket is None or bucket['iam_mode'] == IAM_MODE_GROUPS:
+            return
+        instance = await get_instance(instance_id, cur=cur)
+        credentials = [c async for c in credentials_list_iterator(instance_id, bucket_name, cur=cur)]
+        async with CompensationStack() as stack:
+            await cur.execute('''
+                UPDATE buckets
+                SET iam_mode = %s
+                WHERE instance_id = %s AND name = %s
+            ''', (IAM_MODE_GROUPS, instance_id, bucket_name))
+            await common.async_run_batches([
+                create_group(bucket_name, permission, [
+                    instance['access_key'],
+                    *[c['access_key'] for c in credentials if c[f'permission_{permission}']],
+                ], enabled=not bucket['blocked'], exit_stack=stack)
+                for permission in BUCKET_PERMISSIONS
+            ])
+            # policies of blocked buckets are already detached from the users,
+            # otherwise they are detached only after the groups grant the same access
+            if not bucket['blocked']:
+                await common.async_run_window(
+                    credentials_detach(bucket_name, access_key, exit_stack=stack)
+                    for access_key in [instance['access_key'], *[c['access_key'] for c in credentials]]
+                )
+            await outbox_api.commit(conn, cur, instance_id)
+            stack.pop_all()
+
+
 async def list_buckets_prometheus_sd(targets):
     async with db.connection_cursor() as (conn, cur):
         await cur.execute('SELECT name FROM buckets')
@@ -295,14 +561,19 @@ def get_credential_policies(bucket_name, permission_read=True, permission_write=
     return policies
 
 
-async def credentials_attach(bucket_name, access_key, permission_read, permission_write, permission_delete, exit_stack=None):
+async def credentials_attach(bucket_name, access_key, permission_read, permission_write, permission_delete, exit_stack=None, iam_mode=IAM_MODE_POLICIES):
+    # groups have the same names as the policies
     policies = get_credential_policies(bucket_name, permission_read, permission_write, permission_delete)
-    await common.async_run_batches([
-        minio_api.attach_policy_to_user(policy, access_key, exit_stack=exit_stack)
-        for policy in policies
-    ])
+    if iam_mode == IAM_MODE_GROUPS:
+        await common.async_run_batches([
+            minio_api.add_users_to_group(group, [access_key], exit_stack=exit_stack)
+            for group in policies
+        ])
+    elif policies:
+        await minio_api.attach_policies_to_user(policies, access_key, exit_stack=exit_stack)
 
 
+@outbox_api.deferred
 async def credentials_create(instance_id, bucket_name, access_key, read, write, delete):
     if not any([read, write, delete]):
         raise Exception('At least one permission must be specified')
@@ -317,17 +588,92 @@ async def credentials_create(instance_id, bucket_name, access_key, read, write,
             raise Exception('Credentials not found')
         if await credentials_get(instance_id, bucket_name, access_key, cur=cur) is not None:
             raise Exception('Credentials already assigned')
-        async with AsyncExitStack() as exit_stack:
+        async with CompensationStack() as exit_stack:
             await cur.execute('''
                 INSERT INTO bucket_credentials (instance_id, bucket_name, access_key, permission_read, permission_write, permission_delete)
                 VALUES (%s, %s, %s, %s, %s, %s)
             ''', (instance_id, bucket_name, access_key, read, write, delete))
-            await credentials_attach(bucket_name, access_key, read, write, delete, exit_stack=exit_stack)
-            await conn.commit()
+            iam_mode = await get_iam_mode(instance_id, bucket_name, cur=cur)
+            await credentials_attach(bucket_name, access_key, read, write, delete, exit_stack=exit_stack, iam_mode=iam_mode)
+            await outbox_api.commit(conn, cur, instance_id)
             exit_stack.pop_all()
     return await credentials_get(instance_id, bucket_name, access_key)
 
 
+@outbox_api.deferred
+async def credentials_bulk_create(instance_id, bindings):
+    # bindings is a list of dicts with bucket_name, access_key, read, write and delete keys
+    for b in bindings:
+        if not any([b.get('read'), b.get('write'), b.get('delete')]):
+            raise Exception(f'At least one permission must be specified: {b["bucket_name"]} {b["access_key"]}')
+    keys = [(b['bucket_name'], b['access_key']) for b in bindings]
+    assert len(set(keys)) == len(keys), 'Duplicate bucket credentials'
+    bucket_names = sorted({b['bucket_name'] for b in bindings})
+    access_keys = sorted({b['access_key'] for b in bindings})
+    async with db.connection_cursor() as (conn, cur):
+        await cur.execute('''
+            SELECT name, blocked, iam_mode
+            FROM buckets
+            WHERE instance_id = %s AND name = ANY(%s)
+        ''', (instance_id, bucket_names))
+        buckets = {row['name']: row for row in await cur.fetchall()}
+        for bucket_name in bucket_names:
+            if bucket_name not in buckets:
+                raise Exception(f'Bucket not found: {bucket_name}')
+            if buckets[bucket_name]['blocked']:
+                raise Exception(f'Bucket is blocked: {bucket_name}')
+        await cur.execute('''
+            SELECT access_key
+            FROM credentials
+            WHERE instance_id = %s AND access_key = ANY(%s)
+        ''', (instance_id, access_keys))
+        existing_access_keys = {row['access_key'] for row in await cur.fetchall()}
+        for access_key in access_keys:
+            if access_key not in existing_access_keys:
+                raise Exception(f'Credentials not found: {access_key}')
+        await cur.execute('''
+            INSERT INTO bucket_credentials (instance_id, bucket_name, access_key, permission_read, permission_write, permission_delete)
+            SELECT %s, *
+            FROM unnest(%s::text[], %s::text[], %s::bool[], %s::bool[], %s::bool[])
+            ON CONFLICT DO NOTHING
+            RETURNING bucket_name, access_key
+        ''', (
+            instance_id,
+            [b['bucket_name'] for b in bindings],
+            [b['access_key'] for b in bindings],
+            [bool(b.get('read')) for b in bindings],
+            [bool(b.get('write')) for b in bindings],
+            [bool(b.get('delete')) for b in bindings],
+        ))
+        inserted = {(row['bucket_name'], row['access_key']) for row in await cur.fetchall()}
+        for key in keys:
+            if key not in inserted:
+                raise Exception(f'Credentials already assigned: {key[0]} {key[1]}')
+        # policies are attached with one call per user, groups mode members are added with one call per group
+        user_policies, group_users = {}, {}
+        for b in bindings:
+            for policy in get_credential_policies(b['bucket_name'], b.get('read'), b.get('write'), b.get('delete')):
+                if buckets[b['bucket_name']]['iam_mode'] == IAM_MODE_GROUPS:
+                    group_users.setdefault(policy, []).append(b['access_key'])
+                else:
+                    user_policies.setdefault(b['access_key'], []).append(policy)
+        async with CompensationStack() as exit_stack:
+            await common.async_run_window([
+                *(
+                    minio_api.attach_policies_to_user(policies, access_key, exit_stack=exit_stack)
+                    for access_key, policies in user_policies.items()
+                ),
+                *(
+                    minio_api.add_users_to_group(group, users, exit_stack=exit_stack)
+                    for group, users in group_users.items()
+                ),
+            ])
+            await outbox_api.commit(conn, cur, instance_id)
+            exit_stack.pop_all()
+    return {'num_credentials': len(bindings)}
+
+
+@outbox_api.deferred
 async def credentials_update(instance_id, bucket_name, access_key, read, write, delete):
     if not any([read, write, delete]):
         raise Exception('At least one permission must be specified')
@@ -343,32 +689,64 @@ async def credentials_update(instance_id, bucket_name, access_key, read, write,
         existing_credential = await credentials_get(instance_id, bucket_name, access_key, cur=cur)
         if existing_credential is None:
             raise Exception('Credentials not found')
-        async with AsyncExitStack() as exit_stack:
+        async with CompensationStack() as exit_stack:
             await cur.execute('''
                 UPDATE bucket_credentials
                 SET permission_read = %s, permission_write = %s, permission_delete = %s
                 WHERE instance_id = %s AND bucket_name = %s AND access_key = %s
             ''', (read, write, delete, instance_id, bucket_name, access_key))
-            await credentials_detach(
-                bucket_name,
-                access_key,
-                exit_stack=exit_stack,
-            )
-            await credentials_attach(bucket_name, access_key, read, write, delete, exit_stack=exit_stack)
-            await conn.commit()
+            iam_mode = await get_iam_mode(instance_id, bucket_name, cur=cur)
+            plan = get_credential_policies_delta(bucket_name, existing_credential, read, write, delete)
+            plan['minio_operations'] = await credentials_apply_delta(bucket_name, access_key, plan, exit_stack=exit_stack, iam_mode=iam_mode)
+            await outbox_api.commit(conn, cur, instance_id)
             exit_stack.pop_all()
-    return await credentials_get(instance_id, bucket_name, access_key)
-
-
-async def credentials_detach(bucket_name, access_key, exit_stack=None):
+    return {
+        **await credentials_get(instance_id, bucket_name, access_key),
+        'plan': plan,
+    }
+
+
+def get_credential_policies_delta(bucket_name, existing_credential, read, write, delete):
+    # groups have the same names as the policies
+    existing = get_credential_policies(bucket_name, existing_credential['permission_read'], existing_credential['permission_write'], existing_credential['permission_delete'])
+    requested = get_credential_policies(bucket_name, read, write, delete)
+    return {
+        'attach': [policy for policy in requested if policy not in existing],
+        'detach': [policy for policy in existing if policy not in requested],
+    }
+
+
+async def credentials_apply_delta(bucket_name, access_key, plan, exit_stack=None, iam_mode=IAM_MODE_POLICIES):
+    # returns the number of MinIO operations
+    if iam_mode == IAM_MODE_GROUPS:
+        operations = [
+            *(minio_api.add_users_to_group(group, [access_key], exit_stack=exit_stack) for group in plan['attach']),
+            *(minio_api.remove_users_from_group(group, [access_key], exit_stack=exit_stack) for group in plan['detach']),
+        ]
+    else:
+        # all the changed policies of the user are attached / detached with a single call
+        operations = [
+            *([minio_api.attach_policies_to_user(plan['attach'], access_key, exit_stack=exit_stack)] if plan['attach'] else []),
+            *([minio_api.detach_policies_from_user(plan['detach'], access_key, exit_stack=exit_stack)] if plan['detach'] else []),
+        ]
+    await common.async_run_batches(operations)
+    return len(operations)
+
+
+async def credentials_detach(bucket_name, access_key, exit_stack=None, iam_mode=IAM_MODE_POLICIES, credential=None):
+    if iam_mode == IAM_MODE_GROUPS:
+        # leave only the groups the access key is a member of, so that a rollback doesn't add it to other groups
+        groups = get_credential_policies(bucket_name, credential['permission_read'], credential['permission_write'], credential['permission_delete'])
+        await common.async_run_batches([
+            minio_api.remove_users_from_group(group, [access_key], exit_stack=exit_stack)
+            for group in groups
+        ])
+        return
     # minio detach policy does not fail if policy does not exist, so we just detach all policies regardless of which ones the access key actually has
-    policies = get_credential_policies(bucket_name)
-    await common.async_run_batches([
-        minio_api.detach_policy_from_user(policy, access_key, exit_stack=exit_stack)
-        for policy in policies
-    ])
+    await minio_api.detach_policies_from_user(get_credential_policies(bucket_name), access_key, exit_stack=exit_stack)
 
 
+@outbox_api.deferred
 async def credentials_delete(instance_id, bucket_name, access_key):
     async with db.connection_cursor() as (conn, cur):
         bucket = await get(instance_id, bucket_name, cur=cur)
@@ -377,7 +755,7 @@ async def credentials_delete(instance_id, bucket_name, access_key):
         credential = await credentials_get(instance_id, bucket_name, access_key, cur=cur)
         if credential is None:
             raise Exception('Credentials not found')
-        async with AsyncExitStack() as stack:
+        async with CompensationStack() as stack:
             await cur.execute('''
                 DELETE FROM bucket_credentials
                 WHERE instance_id = %s AND bucket_name = %s AND access_key = %s
@@ -385,9 +763,11 @@ async def credentials_delete(instance_id, bucket_name, access_key):
             await credentials_detach(
                 bucket_name,
                 access_key,
-                exit_stack=stack
+                exit_stack=stack,
+                iam_mode=await get_iam_mode(instance_id, bucket_name, cur=cur),
+                credential=credential,
             )
-            await conn.commit()
+            await outbox_api.commit(conn, cur, instance_id)
             stack.pop_all()
 
 
@@ -1,9 +1,11 @@
 import asyncclick as click
-from fastapi import APIRouter
+from fastapi import APIRouter, Query
 from pydantic import BaseModel
 
-from . import api
+from . import api, usage
 from .. import common
+from ..jobs import api as jobs_api
+from ..jobs.router import accepted
 
 
 router = APIRouter()
@@ -25,6 +27,21 @@ async def create(request: CreateRequest):
     return common.cli_print_json(await api.create(request.instance_id, request.bucket_name, request.public))
 
 
+class BulkCreateBucket(BaseModel):
+    bucket_name: str
+    public: bool = False
+
+
+class BulkCreateRequest(BaseModel):
+    instance_id: str
+    buckets: list[BulkCreateBucket]
+
+
+@router.post('/buckets/bulk_create', tags=['buckets'])
+async def bulk_create(request: BulkCreateRequest):
+    return common.cli_print_json(await api.bulk_create(request.instance_id, [b.model_dump() for b in request.buckets]))
+
+
 class UpdateRequest(BaseModel):
     instance_id: str
     bucket_name: str
@@ -40,8 +57,11 @@ async def update(request: UpdateRequest):
 @main.command()
 @click.argument('instance_id')
 @click.argument('bucket_name')
+@click.option('--async', 'async_', is_flag=True)
 @router.delete('/buckets/delete', tags=['buckets'])
-async def delete(instance_id: str, bucket_name: str):
+async def delete(instance_id: str, bucket_name: str, async_: bool = Query(False, alias='async')):
+    if async_:
+        return accepted(await jobs_api.submit('buckets_delete', instance_id=instance_id, bucket_name=bucket_name))
     return common.cli_print_json(await api.delete(instance_id, bucket_name))
 
 
@@ -80,6 +100,20 @@ async def get(instance_id: str, bucket_name: str, with_size: bool = False):
         return bucket
 
 
+@main.command()
+@click.option('--instance-id')
+@router.post('/buckets/usage/refresh', tags=['buckets'])
+async def usage_refresh(instance_id: str | None = None):
+    return common.cli_print_json(await usage.refresh(instance_id))
+
+
+@main.command()
+@click.option('--instance-id')
+async def migrate_iam_groups(instance_id: str | None = None):
+    # migrate existing buckets to the groups IAM mode, set BUCKETS_IAM_MODE=groups to create new buckets in this mode
+    return common.cli_print_json(await api.migrate_iam_groups(instance_id))
+
+
 class CredentialsRequest(BaseModel):
     instance_id: str
     bucket_name: str
@@ -94,6 +128,24 @@ async def credentials_create(request: CredentialsRequest):
     return common.cli_print_json(await api.credentials_create(request.instance_id, request.bucket_name, request.access_key, request.read, request.write, request.delete))
 
 
+class CredentialsBulkBinding(BaseModel):
+    bucket_name: str
+    access_key: str
+    read: bool
+    write: bool
+    delete: bool
+
+
+class CredentialsBulkCreateRequest(BaseModel):
+    instance_id: str
+    bindings: list[CredentialsBulkBinding]
+
+
+@router.post('/buckets/credentials/bulk_create', tags=['buckets'])
+async def credentials_bulk_create(request: CredentialsBulkCreateRequest):
+    return common.cli_print_json(await api.credentials_bulk_create(request.instance_id, [b.model_dump() for b in request.bindings]))
+
+
 @router.put('/buckets/credentials', tags=['buckets'])
 async def credentials_update(request: CredentialsRequest):
     return common.cli_print_json(await api.credentials_update(request.instance_id, request.bucket_name, request.access_key, request.read, request.write, request.delete))
@@ -0,0 +1,58 @@
+import asyncio
+import logging
+
+from .. import db, config
+from ..minio import api as minio_api
+
+
+async def refresh(instance_id=None):
+    async with db.connection_cursor() as (conn, cur):
+        if instance_id:
+            await cur.execute('SELECT name FROM buckets WHERE instance_id = %s', (instance_id,))
+        else:
+            await cur.execute('SELECT name FROM buckets')
+        bucket_names = [row['name'] async for row in cur]
+    # DB connection is not held while waiting for MinIO
+    sizes = await minio_api.get_buckets_sizes(bucket_names) if bucket_names else {}
+    async with db.connection_cursor() as (conn, cur):
+        if sizes:
+            await cur.executemany('''
+                INSERT INTO bucket_usage (bucket_name, size_bytes, updated_at)
+                VALUES (%s, %s, now())
+                ON CONFLICT (bucket_name) DO UPDATE
+                SET size_bytes = excluded.size_bytes, updated_at = excluded.updated_at
+            ''', list(sizes.items()))
+        await cur.execute('''
+            DELETE FROM bucket_usage
+            WHERE NOT EXISTS (SELECT 1 FROM buckets WHERE buckets.name = bucket_usage.bucket_name)
+        ''')
+        await conn.commit()
+    return {'buckets': len(sizes)}
+
+
+async def collect_if_due(interval_seconds=None):
+    if interval_seconds is None:
+        interval_seconds = config.BUCKETS_USAGE_COLLECTOR_INTERVAL_SECONDS
+    # only one of the API workers claims each collection run
+    async with db.connection_cursor() as (conn, cur):
+        await cur.execute('''
+            UPDATE bucket_usage_collector
+            SET last_run_at = now()
+            WHERE id = 1 AND last_run_at < now() - make_interval(secs => %s)
+            RETURNING id
+        ''', (interval_seconds,))
+        claimed = await cur.fetchone() is not None
+        await conn.commit()
+    if claimed:
+        await refresh()
+    return claimed
+
+
+async def collector_loop():
+    while True:
+        try:
+            if await collect_if_due():
+                logging.info('Bucket usage collected')
+        except Exception:
+            logging.exception('Bucket usage collection failed')
+        await asyncio.sleep(config.BUCKETS_USAGE_COLLECTOR_INTERVAL_SECONDS)
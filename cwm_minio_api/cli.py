@@ -1,10 +1,12 @@
 import sys
 import logging
 import importlib
+from contextlib import asynccontextmanager
 
 import asyncclick as click
 
-from . import config, access_keys
+from . import config, access_keys, db
+from .minio import http_backend as minio_http_backend
 from .load_tests import cli as load_tests_cli
 
 
@@ -14,15 +16,25 @@ logging.basicConfig(
 )
 
 
+@asynccontextmanager
+async def resources():
+    yield
+    await minio_http_backend.close()
+    await db.close_pool()
+
+
 @click.group()
-async def main():
-    pass
+@click.pass_context
+async def main(ctx):
+    await ctx.with_async_resource(resources())
 
 
 for submodule in [
     'buckets',
     'credentials',
     'instances',
+    'outbox',
+    'jobs',
 ]:
     main.add_command(getattr(importlib.import_module(f'.{submodule}.router', __package__), 'main'), name=submodule.replace('_', '-'))
 
@@ -1,7 +1,9 @@
 import re
+import time
 import string
 import secrets
 import asyncio
+import contextvars
 
 
 import orjson
@@ -71,11 +73,78 @@ def check_instance_id(instance_id):
         raise ValueError('Instance ID contains invalid characters')
 
 
+async def async_run_window(tasks, window=10, return_exceptions=False):
+    # runs the coroutines with at most `window` of them running concurrently,
+    # a new coroutine is started as soon as a running one finishes.
+    # tasks can be an iterable or an async iterable of coroutines, it is consumed lazily.
+    # returns the results in the same order as the tasks.
+    # if return_exceptions is True, exceptions are returned in the results instead of failing fast,
+    # otherwise the first failure cancels the running tasks and raises an ExceptionGroup like asyncio.TaskGroup
+    is_async = hasattr(tasks, '__aiter__')
+    iterator = aiter(tasks) if is_async else iter(tasks)
+    exhausted = False
+    num_started = 0
+    results = {}
+    errors = []
+    running = {}
+    try:
+        while True:
+            while not exhausted and not errors and len(running) < window:
+                try:
+                    coro = (await anext(iterator)) if is_async else next(iterator)
+                except (StopIteration, StopAsyncIteration):
+                    exhausted = True
+                else:
+                    running[asyncio.create_task(coro)] = num_started
+                    num_started += 1
+            if not running:
+                break
+            done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                i = running.pop(task)
+                if task.cancelled():
+                    errors.append(asyncio.CancelledError())
+                elif task.exception() is not None:
+                    if return_exceptions:
+                        results[i] = task.exception()
+                    else:
+                        errors.append(task.exception())
+                else:
+                    results[i] = task.result()
+            if errors and running:
+                for task in running:
+                    task.cancel()
+                await asyncio.wait(running)
+                for task in running:
+                    if not task.cancelled() and task.exception() is not None:
+                        errors.append(task.exception())
+                running = {}
+    finally:
+        if running:
+            for task in running:
+                task.cancel()
+            await asyncio.wait(running)
+        if not exhausted:
+            if not is_async:
+                # close the coroutines which were not started to prevent "never awaited" warnings
+                for coro in iterator:
+                    coro.close()
+            elif hasattr(iterator, 'aclose'):
+                await iterator.aclose()
+    if errors:
+        raise BaseExceptionGroup('async_run_window errors', errors)
+    return [results[i] for i in range(num_started)]
+
+
+def format_error(e):
+    # flattens the exception groups raised by async_run_window
+    if isinstance(e, BaseExceptionGroup):
+        return '\n'.join(format_error(ex) for ex in e.exceptions)
+    return f'{type(e).__name__}: {e}'
+
+
 async def async_run_batches(tasks, batch_size=10):
-    for i in range(0, len(tasks), batch_size):
-        async with asyncio.TaskGroup() as tg:
-            for task in tasks[i:i + batch_size]:
-                tg.create_task(task)
+    await async_run_window(tasks, window=batch_size)
 
 
 async def wait_for(condition_coro, timeout, check_interval=0.5):
@@ -90,3 +159,36 @@ async def wait_for(condition_coro, timeout, check_interval=0.5):
 
 class ServerOverloadedException(Exception):
     pass
+
+
+class BadRequestException(Exception):
+    pass
+
+
+class DeadlineExceededException(ServerOverloadedException):
+    pass
+
+
+# time.monotonic() deadline of the current API request, None = no deadline
+request_deadline = contextvars.ContextVar('request_deadline', default=None)
+
+
+def get_remaining_seconds(max_seconds=None):
+    # returns the time left until the request deadline (capped by max_seconds), None if there is no limit
+    deadline = request_deadline.get()
+    remaining = None if deadline is None else deadline - time.monotonic()
+    if max_seconds:
+        remaining = max_seconds if remaining is None else min(remaining, max_seconds)
+    if remaining is not None and remaining <= 0:
+        raise DeadlineExceededException('Request deadline exceeded')
+    return remaining
+
+
+# counters of the current operation (e.g. MinIO calls and DB connections), set by the control plane benchmark
+operation_counters = contextvars.ContextVar('operation_counters', default=None)
+
+
+def count_operation(name, num=1):
+    counters = operation_counters.get()
+    if counters is not None:
+        counters[name] = counters.get(name, 0) + num
@@ -1,8 +1,9 @@
-from contextlib import AsyncExitStack
-
 from .. import access_keys, common, db
-from ..instances.api import get as get_instance
+from ..instances.api import get as get_instance, get_block_strategy as get_instance_block_strategy, BLOCK_STRATEGY_USERS as INSTANCE_BLOCK_STRATEGY_USERS
 from ..minio import api as minio_api
+from ..minio.compensation import CompensationStack
+from ..outbox import api as outbox_api
+from ..jobs import api as jobs_api
 
 
 async def create(instance_id):
@@ -10,14 +11,17 @@ async def create(instance_id):
         instance = await get_instance(instance_id, cur=cur)
         if instance is None:
             raise Exception('Instance not found')
-        async with AsyncExitStack() as stack:
-            access_key = await access_keys.get_access_key(exit_stack=stack)
+        async with CompensationStack() as stack:
+            access_key = await access_keys.get_access_key(cur=cur)
             await cur.execute('''
                 INSERT INTO credentials (instance_id, access_key)
                 VALUES (%s, %s)
             ''', (instance_id, access_key))
             secret_key = common.generate_key(40)
             await minio_api.create_user(access_key, secret_key, exit_stack=stack)
+            if instance['blocked'] and await get_instance_block_strategy(instance_id, cur=cur) == INSTANCE_BLOCK_STRATEGY_USERS:
+                # enabled with the other instance users when the instance is unblocked
+                await minio_api.set_user_status(access_key, False, exit_stack=stack)
             await conn.commit()
             stack.pop_all()
         return {
@@ -42,6 +46,7 @@ async def get(access_key, cur=None):
         }
 
 
+@outbox_api.deferred
 async def delete(access_key):
     async with db.connection_cursor() as (conn, cur):
         credential = await get(access_key, cur=cur)
@@ -63,7 +68,8 @@ async def delete(access_key):
             WHERE access_key = %s
         ''', (access_key,))
         await minio_api.delete_user(access_key)
-        await conn.commit()
+        await outbox_api.commit(conn, cur, credential['instance_id'])
+    await jobs_api.progress_advance()
 
 
 async def list_iterator(instance_id, cur=None):
@@ -1,13 +1,107 @@
 import time
+import asyncio
 from contextlib import asynccontextmanager
 
-from psycopg import AsyncConnection
+from psycopg import AsyncConnection, AsyncCursor
+from psycopg.pq import TransactionStatus
 from psycopg.rows import dict_row
 from psycopg.errors import ConnectionTimeout
+from psycopg_pool import AsyncConnectionPool, PoolTimeout
 
 
 from . import config, common
-from .metrics.prometheus import DB_CONN_ACQUIRE_TIME, DB_CONNS_TOTAL
+from .metrics.prometheus import DB_CONN_ACQUIRE_TIME, DB_CONNS_TOTAL, DB_POOL_SIZE, DB_POOL_IDLE, DB_POOL_WAITING
+
+
+_pool = None
+_pool_loop = None
+
+
+async def get_pool():
+    global _pool, _pool_loop
+    loop = asyncio.get_running_loop()
+    if _pool is None or _pool_loop is not loop or _pool.conninfo != config.DB_CONNSTRING:
+        if _pool is not None and _pool_loop is loop:
+            await close_pool()
+        # the pool is bound to the event loop it was created in
+        pool = AsyncConnectionPool(
+            conninfo=config.DB_CONNSTRING,
+            min_size=config.DB_POOL_MIN_SIZE,
+            max_size=config.DB_POOL_MAX_SIZE,
+            max_idle=config.DB_POOL_MAX_IDLE_SECONDS,
+            max_lifetime=config.DB_POOL_MAX_LIFETIME_SECONDS,
+            timeout=config.DB_POOL_TIMEOUT_SECONDS,
+            check=AsyncConnectionPool.check_connection,
+            name='cwm-minio-api',
+            open=False,
+        )
+        _pool, _pool_loop = pool, loop
+        await pool.open()
+    return _pool
+
+
+async def close_pool():
+    global _pool, _pool_loop
+    if _pool is not None:
+        pool, _pool, _pool_loop = _pool, None, None
+        await pool.close()
+
+
+def _update_pool_metrics(pool):
+    try:
+        stats = pool.get_stats()
+        DB_POOL_SIZE.set(stats.get('pool_size', 0))
+        DB_POOL_IDLE.set(stats.get('pool_available', 0))
+        DB_POOL_WAITING.set(stats.get('requests_waiting', 0))
+    except Exception:
+        pass
+
+
+class DeadlineCursor(AsyncCursor):
+    # queries use the time left until the request deadline as timeout, psycopg cancels the query on the server
+
+    async def _run_with_deadline(self, method, *args, **kwargs):
+        timeout = common.get_remaining_seconds()
+        if timeout is None:
+            return await method(*args, **kwargs)
+        try:
+            async with asyncio.timeout(timeout):
+                return await method(*args, **kwargs)
+        except TimeoutError:
+            raise common.DeadlineExceededException(f'DB query timed out after {timeout:.1f}s')
+
+    async def execute(self, *args, **kwargs):
+        return await self._run_with_deadline(super().execute, *args, **kwargs)
+
+    async def executemany(self, *args, **kwargs):
+        return await self._run_with_deadline(super().executemany, *args, **kwargs)
+
+
+@asynccontextmanager
+async def _pooled_connection():
+    pool = await get_pool()
+    _update_pool_metrics(pool)
+    conn = await pool.getconn(timeout=common.get_remaining_seconds(config.DB_POOL_TIMEOUT_SECONDS))
+    try:
+        _update_pool_metrics(pool)
+        yield conn
+    finally:
+        try:
+            # same as closing a non-pooled connection - changes which were not committed are rolled back
+            if conn.info.transaction_status != TransactionStatus.IDLE:
+                await conn.rollback()
+        finally:
+            await pool.putconn(conn)
+            _update_pool_metrics(pool)
+
+
+@asynccontextmanager
+async def _connection():
+    conn = await AsyncConnection.connect(conninfo=config.DB_CONNSTRING)
+    try:
+        yield conn
+    finally:
+        await conn.close()
 
 
 @asynccontextmanager
@@ -15,15 +109,13 @@ async def connection_cursor(cur=None):
     if cur is None:
         start_time = time.perf_counter()
         try:
-            conn = await AsyncConnection.connect(conninfo=config.DB_CONNSTRING)
-            try:
-                async with conn.cursor(row_factory=dict_row) as cur:
+            async with (_pooled_connection() if config.DB_POOL_MAX_SIZE > 0 else _connection()) as conn:
+                async with DeadlineCursor(conn, row_factory=dict_row) as cur:
                     DB_CONNS_TOTAL.labels(outcome="success").inc()
                     DB_CONN_ACQUIRE_TIME.labels(outcome="success").observe(time.perf_counter() - start_time)
+                    common.count_operation('db_connections')
                     yield conn, cur
-            finally:
-                await conn.close()
-        except ConnectionTimeout as e:
+        except (ConnectionTimeout, PoolTimeout) as e:
             DB_CONNS_TOTAL.labels(outcome="timeout").inc()
             DB_CONN_ACQUIRE_TIME.labels(outcome="timeout").observe(time.perf_counter() - start_time)
             raise common.ServerOverloadedException(str(e))
@@ -1,15 +1,21 @@
 import logging
-from contextlib import AsyncExitStack
 
 from ..minio import api as minio_api
-from .. import db, common, access_keys
+from ..minio.compensation import CompensationStack
+from ..outbox import api as outbox_api
+from ..jobs import api as jobs_api
+from .. import db, common, config, access_keys
+
+
+BLOCK_STRATEGY_POLICIES = 'policies'
+BLOCK_STRATEGY_USERS = 'users'
 
 
 async def create(instance_id):
     common.check_instance_id(instance_id)
     async with db.connection_cursor() as (conn, cur):
-        async with AsyncExitStack() as stack:
-            access_key = await access_keys.get_access_key(exit_stack=stack)
+        async with CompensationStack() as stack:
+            access_key = await access_keys.get_access_key(cur=cur)
             await cur.execute('''
                 INSERT INTO instances (id, blocked, access_key)
                 VALUES (%s, %s, %s)
@@ -28,69 +34,115 @@ async def create(instance_id):
         }
 
 
+async def get_block_strategy(instance_id, cur=None):
+    async with db.connection_cursor(cur) as (conn, cur):
+        await cur.execute('''SELECT block_strategy FROM instances WHERE id = %s''', (instance_id,))
+        row = await cur.fetchone()
+        return row['block_strategy'] if row else None
+
+
+async def set_users_status(instance, enabled, cur, exit_stack):
+    # enables / disables the instance user and all its credential users
+    await cur.execute('''SELECT access_key FROM credentials WHERE instance_id = %s''', (instance['instance_id'],))
+    user_names = [instance['access_key'], *(row['access_key'] for row in await cur.fetchall())]
+    await common.async_run_window(
+        minio_api.set_user_status(user_name, enabled, exit_stack=exit_stack)
+        for user_name in user_names
+    )
+
+
+@outbox_api.deferred
 async def update(instance_id, blocked=False, reset_access_key=False):
     async with db.connection_cursor() as (conn, cur):
         instance = await get(instance_id, cur=cur)
         if instance is None:
             raise Exception('Instance not found')
         from ..buckets import api as buckets_api
-        bucket_names = [b async for b in buckets_api.list_iterator(instance_id, cur=cur)]
-        async with AsyncExitStack() as stack:
-            await common.async_run_batches([
-                buckets_api.update_block(instance_id, bucket_name, blocked=blocked)
-                for bucket_name in bucket_names
-            ])
+        bucket_iam_modes = await buckets_api.get_iam_modes(instance_id, cur=cur)
+        # the strategy which blocked the instance is used to unblock it
+        block_strategy = await get_block_strategy(instance_id, cur=cur)
+        if blocked and not instance['blocked']:
+            block_strategy = config.INSTANCES_BLOCK_STRATEGY
+            assert block_strategy in (BLOCK_STRATEGY_POLICIES, BLOCK_STRATEGY_USERS), f'Invalid block strategy: {block_strategy}'
+        async with CompensationStack() as stack:
+            if block_strategy == BLOCK_STRATEGY_USERS:
+                if blocked != instance['blocked']:
+                    await buckets_api.update_instance_anonymous_access(instance_id, blocked, cur=cur, exit_stack=stack)
+                    await set_users_status(instance, not blocked, cur=cur, exit_stack=stack)
+            else:
+                await buckets_api.update_instance_block(instance, blocked, cur=cur, exit_stack=stack)
             if reset_access_key:
                 old_access_key = instance['access_key']
-                access_key = await access_keys.get_access_key(exit_stack=stack)
-                await cur.execute('''UPDATE instances SET blocked = %s, access_key = %s WHERE id = %s''', (blocked, access_key, instance_id))
+                access_key = await access_keys.get_access_key(cur=cur)
+                await cur.execute('''UPDATE instances SET access_key = %s WHERE id = %s''', (access_key, instance_id))
                 secret_key = common.generate_key(40)
                 await minio_api.create_user(access_key, secret_key, exit_stack=stack)
-                await common.async_run_batches([
-                    buckets_api.update_instance_access_key(bucket_name, old_access_key, access_key)
-                    for bucket_name in bucket_names
-                ])
+                if blocked and block_strategy == BLOCK_STRATEGY_USERS:
+                    await minio_api.set_user_status(access_key, False, exit_stack=stack)
+                await common.async_run_window(
+                    buckets_api.update_instance_access_key(bucket_name, old_access_key, access_key, iam_mode=iam_mode)
+                    for bucket_name, iam_mode in bucket_iam_modes.items()
+                )
                 await minio_api.delete_user(old_access_key)
-                await access_keys.delete_access_key(old_access_key)
-            else:
-                await cur.execute('''UPDATE instances SET blocked = %s WHERE id = %s''', (blocked, instance_id))
-            await conn.commit()
+                await access_keys.delete_access_key(old_access_key, cur=cur)
+            await cur.execute('''
+                UPDATE instances SET blocked = %s, block_strategy = %s WHERE id = %s
+            ''', (blocked, block_strategy if blocked else None, instance_id))
+            await outbox_api.commit(conn, cur, instance_id)
             stack.pop_all()
         instance = await get(instance_id, cur=cur)
-        return {
-            **instance,
-            **({'secret_key': secret_key} if reset_access_key else {})
-        }
+    # the buckets are updated in a single transaction, progress is reported once the connection is released
+    await jobs_api.progress_add_total(len(bucket_iam_modes))
+    await jobs_api.progress_advance(len(bucket_iam_modes))
+    return {
+        **instance,
+        **({'secret_key': secret_key} if reset_access_key else {})
+    }
 
 
+@outbox_api.deferred
 async def delete(instance_id):
-    async with db.connection_cursor() as (conn, cur):
-        instance = await get(instance_id, cur=None)
-        if instance is None:
-            raise Exception('Instance not found')
-        from ..buckets import api as buckets_api
-        from ..credentials import api as credentials_api
-        bucket_names = [b async for b in buckets_api.list_iterator(instance_id, cur=cur)]
-        await common.async_run_batches([
+    instance = await get(instance_id)
+    if instance is None:
+        raise Exception('Instance not found')
+    from ..buckets import api as buckets_api
+    from ..credentials import api as credentials_api
+    # each bucket / credentials delete uses its own connection, so no connection is held while they run
+    bucket_names = [bucket_name async for bucket_name in buckets_api.list_iterator(instance_id)]
+    # delete as many buckets and credentials as possible and only then fail on errors
+    await jobs_api.progress_add_total(len(bucket_names))
+    errors = [
+        res for res in await common.async_run_window((
             buckets_api.delete(instance_id, bucket_name)
             for bucket_name in bucket_names
-        ])
-        credentials = [c async for c in credentials_api.list_iterator(instance_id, cur=cur)]
-        await common.async_run_batches([
-            credentials_api.delete(credential['access_key'])
-            for credential in credentials
-        ])
+        ), return_exceptions=True)
+        if isinstance(res, Exception)
+    ]
+    if errors:
+        raise ExceptionGroup(f'Delete instance {instance_id}: failed to delete buckets', errors)
+    credentials_access_keys = [credential['access_key'] async for credential in credentials_api.list_iterator(instance_id)]
+    await jobs_api.progress_add_total(len(credentials_access_keys))
+    errors = [
+        res for res in await common.async_run_window((
+            credentials_api.delete(credentials_access_key)
+            for credentials_access_key in credentials_access_keys
+        ), return_exceptions=True)
+        if isinstance(res, Exception)
+    ]
+    if errors:
+        raise ExceptionGroup(f'Delete instance {instance_id}: failed to delete credentials', errors)
+    async with db.connection_cursor() as (conn, cur):
         access_key = instance['access_key']
         if access_key:
             await minio_api.delete_user(access_key)
-            await access_keys.delete_access_key(access_key)
+            await access_keys.delete_access_key(access_key, cur=cur)
         else:
             logging.warning(f'Delete instance {instance_id}: has no access key set, skipping user deletion')
         await cur.execute('''
             DELETE FROM instances
             WHERE id = %s
         ''', (instance_id,))
-        await conn.commit()
+        await outbox_api.commit(conn, cur, instance_id)
 
 
 async def get(instance_id, cur=None):
@@ -1,9 +1,11 @@
 import asyncclick as click
-from fastapi import APIRouter
+from fastapi import APIRouter, Query
 from pydantic import BaseModel
 
 from . import api
 from .. import common
+from ..jobs import api as jobs_api
+from ..jobs.router import accepted
 
 
 router = APIRouter()
@@ -30,14 +32,19 @@ class UpdateRequest(BaseModel):
 
 
 @router.put('/instances/update', tags=['instances'])
-async def update(request: UpdateRequest):
+async def update(request: UpdateRequest, async_: bool = Query(False, alias='async')):
+    if async_:
+        return accepted(await jobs_api.submit('instances_update', instance_id=request.instance_id, blocked=request.blocked, reset_access_key=request.reset_access_key))
     return common.cli_print_json(await api.update(request.instance_id, request.blocked, request.reset_access_key))
 
 
 @main.command()
 @click.argument('instance_id')
+@click.option('--async', 'async_', is_flag=True)
 @router.delete('/instances/delete', tags=['instances'])
-async def delete(instance_id: str):
+async def delete(instance_id: str, async_: bool = Query(False, alias='async')):
+    if async_:
+        return accepted(await jobs_api.submit('instances_delete', instance_id=instance_id))
     return common.cli_print_json(await api.delete(instance_id))
 
 
@@ -0,0 +1,234 @@
+import asyncio
+import logging
+import importlib
+import contextvars
+
+import orjson
+from psycopg.types.json import Jsonb
+
+from .. import db, config
+from ..minio import api as minio_api
+
+
+# job kind: (module, function, initial items total)
+# the job functions report progress using progress_add_total / progress_advance
+JOB_KINDS = {
+    'instances_update': ('instances', 'update', 0),
+    'instances_delete': ('instances', 'delete', 0),
+    'buckets_delete': ('buckets', 'delete', 1),
+}
+
+# id of the job which is executed in the current context
+current_job_id = contextvars.ContextVar('current_job_id', default=None)
+
+
+def _job(row):
+    return {
+        'job_id': row['id'],
+        'kind': row['kind'],
+        'params': row['params'],
+        'status': row['status'],
+        'items_done': row['items_done'],
+        'items_total': row['items_total'],
+        'result': row['result'],
+        'error': row['error'],
+        'secret_key_available': row['secret_key'] is not None,
+        'created_at': row['created_at'].isoformat(),
+        'started_at': row['started_at'].isoformat() if row['started_at'] else None,
+        'finished_at': row['finished_at'].isoformat() if row['finished_at'] else None,
+    }
+
+
+async def submit(kind, **params):
+    assert kind in JOB_KINDS, f'Invalid job kind: {kind}'
+    dedupe_key = f'{kind}:{orjson.dumps(params, option=orjson.OPT_SORT_KEYS).decode()}'
+    async with db.connection_cursor() as (conn, cur):
+        # if the same job is already queued or running, it is returned instead of submitting a new job
+        await cur.execute('''
+            INSERT INTO jobs (kind, params, dedupe_key, items_total)
+            VALUES (%s, %s, %s, %s)
+            ON CONFLICT (dedupe_key) WHERE status IN ('queued', 'running') DO NOTHING
+            RETURNING *
+        ''', (kind, Jsonb(params), dedupe_key, JOB_KINDS[kind][2]))
+        row = await cur.fetchone()
+        if row is None:
+            await cur.execute('''
+                SELECT * FROM jobs
+                WHERE dedupe_key = %s AND status IN ('queued', 'running')
+            ''', (dedupe_key,))
+            row = await cur.fetchone()
+            assert row, 'Failed to submit job'
+        await conn.commit()
+        return _job(row)
+
+
+async def get(job_id):
+    async with db.connection_cursor() as (conn, cur):
+        await cur.execute('SELECT * FROM jobs WHERE id = %s', (job_id,))
+        row = await cur.fetchone()
+        return _job(row) if row else None
+
+
+async def list_iterator(status=None, kind=None, limit=100):
+    async with db.connection_cursor() as (conn, cur):
+        await cur.execute('''
+            SELECT * FROM jobs
+            WHERE (%(status)s::text IS NULL OR status = %(status)s) AND (%(kind)s::text IS NULL OR kind = %(kind)s)
+            ORDER BY id DESC
+            LIMIT %(limit)s
+        ''', {'status': status, 'kind': kind, 'limit': limit})
+        async for row in cur:
+            yield _job(row)
+
+
+async def progress_add_total(num_items):
+    job_id = current_job_id.get()
+    if job_id is None or not num_items:
+        return
+    async with db.connection_cursor() as (conn, cur):
+        await cur.execute('UPDATE jobs SET items_total = items_total + %s WHERE id = %s', (num_items, job_id))
+        await conn.commit()
+
+
+async def progress_advance(num_items=1):
+    job_id = current_job_id.get()
+    if job_id is None:
+        return
+    async with db.connection_cursor() as (conn, cur):
+        await cur.execute('UPDATE jobs SET items_done = items_done + %s WHERE id = %s', (num_items, job_id))
+        await conn.commit()
+
+
+async def claim():
+    async with db.connection_cursor() as (conn, cur):
+        # running jobs with an expired lease were lost (e.g. the worker was killed) and are executed again
+        await cur.execute('''
+            UPDATE jobs
+            SET status = 'running', attempts = attempts + 1, started_at = coalesce(started_at, now()),
+                locked_until = now() + make_interval(secs => %s)
+            WHERE id = (
+                SELECT id
+                FROM jobs
+                WHERE status = 'queued' OR (status = 'running' AND locked_until < now())
+                ORDER BY id
+                LIMIT 1
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING *
+        ''', (config.JOBS_LEASE_SECONDS,))
+        row = await cur.fetchone()
+        await conn.commit()
+        return row
+
+
+async def _finish(job_id, status, result=None, error=None):
+    # the new secret key of an access key reset is not stored in the result, it can be fetched once with pop_secret_key
+    secret_key = None
+    if isinstance(result, dict) and 'secret_key' in result:
+        result = {**result}
+        secret_key = result.pop('secret_key')
+    async with db.connection_cursor() as (conn, cur):
+        await cur.execute('''
+            UPDATE jobs
+            SET status = %s, result = %s, error = %s, secret_key = %s, locked_until = NULL, finished_at = now(),
+                items_done = CASE WHEN %s = 'done' THEN greatest(items_done, items_total) ELSE items_done END
+            WHERE id = %s
+        ''', (status, Jsonb(result), error, secret_key, status, job_id))
+        await conn.commit()
+
+
+async def pop_secret_key(job_id):
+    # returns the secret key of a finished job and clears it, None if it was already fetched or expired
+    async with db.connection_cursor() as (conn, cur):
+        await cur.execute('''
+            UPDATE jobs
+            SET secret_key = NULL
+            FROM (
+                SELECT id, secret_key
+                FROM jobs
+                WHERE id = %s AND secret_key IS NOT NULL AND finished_at > now() - make_interval(secs => %s)
+                FOR UPDATE
+            ) AS old
+            WHERE jobs.id = old.id
+            RETURNING old.secret_key
+        ''', (job_id, config.JOBS_SECRET_KEY_TTL_SECONDS))
+        row = await cur.fetchone()
+        await conn.commit()
+        return row['secret_key'] if row else None
+
+
+async def clear_expired_secret_keys():
+    async with db.connection_cursor() as (conn, cur):
+        await cur.execute('''
+            UPDATE jobs
+            SET secret_key = NULL
+            WHERE secret_key IS NOT NULL AND finished_at <= now() - make_interval(secs => %s)
+        ''', (config.JOBS_SECRET_KEY_TTL_SECONDS,))
+        await conn.commit()
+
+
+async def _heartbeat(job_id):
+    # extends the lease while the job is running, long MinIO operations don't report progress
+    while True:
+        await asyncio.sleep(config.JOBS_LEASE_SECONDS / 3)
+        try:
+            async with db.connection_cursor() as (conn, cur):
+                await cur.execute('''
+                    UPDATE jobs SET locked_until = now() + make_interval(secs => %s)
+                    WHERE id = %s AND status = 'running'
+                ''', (config.JOBS_LEASE_SECONDS, job_id))
+                await conn.commit()
+        except Exception:
+            logging.exception(f'Job {job_id} heartbeat failed')
+
+
+async def run(row):
+    if row['attempts'] > config.JOBS_MAX_ATTEMPTS:
+        await _finish(row['id'], 'failed', error=f'Job was interrupted {row["attempts"] - 1} times')
+        return
+    module, function, items_total = JOB_KINDS[row['kind']]
+    if row['attempts'] > 1:
+        # the job is executed again from the start
+        async with db.connection_cursor() as (conn, cur):
+            await cur.execute('UPDATE jobs SET items_done = 0, items_total = %s WHERE id = %s', (items_total, row['id']))
+            await conn.commit()
+    func = getattr(importlib.import_module(f'..{module}.api', __package__), function)
+    token = current_job_id.set(row['id'])
+    minio_api.start_retry_budget()
+    heartbeat = asyncio.create_task(_heartbeat(row['id']))
+    try:
+        result = await func(**row['params'])
+    except Exception as e:
+        logging.exception(f'Job {row["id"]} {row["kind"]} failed')
+        await _finish(row['id'], 'failed', error=f'{type(e).__name__}: {e}')
+    else:
+        await _finish(row['id'], 'done', result=result)
+    finally:
+        heartbeat.cancel()
+        current_job_id.reset(token)
+
+
+async def run_next():
+    row = await claim()
+    if row is None:
+        return False
+    await run(row)
+    return True
+
+
+async def run_pending():
+    num_jobs = 0
+    while await run_next():
+        num_jobs += 1
+    return {'jobs': num_jobs}
+
+
+async def worker_loop():
+    while True:
+        try:
+            if await run_next():
+                continue
+            await clear_expired_secret_keys()
+        except Exception:
+            logging.exception('Jobs worker failed')
+        await asyncio.sleep(config.JOBS_POLL_INTERVAL_SECONDS)
@@ -0,0 +1,62 @@
+import asyncclick as click
+from fastapi import APIRouter
+from fastapi.responses import JSONResponse
+
+from . import api
+from .. import common
+
+
+router = APIRouter()
+
+
+@click.group()
+async def main():
+    pass
+
+
+def accepted(job):
+    # response of an endpoint which submitted a job with ?async=true
+    if common.is_cli():
+        return common.cli_print_json(job)
+    return JSONResponse(status_code=202, content=job)
+
+
+@main.command()
+@click.argument('job_id', type=int)
+@router.get('/jobs/get', tags=['jobs'])
+async def get(job_id: int):
+    job = await api.get(job_id)
+    if job is None:
+        raise Exception('Job not found')
+    return common.cli_print_json(job)
+
+
+@main.command()
+@click.argument('job_id', type=int)
+@router.post('/jobs/pop_secret_key', tags=['jobs'])
+async def pop_secret_key(job_id: int):
+    # the secret key of an instance update job with reset_access_key, returned only once
+    secret_key = await api.pop_secret_key(job_id)
+    if secret_key is None:
+        raise Exception('Secret key not found, it was already fetched or expired')
+    return common.cli_print_json({'job_id': job_id, 'secret_key': secret_key})
+
+
+@main.command(name='list')
+@click.option('--status')
+@click.option('--kind')
+@click.option('--limit', type=int, default=100)
+@router.get('/jobs/list', tags=['jobs'])
+async def list_jobs(status: str | None = None, kind: str | None = None, limit: int = 100):
+    jobs = [job async for job in api.list_iterator(status, kind, limit)]
+    if common.is_cli():
+        common.cli_print_json(jobs)
+        return click.echo(f'Total jobs: {len(jobs)}', err=True)
+    else:
+        return jobs
+
+
+@main.command()
+async def run():
+    # run all queued jobs and exit
+    return common.cli_print_json(await api.run_pending())
@@ -0,0 +1,334 @@
+import time
+import random
+import asyncio
+import logging
+from uuid import uuid4
+
+import orjson
+
+from .. import config, db, common
+from ..instances import api as instances_api
+from ..buckets import api as buckets_api
+from ..credentials import api as credentials_api
+from ..minio import sim_backend
+
+
+# control plane benchmark - runs the instances / buckets / credentials API functions in-process against the configured DB
+# and a simulated MinIO (or a stubbed mc binary), each worker works on its own instances so operations don't conflict,
+# the worker operations return the name of the executed operation (e.g. buckets_update creates a bucket if there are none)
+
+# operation mixes - relative weights of the operations
+MIXES = {
+    'mixed': {
+        'instances_create': 1, 'instances_update': 1, 'instances_delete': 1, 'instances_get': 4,
+        'buckets_create': 4, 'buckets_update': 3, 'buckets_delete': 3, 'buckets_list': 6,
+        'credentials_create': 3, 'credentials_update': 3, 'credentials_delete': 2,
+    },
+    'provisioning': {
+        'instances_create': 2, 'instances_delete': 1, 'buckets_create': 6, 'buckets_delete': 2,
+        'credentials_create': 4, 'credentials_delete': 1,
+    },
+    'updates': {
+        'instances_update': 2, 'buckets_update': 5, 'credentials_update': 5,
+    },
+    'reads': {
+        'instances_get': 1, 'buckets_list': 1,
+    },
+}
+
+ID_PREFIX = 'cmbench'
+
+
+def _new_id():
+    return f'{ID_PREFIX}-{uuid4().hex[:16]}'
+
+
+class Worker:
+
+    def __init__(self, max_instances):
+        self.max_instances = max_instances
+        # instance id: {'blocked': bool, 'buckets': {bucket name: {'public': bool, 'credentials': {access key: permissions}}}}
+        self.instances = {}
+
+    def _random_instance(self, unblocked=False):
+        instance_ids = [i for i, instance in self.instances.items() if not (unblocked and instance['blocked'])]
+        return random.choice(instance_ids) if instance_ids else None
+
+    def _random_bucket(self):
+        buckets = [(i, b) for i, instance in self.instances.items() if not instance['blocked'] for b in instance['buckets']]
+        return random.choice(buckets) if buckets else (None, None)
+
+    def _random_credential(self):
+        credentials = [
+            (i, b, a)
+            for i, instance in self.instances.items() if not instance['blocked']
+            for b, bucket in instance['buckets'].items()
+            for a in bucket['credentials']
+        ]
+        return random.choice(credentials) if credentials else (None, None, None)
+
+    async def instances_create(self):
+        if len(self.instances) >= self.max_instances:
+            return await self.instances_delete()
+        instance_id = _new_id()
+        await instances_api.create(instance_id)
+        self.instances[instance_id] = {'blocked': False, 'buckets': {}}
+        return 'instances_create'
+
+    async def instances_update(self):
+        instance_id = self._random_instance()
+        if instance_id is None:
+            return await self.instances_create()
+        blocked = not self.instances[instance_id]['blocked']
+        await instances_api.update(instance_id, blocked=blocked)
+        self.instances[instance_id]['blocked'] = blocked
+        return 'instances_update'
+
+    async def instances_delete(self):
+        instance_id = self._random_instance()
+        if instance_id is None:
+            return await self.instances_create()
+        await instances_api.delete(instance_id)
+        del self.instances[instance_id]
+        return 'instances_delete'
+
+    async def instances_get(self):
+        instance_id = self._random_instance()
+        if instance_id is None:
+            return await self.instances_create()
+        await instances_api.get(instance_id)
+        return 'instances_get'
+
+    async def buckets_create(self):
+        instance_id = self._random_instance(unblocked=True)
+        if instance_id is None:
+            return await self.instances_create()
+        bucket_name = _new_id()
+        public = random.random() < 0.5
+        await buckets_api.create(instance_id, bucket_name, public=public)
+        self.instances[instance_id]['buckets'][bucket_name] = {'public': public, 'credentials': {}}
+        return 'buckets_create'
+
+    async def buckets_update(self):
+        instance_id, bucket_name = self._random_bucket()
+        if bucket_name is None:
+            return await self.buckets_create()
+        bucket = self.instances[instance_id]['buckets'][bucket_name]
+        await buckets_api.update(instance_id, bucket_name, public=not bucket['public'], blocked=False)
+        bucket['public'] = not bucket['public']
+        return 'buckets_update'
+
+    async def buckets_delete(self):
+        instance_id, bucket_name = self._random_bucket()
+        if bucket_name is None:
+            return await self.buckets_create()
+        await buckets_api.delete(instance_id, bucket_name)
+        del self.instances[instance_id]['buckets'][bucket_name]
+        return 'buckets_delete'
+
+    async def buckets_list(self):
+        instance_id = self._random_instance()
+        if instance_id is None:
+            return await self.instances_create()
+        [bucket async for bucket in buckets_api.list_iterator(instance_id)]
+        return 'buckets_list'
+
+    async def credentials_create(self):
+        instance_id, bucket_name = self._random_bucket()
+        if bucket_name is None:
+            return await self.buckets_create()
+        access_key = (await credentials_api.create(instance_id))['access_key']
+        permissions = (True, random.random() < 0.5, random.random() < 0.2)
+        await buckets_api.credentials_create(instance_id, bucket_name, access_key, *permissions)
+        self.instances[instance_id]['buckets'][bucket_name]['credentials'][access_key] = permissions
+        return 'credentials_create'
+
+    async def credentials_update(self):
+        instance_id, bucket_name, access_key = self._random_credential()
+        if access_key is None:
+            return await self.credentials_create()
+        permissions = (True, random.random() < 0.5, random.random() < 0.2)
+        await buckets_api.credentials_update(instance_id, bucket_name, access_key, *permissions)
+        self.instances[instance_id]['buckets'][bucket_name]['credentials'][access_key] = permissions
+        return 'credentials_update'
+
+    async def credentials_delete(self):
+        instance_id, bucket_name, access_key = self._random_credential()
+        if access_key is None:
+            return await self.credentials_create()
+        await buckets_api.credentials_delete(instance_id, bucket_name, access_key)
+        await credentials_api.delete(access_key)
+        del self.instances[instance_id]['buckets'][bucket_name]['credentials'][access_key]
+        return 'credentials_delete'
+
+    async def cleanup(self):
+        for instance_id in list(self.instances):
+            try:
+                await instances_api.delete(instance_id)
+            except Exception:
+                logging.exception(f'Failed to delete benchmark instance {instance_id}')
+            del self.instances[instance_id]
+
+
+def _percentile(sorted_values, p):
+    # nearest rank percentile
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, max(0, round(p / 100 * len(sorted_values)) - 1))]
+
+
+class Results:
+
+    def __init__(self):
+        # operation name: {'durations': [], 'errors': int, 'minio_calls': int, 'db_connections': int}
+        self.operations = {}
+        self.db_connections_max_in_use = 0
+
+    def add(self, op, duration, error, counters):
+        stats = self.operations.setdefault(op, {'durations': [], 'errors': 0, 'minio_calls': 0, 'db_connections': 0})
+        stats['durations'].append(duration)
+        stats['errors'] += 1 if error else 0
+        stats['minio_calls'] += counters.get('minio_calls', 0)
+        stats['db_connections'] += counters.get('db_connections', 0)
+
+    def summary(self, elapsed_seconds):
+        operations = {}
+        for op, stats in sorted(self.operations.items()):
+            durations = sorted(stats['durations'])
+            num_ops = len(durations)
+            operations[op] = {
+                'count': num_ops,
+                'errors': stats['errors'],
+                'ops_per_second': num_ops / elapsed_seconds,
+                'p50_ms': _percentile(durations, 50) * 1000,
+                'p95_ms': _percentile(durations, 95) * 1000,
+                'p99_ms': _percentile(durations, 99) * 1000,
+                'minio_calls_per_op': stats['minio_calls'] / num_ops,
+                'db_connections_per_op': stats['db_connections'] / num_ops,
+            }
+        durations = sorted(d for stats in self.operations.values() for d in stats['durations'])
+        return {
+            'total': {
+                'count': len(durations),
+                'errors': sum(stats['errors'] for stats in self.operations.values()),
+                'ops_per_second': len(durations) / elapsed_seconds,
+                'p50_ms': _percentile(durations, 50) * 1000 if durations else None,
+                'p95_ms': _percentile(durations, 95) * 1000 if durations else None,
+                'p99_ms': _percentile(durations, 99) * 1000 if durations else None,
+                'minio_calls_per_op': sum(stats['minio_calls'] for stats in self.operations.values()) / len(durations) if durations else None,
+                'db_connections_per_op': sum(stats['db_connections'] for stats in self.operations.values()) / len(durations) if durations else None,
+                'elapsed_seconds': elapsed_seconds,
+                'db_connections_max_in_use': self.db_connections_max_in_use,
+            },
+            'operations': operations,
+        }
+
+
+async def _run_worker(worker, mix, results, deadline, remaining_ops):
+    ops, weights = zip(*mix.items())
+    while time.monotonic() < deadline and remaining_ops[0] != 0:
+        remaining_ops[0] -= 1
+        op = random.choices(ops, weights)[0]
+        counters = {}
+        token = common.operation_counters.set(counters)
+        start = time.perf_counter()
+        error = None
+        try:
+            op = await getattr(worker, op)()
+        except Exception as e:
+            error = e
+            logging.warning(f'Benchmark operation {op} failed: {common.format_error(e)}')
+        finally:
+            common.operation_counters.reset(token)
+        results.add(op, time.perf_counter() - start, error, counters)
+
+
+async def _sample_db_pool(results):
+    while True:
+        if config.DB_POOL_MAX_SIZE > 0:
+            stats = (await db.get_pool()).get_stats()
+            results.db_connections_max_in_use = max(results.db_connections_max_in_use, stats.get('pool_size', 0) - stats.get('pool_available', 0))
+        await asyncio.sleep(0.05)
+
+
+async def run(mix='mixed', concurrency=10, duration_seconds=30.0, num_operations=0, max_instances_per_worker=3, keep=False):
+    mix = MIXES[mix] if isinstance(mix, str) else mix
+    assert mix and all(hasattr(Worker, op) for op in mix), f'Invalid operations mix: {mix}'
+    assert max_instances_per_worker >= 1, 'At least one instance per worker is required'
+    workers = [Worker(max_instances_per_worker) for _ in range(concurrency)]
+    results = Results()
+    sampler = asyncio.create_task(_sample_db_pool(results))
+    # shared count of operations left to run, -1 = run until the duration passes
+    remaining_ops = [num_operations or -1]
+    start = time.monotonic()
+    try:
+        await asyncio.gather(*(
+            _run_worker(worker, mix, results, start + duration_seconds if duration_seconds else float('inf'), remaining_ops)
+            for worker in workers
+        ))
+        elapsed_seconds = time.monotonic() - start
+    finally:
+        sampler.cancel()
+        if not keep:
+            await asyncio.gather(*(worker.cleanup() for worker in workers))
+    return {
+        'config': {
+            'mix': mix,
+            'concurrency': concurrency,
+            'duration_seconds': duration_seconds,
+            'num_operations': num_operations,
+            'minio_api_backend': config.MINIO_API_BACKEND,
+            'minio_sim_latency': config.MINIO_SIM_LATENCY if config.MINIO_API_BACKEND == 'sim' else None,
+            'minio_max_in_flight': config.MINIO_MAX_IN_FLIGHT,
+            'db_pool_max_size': config.DB_POOL_MAX_SIZE,
+        },
+        **results.summary(elapsed_seconds),
+        'minio_sim_calls': dict(sim_backend.get_state().calls) if config.MINIO_API_BACKEND == 'sim' else None,
+    }
+
+
+def compare(results, baseline):
+    # relative change of the main metrics compared to a baseline run, positive ops/s change / negative latency change is better
+    def change(value, baseline_value):
+        if value is None or not baseline_value:
+            return None
+        return (value - baseline_value) / baseline_value
+
+    comparison = {}
+    for op, stats in {'total': results['total'], **results['operations']}.items():
+        baseline_stats = baseline['total'] if op == 'total' else baseline['operations'].get(op)
+        if baseline_stats:
+            comparison[op] = {
+                key: change(stats.get(key), baseline_stats.get(key))
+                for key in ('ops_per_second', 'p50_ms', 'p95_ms', 'p99_ms', 'minio_calls_per_op', 'db_connections_per_op')
+                if key in stats
+            }
+    return comparison
+
+
+def format_results(results, comparison=None):
+    lines = [f'{"operation":<20} {"count":>7} {"errors":>6} {"ops/s":>8} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} {"minio/op":>8} {"db/op":>6}']
+    for op, stats in {**results['operations'], 'total': results['total']}.items():
+        line = (
+            f'{op:<20} {stats["count"]:>7} {stats["errors"]:>6} {stats["ops_per_second"]:>8.1f} '
+            f'{stats["p50_ms"] or 0:>8.1f} {stats["p95_ms"] or 0:>8.1f} {stats["p99_ms"] or 0:>8.1f} '
+            f'{stats["minio_calls_per_op"] or 0:>8.2f} {stats["db_connections_per_op"] or 0:>6.2f}'
+        )
+        if comparison and op in comparison:
+            line += '  ' + ' '.join(
+                f'{key}={value:+.0%}' for key, value in comparison[op].items()
+                if value is not None and key in ('ops_per_second', 'p95_ms')
+            )
+        lines.append(line)
+    lines.append(f'max DB connections in use: {results["total"]["db_connections_max_in_use"]}')
+    return '\n'.join(lines)
+
+
+def load(filename):
+    with open(filename, 'rb') as f:
+        return orjson.loads(f.read())
+
+
+def save(results, filename):
+    with open(filename, 'wb') as f:
+        f.write(orjson.dumps(results, option=orjson.OPT_INDENT_2))
@@ -0,0 +1,115 @@
+import sys
+import random
+from array import array
+from bisect import bisect_left, bisect_right, insort
+
+
+class Catalog:
+    # compact catalog of names (files / buckets) ordered by their timestamp, supports sampling a random name older than
+    # a TTL without building lists: the names older than the TTL are a prefix of the arrays found with a binary search.
+    # deleted entries are kept as tombstones (None name) and compacted when they are more than half of the entries,
+    # sampling picks live entries by their rank so it doesn't depend on where the tombstones are.
+    # values are stored in an int64 array (e.g. content length) or in a list if value_typecode is None (e.g. bucket dicts)
+
+    def __init__(self, value_typecode='q'):
+        self.names = []
+        self.timestamps = array('q')
+        self.values = array(value_typecode) if value_typecode else []
+        # name: position in the arrays
+        self.positions = {}
+        # sorted positions of the tombstones
+        self.deleted_positions = array('q')
+
+    @classmethod
+    def from_items(cls, items, value_typecode='q'):
+        # items: iterable of (name, value, timestamp) in any order
+        catalog = cls(value_typecode)
+        for name, value, ts in sorted(items, key=lambda item: item[2]):
+            catalog._append(name, value, ts)
+        return catalog
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __contains__(self, name):
+        return name in self.positions
+
+    def _append(self, name, value, ts):
+        name = sys.intern(name)
+        self.positions[name] = len(self.names)
+        self.names.append(name)
+        self.timestamps.append(int(ts))
+        self.values.append(value)
+
+    def add(self, name, value, ts):
+        if name in self.positions:
+            self.delete(name)
+        ts = int(ts)
+        if not self.timestamps or ts >= self.timestamps[-1]:
+            self._append(name, value, ts)
+        else:
+            # out of order timestamps are rare and close to the end (new entries use the current time),
+            # insert keeping the order and shift the positions of the following entries
+            pos = bisect_right(self.timestamps, ts)
+            name = sys.intern(name)
+            self.names.insert(pos, name)
+            self.timestamps.insert(pos, ts)
+            self.values.insert(pos, value)
+            for i in range(pos + 1, len(self.names)):
+                if self.names[i] is not None:
+                    self.positions[self.names[i]] = i
+            self.positions[name] = pos
+            for i in range(bisect_left(self.deleted_positions, pos), len(self.deleted_positions)):
+                self.deleted_positions[i] += 1
+
+    def delete(self, name):
+        pos = self.positions.pop(name, None)
+        if pos is not None:
+            self.names[pos] = None
+            insort(self.deleted_positions, pos)
+            if len(self.deleted_positions) * 2 > len(self.names):
+                self._rebuild(list(self.items()))
+
+    def _rebuild(self, items):
+        catalog = Catalog.from_items(items, self.values.typecode if isinstance(self.values, array) else None)
+        self.names, self.timestamps, self.values, self.positions = catalog.names, catalog.timestamps, catalog.values, catalog.positions
+        self.deleted_positions = array('q')
+
+    def get(self, name):
+        # returns (value, timestamp) or None
+        pos = self.positions.get(name)
+        return None if pos is None else (self.values[pos], self.timestamps[pos])
+
+    def items(self):
+        for name, value, ts in zip(self.names, self.values, self.timestamps):
+            if name is not None:
+                yield name, value, ts
+
+    def _older_than_end(self, ttl_seconds, now):
+        # entries before this position were added more than ttl_seconds before now
+        return bisect_left(self.timestamps, now - ttl_seconds) if ttl_seconds else len(self.names)
+
+    def get_names(self, ttl_seconds, now):
+        return [name for name in self.names[:self._older_than_end(ttl_seconds, now)] if name is not None]
+
+    def count(self, ttl_seconds, now):
+        # number of entries older than the TTL
+        end = self._older_than_end(ttl_seconds, now)
+        return end - bisect_left(self.deleted_positions, end)
+
+    def _live_position(self, rank):
+        # position of the live entry with the given rank (0 = first live entry), binary search over the number of
+        # live entries up to each position
+        lo, hi = 0, len(self.names) - 1
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if mid + 1 - bisect_right(self.deleted_positions, mid) > rank:
+                hi = mid
+            else:
+                lo = mid + 1
+        return lo
+
+    def sample(self, ttl_seconds, now, k=1):
+        # returns up to k distinct random names older than the TTL
+        count = self.count(ttl_seconds, now)
+        return [self.names[self._live_position(rank)] for rank in random.sample(range(count), min(k, count))]
@@ -16,7 +16,7 @@ def is_valid_id_for_cleanup(txt):
     if len(parts) != 6:
         return False
     valid_prefix = False
-    for prefix in ['cmalti', 'cmaltbpriv', 'cmaltbpub']:
+    for prefix in ['cmalti', 'cmalticp', 'cmaltbpriv', 'cmaltbpub']:
         if parts[0] == prefix:
             valid_prefix = True
             break
@@ -27,7 +27,7 @@ def is_valid_id_for_cleanup(txt):
 
 async def main():
     for instance_id in requests.get(f'https://{CWM_MINIO_API_HOST}/instances/list', auth=(CWM_MINIO_API_USERNAME, CWM_MINIO_API_PASSWORD)).json():
-        if instance_id.startswith('cmalti-') and is_valid_id_for_cleanup(instance_id):
+        if instance_id.startswith(('cmalti-', 'cmalticp-')) and is_valid_id_for_cleanup(instance_id):
             print(instance_id)
             for bucket_name in requests.get(f'https://{CWM_MINIO_API_HOST}/buckets/list?instance_id={instance_id}', auth=(CWM_MINIO_API_USERNAME, CWM_MINIO_API_PASSWORD)).json():
                 if (bucket_name.startswith('cmaltbpriv-') or bucket_name.startswith('cmaltbpub-')) and is_valid_id_for_cleanup(bucket_name):
@@ -57,7 +57,7 @@ async def main():
             await minio_api.mc_check_call('admin', 'policy', 'remove', MINIO_MC_PROFILE, policy_name)
     subprocess.check_call([
         'kubectl', 'exec', '-n', 'minio-tenant-main', 'cwm-1', '-c', 'postgres', '--', 'psql', '-c', dedent('''
-            DELETE FROM buckets where instance_id like 'cmalti-%' and name like 'cmaltbp%';
-            DELETE FROM instances where id like 'cmalti-%';
+            DELETE FROM buckets where (instance_id like 'cmalti-%' or instance_id like 'cmalticp-%') and name like 'cmaltbp%';
+            DELETE FROM instances where id like 'cmalti-%' or id like 'cmalticp-%';
         ''')
     ], env={**os.environ, 'KUBECONFIG': os.getenv('KUBECONFIG')})
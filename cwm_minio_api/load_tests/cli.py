@@ -1,4 +1,5 @@
 import asyncclick as click
+import orjson
 
 
 @click.group()
@@ -17,3 +18,65 @@ async def cleanup():
 async def export_shared_state(filename):
     from .shared_state import SharedState
     SharedState.get_singleton().export(filename)
+
+
+@main.command()
+@click.option('--mix', default='mixed', help='Operations mix: one of mixed, provisioning, updates, reads or JSON of {"<operation>": weight}')
+@click.option('--concurrency', default=10, help='Number of concurrent workers')
+@click.option('--duration', default=30.0, help='Seconds to run (0 = until --operations are done)')
+@click.option('--operations', default=0, help='Total number of operations to run (0 = until --duration passes)')
+@click.option('--max-instances-per-worker', default=3)
+@click.option('--minio-backend', default='sim', type=click.Choice(['sim', 'mc']), help='sim - in-memory MinIO (see MINIO_SIM_* config), mc - run MINIO_MC_BINARY')
+@click.option('--mc-binary', default='true', help='mc binary to run with --minio-backend mc, by default a no-op stub')
+@click.option('--output', help='Write JSON results to this file')
+@click.option('--baseline', help='Compare with JSON results of a previous run')
+@click.option('--keep', is_flag=True, help='Keep the created instances')
+async def benchmark(mix, concurrency, duration, operations, max_instances_per_worker, minio_backend, mc_binary, output, baseline, keep):
+    # control plane benchmark against the configured DB (DB_CONNSTRING) and a simulated / stubbed MinIO
+    from .. import config
+    from . import benchmark
+    config.MINIO_API_BACKEND = minio_backend
+    if minio_backend == 'mc':
+        config.MINIO_MC_BINARY = mc_binary
+    results = await benchmark.run(
+        mix=orjson.loads(mix) if mix.startswith('{') else mix, concurrency=concurrency, duration_seconds=duration,
+        num_operations=operations, max_instances_per_worker=max_instances_per_worker, keep=keep,
+    )
+    comparison = None
+    if baseline:
+        comparison = results['comparison'] = benchmark.compare(results, benchmark.load(baseline))
+    click.echo(benchmark.format_results(results, comparison))
+    if output:
+        benchmark.save(results, output)
+
+
+@main.command()
+@click.option('--keep-old-keys', is_flag=True)
+async def migrate_shared_state(keep_old_keys):
+    # migrates the shared state in Redis from the previous set / key per item layout to the hashes layout
+    from .shared_state import SharedState
+    num_instances, num_buckets, num_files = SharedState.get_singleton().migrate_from_sets(delete_old_keys=not keep_old_keys)
+    click.echo(f'Migrated {num_instances} instances, {num_buckets} buckets and {num_files} files')
+
+
+@main.command()
+@click.option('--num-files', default='1000,10000,100000', help='Comma separated numbers of files to benchmark')
+@click.option('--files-per-bucket', default=100)
+@click.option('--buckets-per-instance', default=10)
+async def benchmark_shared_state(num_files, files_per_bucket, buckets_per_instance):
+    # shared state refresh time from Redis against the number of files
+    from . import shared_state_benchmark
+    for result in shared_state_benchmark.run([int(n) for n in num_files.split(',')], files_per_bucket, buckets_per_instance):
+        click.echo(f'{result["num_files"]:>8} files {result["num_buckets"]:>6} buckets {result["num_instances"]:>5} instances: {result["refresh_seconds"]:.3f}s')
+
+
+@main.command()
+@click.option('--content-lengths', default='5,1024,1048576', help='Comma separated upload content lengths')
+@click.option('--requests', 'num_requests', default=1000, help='Number of requests per content length and method')
+async def benchmark_signing(content_lengths, num_requests):
+    # load generator CPU time per signed upload request with and without the payload and signing key caches
+    from . import signing_benchmark
+    for result in signing_benchmark.run([int(n) for n in content_lengths.split(',')], num_requests):
+        click.echo(' '.join([f'{result["content_length"]:>8} bytes:', *(
+            f'{name} {result[f"{name}_us_per_request"]:.1f}us' for name in signing_benchmark.METHODS
+        )]))
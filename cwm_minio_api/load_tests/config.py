@@ -46,6 +46,19 @@ CWM_UPDOWNDEL_CONTENT_LENGTH_VALUES = os.getenv("CWM_UPDOWNDEL_CONTENT_LENGTH_VA
 CWM_UPDOWNDEL_CONTENT_LENGTH_VALUES = [int(x.strip()) for x in CWM_UPDOWNDEL_CONTENT_LENGTH_VALUES.split(",") if x.strip()]
 CWM_UPDOWNDEL_CONTENT_LENGTH_WEIGHTS = os.getenv("CWM_UPDOWNDEL_CONTENT_LENGTH_WEIGHTS", "100,10,1")
 CWM_UPDOWNDEL_CONTENT_LENGTH_WEIGHTS = [int(x.strip()) for x in CWM_UPDOWNDEL_CONTENT_LENGTH_WEIGHTS.split(",") if x.strip()]
+# uploads of at least this content length are signed with UNSIGNED-PAYLOAD instead of the body hash (0 = disabled)
+CWM_UPDOWNDEL_UNSIGNED_PAYLOAD_MIN_CONTENT_LENGTH = int(os.getenv("CWM_UPDOWNDEL_UNSIGNED_PAYLOAD_MIN_CONTENT_LENGTH", "0"))
+# multipart uploads, the parts are uploaded concurrently from a shared buffer of the part size
+CWM_UPDOWNDEL_MULTIPART_WEIGHT = int(os.getenv("CWM_UPDOWNDEL_MULTIPART_WEIGHT", "0"))
+CWM_UPDOWNDEL_MULTIPART_CONTENT_LENGTH_VALUES = os.getenv("CWM_UPDOWNDEL_MULTIPART_CONTENT_LENGTH_VALUES", "16777216,104857600")
+CWM_UPDOWNDEL_MULTIPART_CONTENT_LENGTH_VALUES = [int(x.strip()) for x in CWM_UPDOWNDEL_MULTIPART_CONTENT_LENGTH_VALUES.split(",") if x.strip()]
+CWM_UPDOWNDEL_MULTIPART_CONTENT_LENGTH_WEIGHTS = os.getenv("CWM_UPDOWNDEL_MULTIPART_CONTENT_LENGTH_WEIGHTS", "10,1")
+CWM_UPDOWNDEL_MULTIPART_CONTENT_LENGTH_WEIGHTS = [int(x.strip()) for x in CWM_UPDOWNDEL_MULTIPART_CONTENT_LENGTH_WEIGHTS.split(",") if x.strip()]
+# minimum part size is 5 MiB (except the last part)
+CWM_UPDOWNDEL_MULTIPART_PART_SIZE = int(os.getenv("CWM_UPDOWNDEL_MULTIPART_PART_SIZE", str(5 * 1024 * 1024)))
+CWM_UPDOWNDEL_MULTIPART_CONCURRENCY = int(os.getenv("CWM_UPDOWNDEL_MULTIPART_CONCURRENCY", "4"))
+# percent of multipart uploads which are aborted after uploading some of the parts
+CWM_UPDOWNDEL_MULTIPART_ABORT_PERCENT = int(os.getenv("CWM_UPDOWNDEL_MULTIPART_ABORT_PERCENT", "5"))
 CWM_UPDOWNDEL_MAX_FILES_PER_BUCKET = int(os.getenv("CWM_UPDOWNDEL_MAX_FILES_PER_BUCKET", "10"))
 CWM_UPDOWNDEL_MIN_FILES_PER_BUCKET = int(os.getenv("CWM_UPDOWNDEL_MIN_FILES_PER_BUCKET", "5"))
 CWM_UPDOWNDEL_CONCURRENCY = int(os.getenv("CWM_UPDOWNDEL_CONCURRENCY", "10"))
@@ -60,8 +73,28 @@ CWM_GETGETTER_USER_WEIGHT = int(os.getenv("CWM_GETGETTER_USER_WEIGHT", "1"))
 CWM_GETGETTER_FIXED_COUNT = int(os.getenv("CWM_GETGETTER_FIXED_COUNT", "0"))
 CWM_GETGETTER_CONCURRENCY = int(os.getenv("CWM_GETGETTER_CONCURRENCY", "10"))
 
+# control plane user - each user creates an instance and runs API operations on its buckets and credentials
+CWM_CONTROLPLANE_ENABLED = os.getenv("CWM_CONTROLPLANE_ENABLED", "no").lower() == "yes"
+CWM_CONTROLPLANE_USER_WEIGHT = int(os.getenv("CWM_CONTROLPLANE_USER_WEIGHT", "1"))
+CWM_CONTROLPLANE_FIXED_COUNT = int(os.getenv("CWM_CONTROLPLANE_FIXED_COUNT", "0"))
+CWM_CONTROLPLANE_CONCURRENCY = int(os.getenv("CWM_CONTROLPLANE_CONCURRENCY", "10"))
+CWM_CONTROLPLANE_CREATE_BUCKET_WEIGHT = int(os.getenv("CWM_CONTROLPLANE_CREATE_BUCKET_WEIGHT", "2"))
+CWM_CONTROLPLANE_DELETE_BUCKET_WEIGHT = int(os.getenv("CWM_CONTROLPLANE_DELETE_BUCKET_WEIGHT", "1"))
+CWM_CONTROLPLANE_UPDATE_BUCKET_WEIGHT = int(os.getenv("CWM_CONTROLPLANE_UPDATE_BUCKET_WEIGHT", "2"))
+CWM_CONTROLPLANE_BLOCK_BUCKET_WEIGHT = int(os.getenv("CWM_CONTROLPLANE_BLOCK_BUCKET_WEIGHT", "2"))
+CWM_CONTROLPLANE_RESET_ACCESS_KEY_WEIGHT = int(os.getenv("CWM_CONTROLPLANE_RESET_ACCESS_KEY_WEIGHT", "1"))
+CWM_CONTROLPLANE_BIND_CREDENTIALS_WEIGHT = int(os.getenv("CWM_CONTROLPLANE_BIND_CREDENTIALS_WEIGHT", "2"))
+CWM_CONTROLPLANE_UNBIND_CREDENTIALS_WEIGHT = int(os.getenv("CWM_CONTROLPLANE_UNBIND_CREDENTIALS_WEIGHT", "2"))
+CWM_CONTROLPLANE_LIST_WEIGHT = int(os.getenv("CWM_CONTROLPLANE_LIST_WEIGHT", "4"))
+CWM_CONTROLPLANE_LIST_WITH_SIZE_WEIGHT = int(os.getenv("CWM_CONTROLPLANE_LIST_WITH_SIZE_WEIGHT", "1"))
+# bucket create deletes a bucket instead when the instance has this many buckets, same for credentials bind
+CWM_CONTROLPLANE_MAX_BUCKETS = int(os.getenv("CWM_CONTROLPLANE_MAX_BUCKETS", "5"))
+CWM_CONTROLPLANE_MAX_CREDENTIALS = int(os.getenv("CWM_CONTROLPLANE_MAX_CREDENTIALS", "5"))
+
 SHARED_STATE_REDIS_HOST = os.getenv("SHARED_STATE_REDIS_HOST", "localhost")
 SHARED_STATE_REDIS_PORT = int(os.getenv("SHARED_STATE_REDIS_PORT", "6379"))
+# interval of reporting the shared state snapshot age as a locust stat when refreshed in the background
+SHARED_STATE_SNAPSHOT_AGE_STAT_INTERVAL_SECONDS = int(os.getenv("SHARED_STATE_SNAPSHOT_AGE_STAT_INTERVAL_SECONDS", "10"))
 
 AWS_ACCESS_KEY_ID = os.getenv("AWS_ACCESS_KEY_ID")
 AWS_SECRET_ACCESS_KEY = os.getenv("AWS_SECRET_ACCESS_KEY")
@@ -0,0 +1,7 @@
+# custom locust stats which are not requests (e.g. load test internals or throughput), they are logged on their own stats
+# entry instead of firing events.request: the entry is shown in the stats table and reported to the master with the
+# other entries, but it's not counted in the Aggregated row
+
+
+def log_stat(environment, stat_type, name, value):
+    environment.stats.get(name, stat_type).log(value, 0)
@@ -9,11 +9,21 @@ from locust.runners import MasterRunner, LocalRunner
 
 from cwm_minio_api.load_tests.users.getgetter import GetGetter
 from cwm_minio_api.load_tests.users.updowndel import UpDownDel
+from cwm_minio_api.load_tests.users.controlplane import ControlPlane
 from cwm_minio_api.load_tests.users.base import teardown_instance
 from cwm_minio_api.load_tests import config
 from cwm_minio_api.load_tests.shared_state import SharedState
 
 
+@events.init.add_listener
+def on_locust_init(environment, **kwargs):
+    shared_state = SharedState.get_singleton()
+    shared_state.stats_environment = environment
+    if not isinstance(environment.runner, MasterRunner):
+        # the users read the shared state snapshot which is refreshed in the background
+        shared_state.start_background_refresh()
+
+
 @events.test_start.add_listener
 def on_test_start(environment, **kwargs):
     # logging.info("on_test_start")
@@ -73,6 +83,8 @@ class CwmLoadTestShape(LoadTestShape):
             user_classes.add(GetGetter)
         if config.CWM_UPDOWNDEL_ENABLED:
             user_classes.add(UpDownDel)
+        if config.CWM_CONTROLPLANE_ENABLED:
+            user_classes.add(ControlPlane)
         if config.CWM_UPDOWNDEL_ENABLED and config.CWM_UPDOWNDEL_SEPARATE_FROM_OTHER_USERS:
             if not state['updowndel_separate_initialized']:
                 assert UpDownDel in user_classes and len(user_classes) > 1 and UpDownDel.fixed_count > 0
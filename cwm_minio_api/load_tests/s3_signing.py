@@ -0,0 +1,68 @@
+import hmac
+import time
+import hashlib
+from functools import lru_cache
+from urllib.parse import urlsplit, quote
+
+
+# S3 SigV4 signing for the load tests users, produces the same headers as botocore SigV4Auth
+# without building an AWSRequest and deriving the signing key for each request
+
+EMPTY_PAYLOAD_HASH = hashlib.sha256(b'').hexdigest()
+UNSIGNED_PAYLOAD = 'UNSIGNED-PAYLOAD'
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+@lru_cache(maxsize=None)
+def get_payload(content_length):
+    # shared immutable upload body and its sha256 hex digest for each content length
+    body = b'a' * content_length
+    return body, hashlib.sha256(body).hexdigest()
+
+
+@lru_cache(maxsize=4096)
+def get_signing_key(secret_key, date, region_name, service_name='s3'):
+    key = hmac.digest(f'AWS4{secret_key}'.encode(), date.encode(), 'sha256')
+    for msg in (region_name, service_name, 'aws4_request'):
+        key = hmac.digest(key, msg.encode(), 'sha256')
+    return key
+
+
+def get_host(parts):
+    host = parts.hostname
+    if parts.port is not None and parts.port != DEFAULT_PORTS.get(parts.scheme):
+        host = f'{host}:{parts.port}'
+    return host
+
+
+def get_canonical_query_string(query):
+    if not query:
+        return ''
+    return '&'.join(f'{key}={value}' for key, _, value in sorted(pair.partition('=') for pair in query.split('&')))
+
+
+def sign(method, url, access_key, secret_key, region_name, payload_hash=EMPTY_PAYLOAD_HASH, headers=None, timestamp=None):
+    # returns the request headers including the x-amz-date and authorization headers
+    parts = urlsplit(url)
+    timestamp = timestamp or time.strftime('%Y%m%dT%H%M%SZ', time.gmtime())
+    date = timestamp[:8]
+    headers = {**(headers or {}), 'x-amz-content-sha256': payload_hash, 'X-Amz-Date': timestamp}
+    headers_to_sign = {name.lower(): ' '.join(value.split()) for name, value in headers.items()}
+    headers_to_sign.setdefault('host', get_host(parts))
+    signed_header_names = sorted(headers_to_sign)
+    signed_headers = ';'.join(signed_header_names)
+    canonical_request = '\n'.join([
+        method.upper(),
+        quote(parts.path or '/', safe='/~'),
+        get_canonical_query_string(parts.query),
+        ''.join(f'{name}:{headers_to_sign[name]}\n' for name in signed_header_names),
+        signed_headers,
+        payload_hash,
+    ])
+    credential_scope = f'{date}/{region_name}/s3/aws4_request'
+    string_to_sign = '\n'.join([
+        'AWS4-HMAC-SHA256', timestamp, credential_scope, hashlib.sha256(canonical_request.encode()).hexdigest(),
+    ])
+    signature = hmac.new(get_signing_key(secret_key, date, region_name), string_to_sign.encode(), 'sha256').hexdigest()
+    headers['Authorization'] = f'AWS4-HMAC-SHA256 Credential={access_key}/{credential_scope}, SignedHeaders={signed_headers}, Signature={signature}'
+    return headers
@@ -4,10 +4,12 @@ import time
 import logging
 import subprocess
 
+import gevent
 from redis import Redis
 import requests
 
-from . import config
+from . import config, custom_stats
+from .catalog import Catalog
 from ..config import MINIO_MC_PROFILE, MINIO_MC_BINARY
 
 
@@ -23,11 +25,18 @@ class SharedState:
         self.debug_enabled = config.CWM_LOAD_TESTS_DEBUG
         self.key_prefix = 'cwm-minio-api:load-tests'
         self.instances = {}
+        # instance id: {'public' / 'private': catalog of bucket name: bucket dict}
         self.instance_buckets = {}
+        # instance id: {bucket name: catalog of filename: content length}
         self.instance_bucket_files = {}
         self.last_redis_update_ts = None
         self.updating_from_redis = False
         self.disable_update_from_redis = False
+        self.refresh_greenlet = None
+        # local changes made while a refresh is running, applied to the new snapshot before it's swapped in
+        self.pending_changes = None
+        # locust environment, used to report the refresh duration and snapshot age as custom stats
+        self.stats_environment = None
         self.tenant_info = None
         self.init_from_json_file = None
         if config.CWM_INIT_FROM_JSON_FILE and not config.CWM_INIT_FROM_JSON_FILE_ONLY_INSTANCE_BUCKETS:
@@ -55,8 +64,20 @@ class SharedState:
         with open(filename, 'w') as f:
             json.dump({
                 'instances': self.instances,
-                'instance_buckets': self.instance_buckets,
-                'instance_bucket_files': self.instance_bucket_files,
+                'instance_buckets': {
+                    instance_id: {
+                        suffix: {bucket_name: bucket for bucket_name, bucket, _ in catalog.items()}
+                        for suffix, catalog in buckets.items()
+                    }
+                    for instance_id, buckets in self.instance_buckets.items()
+                },
+                'instance_bucket_files': {
+                    instance_id: {
+                        bucket_name: {filename: [content_length, ts] for filename, content_length, ts in catalog.items()}
+                        for bucket_name, catalog in bucket_files.items()
+                    }
+                    for instance_id, bucket_files in self.instance_bucket_files.items()
+                },
                 'tenant_info': requests.get(f'https://{config.CWM_MINIO_API_HOST}/tenant/info', auth=(config.CWM_MINIO_API_USERNAME, config.CWM_MINIO_API_PASSWORD),).json()
             }, f)
 
@@ -97,14 +118,14 @@ class SharedState:
             num_instances += 1
             self.add_instance(instance_id, *instance)
             for suffix, buckets in self.instance_buckets.get(instance_id, {}).items():
-                for bucket_name, bucket in buckets.items():
+                for bucket_name, bucket, _ in list(buckets.items()):
                     num_buckets += 1
                     self.upsert_bucket(instance_id, bucket_name, bucket)
                     for line in subprocess.check_output([
                         MINIO_MC_BINARY, "ls", f'{MINIO_MC_PROFILE}/{bucket_name}/', '--json', '--no-color'
                     ]).splitlines():
                         line = json.loads(line)
-                        if int(line['size']) in config.CWM_UPDOWNDEL_CONTENT_LENGTH_VALUES:
+                        if int(line['size']) in [*config.CWM_UPDOWNDEL_CONTENT_LENGTH_VALUES, *config.CWM_UPDOWNDEL_MULTIPART_CONTENT_LENGTH_VALUES]:
                             num_files += 1
                             self.add_file(instance_id, bucket_name, line['key'], line['size'])
         self.debug(f'Initialization from JSON file complete, added {num_instances} instances, {num_buckets} buckets and {num_files} files to shared state.')
@@ -113,8 +134,20 @@ class SharedState:
         with open(filename, 'r') as f:
             data = json.load(f)
             self.instances = data.get('instances', {})
-            self.instance_buckets = data.get('instance_buckets', {})
-            self.instance_bucket_files = data.get('instance_bucket_files', {})
+            self.instance_buckets = {
+                instance_id: {
+                    suffix: Catalog.from_items(((bucket_name, bucket, bucket['__ts']) for bucket_name, bucket in buckets.items()), None)
+                    for suffix, buckets in suffix_buckets.items()
+                }
+                for instance_id, suffix_buckets in data.get('instance_buckets', {}).items()
+            }
+            self.instance_bucket_files = {
+                instance_id: {
+                    bucket_name: Catalog.from_items((filename, int(content_length), int(ts)) for filename, (content_length, ts) in files.items())
+                    for bucket_name, files in bucket_files.items()
+                }
+                for instance_id, bucket_files in data.get('instance_bucket_files', {}).items()
+            }
             self.tenant_info = data.get('tenant_info')
 
     def update_from_redis(self):
@@ -126,99 +159,240 @@ class SharedState:
                 should_update = False
                 self.disable_update_from_redis = True
                 self.update_from_file(self.init_from_json_file)
+            elif self.refresh_greenlet:
+                # refreshed by the background greenlet
+                should_update = False
             else:
-                ttl_seconds = 5 if len(self.instances) < 1 else random.randint(240,360)
+                ttl_seconds = self.get_refresh_interval_seconds()
                 should_update = not self.updating_from_redis and (self.last_redis_update_ts is None or self.seconds_since(self.last_redis_update_ts) > ttl_seconds)
             if should_update:
-                self.updating_from_redis = True
+                self.refresh_from_redis()
+
+    def get_refresh_interval_seconds(self):
+        return 5 if len(self.instances) < 1 else random.randint(240,360)
+
+    def start_background_refresh(self):
+        # user tasks read the current snapshot and never wait for Redis, only for the default mode of operation
+        if not self.refresh_greenlet and not config.CWM_INIT_FROM_REDIS and not self.init_from_json_file:
+            self.refresh_greenlet = gevent.spawn(self.background_refresh_loop)
+
+    def background_refresh_loop(self):
+        next_refresh_time = 0
+        while True:
+            if time.time() >= next_refresh_time:
                 try:
-                    self.debug('Updating shared state from Redis...')
-                    instance_ids = list(self.redis.smembers(f'{self.key_prefix}:instances'))
-                    self.debug(f'Found {len(instance_ids)} instances in Redis')
-                    for instance_id in instance_ids:
-                        instance_id = instance_id.decode('utf-8')
-                        access, secret, ts = self.redis.get(f'{self.key_prefix}:instances:{instance_id}').decode('utf-8').split(':')
-                        self.instances[instance_id] = access, secret, ts
-                        for suffix in ['public', 'private']:
-                            buckets_key = f'{self.key_prefix}:instances:{instance_id}:buckets:{suffix}'
-                            bucket_names = list(self.redis.smembers(buckets_key))
-                            self.debug(f'Found {len(bucket_names)} {suffix} buckets for instance {instance_id} in Redis')
-                            for bucket_name in bucket_names:
-                                bucket_name = bucket_name.decode('utf-8')
-                                bucket_data = self.redis.get(f'{buckets_key}:{bucket_name}')
-                                if bucket_data:
-                                    bucket = json.loads(bucket_data)
-                                    self.instance_buckets.setdefault(instance_id, {}).setdefault(suffix, {})[bucket_name] = bucket
-                                    files_key = f'{self.key_prefix}:instances:{instance_id}:buckets:{bucket_name}:files'
-                                    filenames = list(self.redis.smembers(files_key))
-                                    self.debug(f'Found {len(filenames)} files for bucket {bucket_name} of instance {instance_id} in Redis')
-                                    for filename in filenames:
-                                        filename = filename.decode('utf-8')
-                                        file_data = self.redis.get(f'{files_key}:{filename}')
-                                        if file_data:
-                                            content_length, ts = file_data.decode('utf-8').split(':')
-                                            self.instance_bucket_files.setdefault(instance_id, {}).setdefault(bucket_name, {})[filename] = content_length, ts
-                    self.last_redis_update_ts = self.get_timestamp()
-                    self.debug(f'shared state update from Redis complete, last_redis_update_ts={self.last_redis_update_ts}')
-                finally:
-                    self.updating_from_redis = False
+                    self.refresh_from_redis()
+                except Exception:
+                    logging.exception('Failed to refresh shared state from Redis')
+                next_refresh_time = time.time() + self.get_refresh_interval_seconds()
+            if self.last_redis_update_ts is not None:
+                self.fire_stat('snapshot_age', (time.time() - self.last_redis_update_ts) * 1000)
+            gevent.sleep(min(config.SHARED_STATE_SNAPSHOT_AGE_STAT_INTERVAL_SECONDS, max(0, next_refresh_time - time.time())))
+
+    def fire_stat(self, name, milliseconds):
+        if self.stats_environment:
+            custom_stats.log_stat(self.stats_environment, 'shared_state', name, milliseconds)
+
+    def refresh_from_redis(self):
+        # builds a new snapshot from Redis and swaps it in, so readers never see a partially updated state
+        self.updating_from_redis = True
+        self.pending_changes = []
+        start_time = time.perf_counter()
+        try:
+            instances, instance_buckets, instance_bucket_files = self.read_snapshot_from_redis()
+            for change in self.pending_changes:
+                self.apply_change(instances, instance_buckets, instance_bucket_files, *change)
+            self.instances, self.instance_buckets, self.instance_bucket_files = instances, instance_buckets, instance_bucket_files
+        finally:
+            self.pending_changes = None
+            self.updating_from_redis = False
+        self.last_redis_update_ts = self.get_timestamp()
+        self.fire_stat('refresh', (time.perf_counter() - start_time) * 1000)
+        self.debug(f'shared state update from Redis complete, last_redis_update_ts={self.last_redis_update_ts}')
+
+    def read_snapshot_from_redis(self):
+        # reads the whole state in 3 round trips regardless of its size:
+        # instances hash, pipelined buckets hash of each instance, pipelined files hash of each bucket
+        self.debug('Updating shared state from Redis...')
+        instances, instance_buckets, instance_bucket_files = {}, {}, {}
+        instance_datas = self.redis.hgetall(self.instances_key)
+        self.debug(f'Found {len(instance_datas)} instances in Redis')
+        instance_ids = []
+        for instance_id, instance_data in instance_datas.items():
+            instance_id = instance_id.decode('utf-8')
+            access, secret, ts = instance_data.decode('utf-8').split(':')
+            instances[instance_id] = access, secret, ts
+            instance_ids.append(instance_id)
+        pipe = self.redis.pipeline(transaction=False)
+        for instance_id in instance_ids:
+            pipe.hgetall(self.get_buckets_key(instance_id))
+        bucket_ids = []
+        for instance_id, buckets in zip(instance_ids, pipe.execute()):
+            self.debug(f'Found {len(buckets)} buckets for instance {instance_id} in Redis')
+            suffix_items = {'public': [], 'private': []}
+            for bucket_name, bucket_data in buckets.items():
+                bucket_name = bucket_name.decode('utf-8')
+                bucket = json.loads(bucket_data)
+                suffix_items['public' if bucket['public'] else 'private'].append((bucket_name, bucket, bucket['__ts']))
+                bucket_ids.append((instance_id, bucket_name))
+            instance_buckets[instance_id] = {suffix: Catalog.from_items(items, None) for suffix, items in suffix_items.items()}
+        pipe = self.redis.pipeline(transaction=False)
+        for instance_id, bucket_name in bucket_ids:
+            pipe.hgetall(self.get_files_key(instance_id, bucket_name))
+        num_files = 0
+        for (instance_id, bucket_name), files in zip(bucket_ids, pipe.execute()):
+            items = []
+            for filename, file_data in files.items():
+                content_length, ts = file_data.split(b':')
+                items.append((filename.decode('utf-8'), int(content_length), int(ts)))
+            instance_bucket_files.setdefault(instance_id, {})[bucket_name] = Catalog.from_items(items)
+            num_files += len(files)
+        self.debug(f'Found {len(bucket_ids)} buckets and {num_files} files in Redis')
+        return instances, instance_buckets, instance_bucket_files
+
+    @staticmethod
+    def apply_change(instances, instance_buckets, instance_bucket_files, op, instance_id, *args):
+        if op == 'add_instance':
+            instances[instance_id] = args
+        elif op == 'delete_instance':
+            instances.pop(instance_id, None)
+        elif op == 'upsert_bucket':
+            bucket_name, bucket = args
+            key_suffix = 'public' if bucket["public"] else 'private'
+            instance_buckets.setdefault(instance_id, {}).setdefault(key_suffix, Catalog(None)).add(bucket_name, bucket, bucket['__ts'])
+        elif op == 'delete_bucket':
+            bucket_name, = args
+            for catalog in instance_buckets.get(instance_id, {}).values():
+                catalog.delete(bucket_name)
+            instance_bucket_files.get(instance_id, {}).pop(bucket_name, None)
+        elif op == 'add_file':
+            bucket_name, filename, content_length, now = args
+            instance_bucket_files.setdefault(instance_id, {}).setdefault(bucket_name, Catalog()).add(filename, int(content_length), now)
+        elif op == 'delete_file':
+            bucket_name, filename = args
+            catalog = instance_bucket_files.get(instance_id, {}).get(bucket_name)
+            if catalog:
+                catalog.delete(filename)
+        else:
+            raise Exception(f'Unknown shared state change: {op}')
+
+    def apply_local_change(self, *change):
+        # the snapshot is replaced as a whole only by a refresh, changes made by the worker's own users are applied to
+        # the current snapshot in place. this is safe under gevent: a change or a read of a catalog never yields, so
+        # readers never see a partially applied change
+        self.apply_change(self.instances, self.instance_buckets, self.instance_bucket_files, *change)
+        if self.pending_changes is not None:
+            self.pending_changes.append(change)
+
+    def migrate_from_sets(self, delete_old_keys=True):
+        # migrates from the previous layout of a set and a key per instance / bucket / file to the hashes layout
+        old_instances_key = f'{self.key_prefix}:instances'
+        instance_ids = [i.decode('utf-8') for i in self.redis.smembers(old_instances_key)]
+        old_keys = [old_instances_key]
+        pipe = self.redis.pipeline(transaction=False)
+        for instance_id in instance_ids:
+            pipe.get(f'{old_instances_key}:{instance_id}')
+            for suffix in ['public', 'private']:
+                pipe.smembers(f'{old_instances_key}:{instance_id}:buckets:{suffix}')
+        res = iter(pipe.execute())
+        old_buckets = []
+        write_pipe = self.redis.pipeline(transaction=False)
+        for instance_id in instance_ids:
+            instance_data = next(res)
+            old_keys.append(f'{old_instances_key}:{instance_id}')
+            if instance_data:
+                write_pipe.hset(self.instances_key, instance_id, instance_data)
+            for suffix in ['public', 'private']:
+                buckets_key = f'{old_instances_key}:{instance_id}:buckets:{suffix}'
+                old_keys.append(buckets_key)
+                for bucket_name in next(res):
+                    old_buckets.append((instance_id, suffix, bucket_name.decode('utf-8')))
+        pipe = self.redis.pipeline(transaction=False)
+        for instance_id, suffix, bucket_name in old_buckets:
+            pipe.get(f'{old_instances_key}:{instance_id}:buckets:{suffix}:{bucket_name}')
+            pipe.smembers(f'{old_instances_key}:{instance_id}:buckets:{bucket_name}:files')
+        res = iter(pipe.execute())
+        old_files = []
+        for instance_id, suffix, bucket_name in old_buckets:
+            bucket_data, filenames = next(res), next(res)
+            old_keys += [f'{old_instances_key}:{instance_id}:buckets:{suffix}:{bucket_name}', f'{old_instances_key}:{instance_id}:buckets:{bucket_name}:files']
+            if bucket_data:
+                write_pipe.hset(self.get_buckets_key(instance_id), bucket_name, bucket_data)
+                old_files += [(instance_id, bucket_name, filename.decode('utf-8')) for filename in filenames]
+        pipe = self.redis.pipeline(transaction=False)
+        for instance_id, bucket_name, filename in old_files:
+            pipe.get(f'{old_instances_key}:{instance_id}:buckets:{bucket_name}:files:{filename}')
+        for (instance_id, bucket_name, filename), file_data in zip(old_files, pipe.execute()):
+            old_keys.append(f'{old_instances_key}:{instance_id}:buckets:{bucket_name}:files:{filename}')
+            if file_data:
+                write_pipe.hset(self.get_files_key(instance_id, bucket_name), filename, file_data)
+        if delete_old_keys:
+            for i in range(0, len(old_keys), 1000):
+                write_pipe.delete(*old_keys[i:i + 1000])
+        write_pipe.execute()
+        self.debug(f'Migrated {len(instance_ids)} instances, {len(old_buckets)} buckets and {len(old_files)} files to the hashes layout')
+        return len(instance_ids), len(old_buckets), len(old_files)
+
+    @property
+    def instances_key(self):
+        # hashes layout: instance id -> "access:secret:ts"
+        return f'{self.key_prefix}:v2:instances'
+
+    def get_buckets_key(self, instance_id):
+        # bucket name -> bucket json
+        return f'{self.key_prefix}:v2:instances:{instance_id}:buckets'
+
+    def get_files_key(self, instance_id, bucket_name):
+        # filename -> "content_length:ts"
+        return f'{self.key_prefix}:v2:instances:{instance_id}:buckets:{bucket_name}:files'
 
     def add_instance(self, instance_id, instance_access_key, instance_secret_key, now=None):
         now = now or self.get_timestamp()
-        self.redis.set(f'{self.key_prefix}:instances:{instance_id}', f'{instance_access_key}:{instance_secret_key}:{now}')
-        self.redis.sadd(f'{self.key_prefix}:instances', instance_id)
-        self.instances[instance_id] = instance_access_key, instance_secret_key, now
+        self.redis.hset(self.instances_key, instance_id, f'{instance_access_key}:{instance_secret_key}:{now}')
+        self.apply_local_change('add_instance', instance_id, instance_access_key, instance_secret_key, now)
 
     def delete_instance(self, instance_id):
-        self.redis.srem(f'{self.key_prefix}:instances', instance_id)
-        self.redis.delete(f'{self.key_prefix}:instances:{instance_id}')
-        if instance_id in self.instances:
-            del self.instances[instance_id]
+        self.redis.hdel(self.instances_key, instance_id)
+        self.apply_local_change('delete_instance', instance_id)
 
     def upsert_bucket(self, instance_id, bucket_name, bucket):
-        key = f'{self.key_prefix}:instances:{instance_id}:buckets:'
-        key_suffix = 'public' if bucket["public"] else 'private'
-        key += key_suffix
         bucket['__ts'] = bucket.get('__ts') or self.get_timestamp()
-        self.redis.set(f'{key}:{bucket_name}', json.dumps(bucket))
-        self.redis.sadd(key, bucket_name)
-        self.instance_buckets.setdefault(instance_id, {}).setdefault(key_suffix, {})[bucket_name] = bucket
+        self.redis.hset(self.get_buckets_key(instance_id), bucket_name, json.dumps(bucket))
+        self.apply_local_change('upsert_bucket', instance_id, bucket_name, bucket)
 
     def delete_bucket(self, instance_id, bucket_name):
-        for suffix in ['public', 'private']:
-            key = f'{self.key_prefix}:instances:{instance_id}:buckets:{suffix}'
-            self.redis.srem(key, bucket_name)
-            self.redis.delete(f'{key}:{bucket_name}')
-            if instance_id in self.instance_buckets:
-                if suffix in self.instance_buckets[instance_id]:
-                    if bucket_name in self.instance_buckets[instance_id][suffix]:
-                        del self.instance_buckets[instance_id][suffix][bucket_name]
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.hdel(self.get_buckets_key(instance_id), bucket_name)
+        pipe.delete(self.get_files_key(instance_id, bucket_name))
+        pipe.execute()
+        self.apply_local_change('delete_bucket', instance_id, bucket_name)
 
     def add_file(self, instance_id, bucket_name, filename, content_length):
         now = self.get_timestamp()
-        self.redis.set(f'{self.key_prefix}:instances:{instance_id}:buckets:{bucket_name}:files:{filename}', f'{content_length}:{now}')
-        self.redis.sadd(f'{self.key_prefix}:instances:{instance_id}:buckets:{bucket_name}:files', filename)
-        self.instance_bucket_files.setdefault(instance_id, {}).setdefault(bucket_name, {})[filename] = content_length, now
+        self.redis.hset(self.get_files_key(instance_id, bucket_name), filename, f'{content_length}:{now}')
+        self.apply_local_change('add_file', instance_id, bucket_name, filename, content_length, now)
 
     def delete_file(self, instance_id, bucket_name, filename):
-        self.redis.srem(f'{self.key_prefix}:instances:{instance_id}:buckets:{bucket_name}:files', filename)
-        self.redis.delete(f'{self.key_prefix}:instances:{instance_id}:buckets:{bucket_name}:files:{filename}')
-        if instance_id in self.instance_bucket_files:
-            if bucket_name in self.instance_bucket_files[instance_id]:
-                if filename in self.instance_bucket_files[instance_id][bucket_name]:
-                    del self.instance_bucket_files[instance_id][bucket_name][filename]
+        self.redis.hdel(self.get_files_key(instance_id, bucket_name), filename)
+        self.apply_local_change('delete_file', instance_id, bucket_name, filename)
+
+    def get_buckets_catalog(self, instance_id, public):
+        return self.instance_buckets.get(instance_id, {}).get('public' if public else 'private')
+
+    def get_files_catalog(self, instance_id, bucket_name):
+        return self.instance_bucket_files.get(instance_id, {}).get(bucket_name)
 
     def get_bucket_names(self, instance_id, public, ttl_seconds=30):
         self.update_from_redis()
-        suffix = 'public' if public else 'private'
-        res = []
-        for bucket_name, bucket in self.instance_buckets.get(instance_id, {}).get(suffix, {}).items():
-            if ttl_seconds:
-                if self.seconds_since(bucket['__ts']) > ttl_seconds:
-                    res.append(bucket_name)
-            else:
-                res.append(bucket_name)
-        return res
+        catalog = self.get_buckets_catalog(instance_id, public)
+        return catalog.get_names(ttl_seconds, self.get_timestamp()) if catalog else []
+
+    def sample_bucket_name(self, instance_id, public, ttl_seconds=30):
+        # random bucket name older than the TTL or None, without listing the buckets
+        self.update_from_redis()
+        catalog = self.get_buckets_catalog(instance_id, public)
+        bucket_names = catalog.sample(ttl_seconds, self.get_timestamp()) if catalog else []
+        return bucket_names[0] if bucket_names else None
 
     def get_instance_ids(self, ttl_seconds=30):
         self.update_from_redis()
@@ -241,18 +415,24 @@ class SharedState:
 
     def get_filenames(self, instance_id, bucket_name, ttl_seconds=30):
         self.update_from_redis()
-        res = []
-        for filename, filedata in self.instance_bucket_files.get(instance_id, {}).get(bucket_name, {}).items():
-            if ttl_seconds:
-                if self.seconds_since(filedata[1]) > ttl_seconds:
-                    res.append(filename)
-            else:
-                res.append(filename)
-        return res
+        catalog = self.get_files_catalog(instance_id, bucket_name)
+        return catalog.get_names(ttl_seconds, self.get_timestamp()) if catalog else []
+
+    def sample_filenames(self, instance_id, bucket_name, k=1, ttl_seconds=30):
+        # up to k distinct random filenames older than the TTL, without listing the files
+        self.update_from_redis()
+        catalog = self.get_files_catalog(instance_id, bucket_name)
+        return catalog.sample(ttl_seconds, self.get_timestamp(), k) if catalog else []
+
+    def count_filenames(self, instance_id, bucket_name, ttl_seconds=30):
+        self.update_from_redis()
+        catalog = self.get_files_catalog(instance_id, bucket_name)
+        return catalog.count(ttl_seconds, self.get_timestamp()) if catalog else 0
 
     def get_filename_content_length(self, instance_id, bucket_name, filename):
         self.update_from_redis()
-        filedata = self.instance_bucket_files.get(instance_id, {}).get(bucket_name, {}).get(filename)
+        catalog = self.get_files_catalog(instance_id, bucket_name)
+        filedata = catalog.get(filename) if catalog else None
         if filedata:
             return filedata[0]
         else:
@@ -260,4 +440,5 @@ class SharedState:
 
     def is_filename_exists(self, instance_id, bucket_name, filename):
         self.update_from_redis()
-        return filename in self.instance_bucket_files.get(instance_id, {}).get(bucket_name, {})
+        catalog = self.get_files_catalog(instance_id, bucket_name)
+        return bool(catalog) and filename in catalog
@@ -0,0 +1,52 @@
+import time
+import uuid
+import json
+
+from .shared_state import SharedState
+
+
+# measures the time of a full shared state refresh from Redis against the number of files,
+# the data is written under a separate key prefix which is deleted after each run
+
+
+def _populate(state, num_files, files_per_bucket, buckets_per_instance):
+    now = state.get_timestamp()
+    pipe = state.redis.pipeline(transaction=False)
+    for bucket_num in range(-(-num_files // files_per_bucket)):
+        instance_id = f'cmalti-benchmark-{bucket_num // buckets_per_instance}'
+        bucket_name = f'cmaltbpriv-benchmark-{bucket_num}'
+        if bucket_num % buckets_per_instance == 0:
+            pipe.hset(state.instances_key, instance_id, f'access:secret:{now}')
+        pipe.hset(state.get_buckets_key(instance_id), bucket_name, json.dumps({'created': True, 'public': False, '__ts': now}))
+        pipe.hset(state.get_files_key(instance_id, bucket_name), mapping={
+            f'{uuid.uuid4().hex}-5.md': f'5:{now}'
+            for _ in range(min(files_per_bucket, num_files - bucket_num * files_per_bucket))
+        })
+    pipe.execute()
+
+
+def _delete(state):
+    keys = list(state.redis.scan_iter(f'{state.key_prefix}:*', count=1000))
+    for i in range(0, len(keys), 1000):
+        state.redis.delete(*keys[i:i + 1000])
+
+
+def run(num_files_list, files_per_bucket=100, buckets_per_instance=10):
+    results = []
+    for num_files in num_files_list:
+        assert num_files > 0, 'Number of files must be positive'
+        state = SharedState()
+        state.key_prefix = f'cwm-minio-api:load-tests-benchmark:{uuid.uuid4().hex}'
+        try:
+            _populate(state, num_files, files_per_bucket, buckets_per_instance)
+            start = time.perf_counter()
+            state.refresh_from_redis()
+            results.append({
+                'num_files': num_files,
+                'num_buckets': sum(len(b) for buckets in state.instance_buckets.values() for b in buckets.values()),
+                'num_instances': len(state.instances),
+                'refresh_seconds': time.perf_counter() - start,
+            })
+        finally:
+            _delete(state)
+    return results
@@ -0,0 +1,49 @@
+import time
+import uuid
+import hashlib
+
+from botocore.awsrequest import AWSRequest
+from botocore.auth import SigV4Auth
+from botocore.credentials import Credentials
+
+from . import s3_signing
+
+
+# compares the load generator CPU time of preparing a signed upload request:
+# botocore - new body, sha256 of the body and botocore signing for each request (the previous UpDownDel upload)
+# cached - shared body and hash of the content length and the signing key cached per date
+
+
+def _botocore(url, content_length):
+    body = b"a" * content_length
+    payload_hash = hashlib.sha256(body).hexdigest()
+    request = AWSRequest(method="PUT", url=url, data=body, headers={"x-amz-content-sha256": payload_hash})
+    SigV4Auth(Credentials('access', 'secret'), "s3", 'us-east-1').add_auth(request)
+    return body, dict(request.headers)
+
+
+def _cached(url, content_length):
+    body, payload_hash = s3_signing.get_payload(content_length)
+    return body, s3_signing.sign('PUT', url, 'access', 'secret', 'us-east-1', payload_hash)
+
+
+def _cached_unsigned(url, content_length):
+    body, _ = s3_signing.get_payload(content_length)
+    return body, s3_signing.sign('PUT', url, 'access', 'secret', 'us-east-1', s3_signing.UNSIGNED_PAYLOAD)
+
+
+METHODS = {'botocore': _botocore, 'cached': _cached, 'cached_unsigned': _cached_unsigned}
+
+
+def run(content_lengths, num_requests=1000):
+    results = []
+    for content_length in content_lengths:
+        result = {'content_length': content_length}
+        for name, method in METHODS.items():
+            urls = [f'https://minio.example.com/bucket/{uuid.uuid4().hex}-{content_length}.md' for _ in range(num_requests)]
+            start = time.process_time()
+            for url in urls:
+                method(url, content_length)
+            result[f'{name}_us_per_request'] = (time.process_time() - start) / num_requests * 1000000
+        results.append(result)
+    return results
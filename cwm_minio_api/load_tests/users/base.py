@@ -1,5 +1,4 @@
 import uuid
-import hashlib
 import traceback
 import json
 import logging
@@ -7,16 +6,17 @@ import random
 
 import gevent
 from locust import FastHttpUser
-from botocore.awsrequest import AWSRequest
-from botocore.auth import SigV4Auth
-from botocore.credentials import Credentials
-
 from .. import config
+from .. import s3_signing
 from ..shared_state import SharedState
 
 
-def generate_instance_id():
-    return f"cmalti-{uuid.uuid4()}"
+# instances of the control plane users, their keys are rotated and buckets blocked so the data plane users don't use them
+CONTROLPLANE_INSTANCE_ID_PREFIX = "cmalticp"
+
+
+def generate_instance_id(prefix="cmalti"):
+    return f"{prefix}-{uuid.uuid4()}"
 
 
 def generate_bucket_name(public):
@@ -110,8 +110,8 @@ class BaseUser(FastHttpUser):
     def get_minio_bucket_api_url(self, bucket_name):
         return self.tenant_info["bucket_api_url"].replace('<BUCKET_NAME>', bucket_name).rstrip('/')
 
-    def create_instance(self):
-        self.instance_id = generate_instance_id()
+    def create_instance(self, instance_id=None):
+        self.instance_id = instance_id or generate_instance_id()
         logging.info(f'Creating instance: {self.instance_id}')
         _, res_text = self.client_request_retry(
             'post',
@@ -183,10 +183,7 @@ class BaseUser(FastHttpUser):
         url = f'{base_url}/{filename}'
         headers = {}
         if not is_public:
-            payload_hash = hashlib.sha256(b"").hexdigest()
-            request = AWSRequest(method="GET", url=url, headers={"x-amz-content-sha256": payload_hash})
-            SigV4Auth(Credentials(access, secret), "s3", region_name).add_auth(request)
-            headers=dict(request.headers)
+            headers = s3_signing.sign('GET', url, access, secret, region_name)
 
         self.client_request_retry(
             'get',
@@ -234,7 +231,10 @@ class BaseUser(FastHttpUser):
         raise Exception(f'client_request_retry exceeded max attempts {max_attempts}: {last_error_msg}')
 
     def get_instance(self):
-        all_instance_ids = self.shared_state.get_instance_ids()
+        all_instance_ids = [
+            instance_id for instance_id in self.shared_state.get_instance_ids()
+            if not instance_id.startswith(f'{CONTROLPLANE_INSTANCE_ID_PREFIX}-')
+        ]
         if len(all_instance_ids) > 0:
             instance_id = random.choice(all_instance_ids)
             instance = self.shared_state.get_instance(instance_id)
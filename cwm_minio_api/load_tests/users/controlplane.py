@@ -0,0 +1,142 @@
+import json
+import random
+
+from locust import task
+
+from .base import BaseUser, generate_instance_id, CONTROLPLANE_INSTANCE_ID_PREFIX
+from .. import config
+
+
+class ControlPlane(BaseUser):
+    if config.CWM_CONTROLPLANE_FIXED_COUNT > 0:
+        fixed_count = config.CWM_CONTROLPLANE_FIXED_COUNT
+    else:
+        weight = config.CWM_CONTROLPLANE_USER_WEIGHT
+
+    concurrency = config.CWM_CONTROLPLANE_CONCURRENCY
+
+    def __init__(self, environment):
+        super().__init__(environment)
+        self.auth = (config.CWM_MINIO_API_USERNAME, config.CWM_MINIO_API_PASSWORD)
+        self.blocked_bucket_names = set()
+        # access key: bucket name of the credentials bound to the instance buckets
+        self.credentials = {}
+
+    def on_start(self):
+        self.update_tenant_info()
+        self.create_instance(generate_instance_id(CONTROLPLANE_INSTANCE_ID_PREFIX))
+        self.debug(f'ControlPlane on_start (instance_id: {self.instance_id})')
+
+    def get_buckets(self):
+        # list of (bucket name, public) of the instance
+        return [
+            (bucket_name, public)
+            for public in [True, False]
+            for bucket_name in self.shared_state.get_bucket_names(self.instance_id, public, ttl_seconds=0)
+        ]
+
+    def get_random_bucket(self, blocked=None):
+        buckets = [
+            (bucket_name, public) for bucket_name, public in self.get_buckets()
+            if blocked is None or (bucket_name in self.blocked_bucket_names) == blocked
+        ]
+        return random.choice(buckets) if buckets else (None, None)
+
+    def request(self, method, path, name, **kwargs):
+        status_code, text = self.client_request_retry(method, path, auth=self.auth, name=name, **kwargs)
+        return 200 <= status_code < 300, text
+
+    @task(config.CWM_CONTROLPLANE_CREATE_BUCKET_WEIGHT)
+    def create_bucket_task(self):
+        if len(self.get_buckets()) >= config.CWM_CONTROLPLANE_MAX_BUCKETS:
+            self.delete_bucket_task()
+        else:
+            self.create_bucket(public=random.choice([True, False]))
+
+    @task(config.CWM_CONTROLPLANE_DELETE_BUCKET_WEIGHT)
+    def delete_bucket_task(self):
+        bucket_name, _ = self.get_random_bucket()
+        if bucket_name:
+            ok, _ = self.request('delete', '/buckets/delete', 'controlplane_delete_bucket', params={'instance_id': self.instance_id, 'bucket_name': bucket_name})
+            if ok:
+                self.shared_state.delete_bucket(self.instance_id, bucket_name)
+                self.blocked_bucket_names.discard(bucket_name)
+                for access_key in [a for a, b in self.credentials.items() if b == bucket_name]:
+                    self.unbind_credentials(access_key, bucket_unbound=True)
+
+    @task(config.CWM_CONTROLPLANE_UPDATE_BUCKET_WEIGHT)
+    def update_bucket(self):
+        bucket_name, public = self.get_random_bucket()
+        if bucket_name:
+            ok, _ = self.request('put', '/buckets/update', 'controlplane_update_bucket', json={
+                'instance_id': self.instance_id, 'bucket_name': bucket_name,
+                'public': not public, 'blocked': bucket_name in self.blocked_bucket_names,
+            })
+            if ok:
+                self.shared_state.delete_bucket(self.instance_id, bucket_name)
+                self.shared_state.upsert_bucket(self.instance_id, bucket_name, {'created': True, 'public': not public})
+
+    @task(config.CWM_CONTROLPLANE_BLOCK_BUCKET_WEIGHT)
+    def block_unblock_bucket(self):
+        bucket_name, public = self.get_random_bucket()
+        if bucket_name:
+            blocked = bucket_name not in self.blocked_bucket_names
+            ok, _ = self.request('put', '/buckets/update', f'controlplane_{"block" if blocked else "unblock"}_bucket', json={
+                'instance_id': self.instance_id, 'bucket_name': bucket_name, 'public': public, 'blocked': blocked,
+            })
+            if ok:
+                if blocked:
+                    self.blocked_bucket_names.add(bucket_name)
+                else:
+                    self.blocked_bucket_names.discard(bucket_name)
+
+    @task(config.CWM_CONTROLPLANE_RESET_ACCESS_KEY_WEIGHT)
+    def reset_access_key(self):
+        ok, text = self.request('put', '/instances/update', 'controlplane_reset_access_key', json={
+            'instance_id': self.instance_id, 'blocked': False, 'reset_access_key': True,
+        })
+        if ok:
+            instance = json.loads(text)
+            self.instance_access_key, self.instance_secret_key = instance['access_key'], instance['secret_key']
+            self.shared_state.add_instance(self.instance_id, self.instance_access_key, self.instance_secret_key)
+            # the instance update with blocked False unblocks all the instance buckets
+            self.blocked_bucket_names.clear()
+
+    @task(config.CWM_CONTROLPLANE_BIND_CREDENTIALS_WEIGHT)
+    def bind_credentials(self):
+        if len(self.credentials) >= config.CWM_CONTROLPLANE_MAX_CREDENTIALS:
+            return self.unbind_credentials()
+        bucket_name, _ = self.get_random_bucket(blocked=False)
+        if bucket_name:
+            ok, text = self.request('post', '/credentials', 'controlplane_create_credentials', json={'instance_id': self.instance_id})
+            if ok:
+                access_key = json.loads(text)['access_key']
+                ok, _ = self.request('post', '/buckets/credentials', 'controlplane_bind_credentials', json={
+                    'instance_id': self.instance_id, 'bucket_name': bucket_name, 'access_key': access_key,
+                    'read': True, 'write': random.choice([True, False]), 'delete': random.choice([True, False]),
+                })
+                if ok:
+                    self.credentials[access_key] = bucket_name
+                else:
+                    self.request('delete', '/credentials', 'controlplane_delete_credentials', params={'access_key': access_key})
+
+    @task(config.CWM_CONTROLPLANE_UNBIND_CREDENTIALS_WEIGHT)
+    def unbind_credentials(self, access_key=None, bucket_unbound=False):
+        if not access_key:
+            if not self.credentials:
+                return
+            access_key = random.choice(list(self.credentials))
+        bucket_name = self.credentials.pop(access_key)
+        if not bucket_unbound:
+            self.request('delete', '/buckets/credentials', 'controlplane_unbind_credentials', params={
+                'instance_id': self.instance_id, 'bucket_name': bucket_name, 'access_key': access_key,
+            })
+        self.request('delete', '/credentials', 'controlplane_delete_credentials', params={'access_key': access_key})
+
+    @task(config.CWM_CONTROLPLANE_LIST_WEIGHT)
+    def list_buckets(self):
+        self.request('get', '/buckets/list', 'controlplane_list_buckets', params={'instance_id': self.instance_id})
+
+    @task(config.CWM_CONTROLPLANE_LIST_WITH_SIZE_WEIGHT)
+    def list_buckets_with_size(self):
+        self.request('get', '/buckets/list', 'controlplane_list_buckets_with_size', params={'instance_id': self.instance_id, 'with_size': 'true'})
@@ -19,12 +19,11 @@ class GetGetter(BaseUser):
         instance_id, access, secret = self.get_instance()
         if instance_id:
             is_public = random.choices([True, False], weights=[config.CWM_UPDOWNDEL_PUBLIC_WEIGHT, config.CWM_UPDOWNDEL_PRIVATE_WEIGHT], k=1)[0]
-            bucket_names = self.shared_state.get_bucket_names(instance_id, is_public)
-            if len(bucket_names) > 0:
-                bucket_name = random.choice(bucket_names)
-                filenames = self.shared_state.get_filenames(instance_id, bucket_name)
+            bucket_name = self.shared_state.sample_bucket_name(instance_id, is_public)
+            if bucket_name:
+                filenames = self.shared_state.sample_filenames(instance_id, bucket_name)
                 if len(filenames) > 0:
-                    filename = random.choice(filenames)
+                    filename = filenames[0]
                     use_bucket_url = random.choices([True, False], weights=[100, 1], k=1)[0]
                     self.download_from_bucket_filename(
                         bucket_name, filename, is_public, use_bucket_url, instance=(instance_id, access, secret),
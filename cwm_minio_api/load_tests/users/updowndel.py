@@ -1,16 +1,20 @@
+import re
+import time
+import logging
 import hashlib
 import uuid
 import random
 from textwrap import dedent
+from urllib.parse import quote
 import base64
 
+from gevent.pool import Pool
 from locust import task
-from botocore.awsrequest import AWSRequest
-from botocore.auth import SigV4Auth
-from botocore.credentials import Credentials
 
 from .base import BaseUser
 from .. import config
+from .. import s3_signing
+from .. import custom_stats
 
 
 class UpDownDel(BaseUser):
@@ -52,7 +56,9 @@ class UpDownDel(BaseUser):
             instance_id, instance_access_key, instance_secret_key = instance
         else:
             instance_id, instance_access_key, instance_secret_key = self.instance_id, self.instance_access_key, self.instance_secret_key
-        body = b"a" * content_length
+        body, payload_hash = s3_signing.get_payload(content_length)
+        if 0 < config.CWM_UPDOWNDEL_UNSIGNED_PAYLOAD_MIN_CONTENT_LENGTH <= content_length:
+            payload_hash = s3_signing.UNSIGNED_PAYLOAD
         filename = f'{uuid.uuid4().hex}-{content_length}.md'
         if instance_id == 'aws':
             name_prefix = 'aws_'
@@ -63,13 +69,10 @@ class UpDownDel(BaseUser):
             region_name = "us-east-1"
             base_url = self.minio_api_url
         url = f'{base_url}/{bucket_name}/{filename}'
-        payload_hash = hashlib.sha256(body).hexdigest()
-        request = AWSRequest(method="PUT", url=url, data=body, headers={"x-amz-content-sha256": payload_hash})
-        SigV4Auth(Credentials(instance_access_key, instance_secret_key), "s3", region_name).add_auth(request)
         status_code, text = self.client_request_retry(
             'put',
             url,
-            headers=dict(request.headers),
+            headers=s3_signing.sign('PUT', url, instance_access_key, instance_secret_key, region_name, payload_hash),
             data=body,
             name=f'{name_prefix}upload_to_bucket({content_length})',
         )
@@ -79,6 +82,89 @@ class UpDownDel(BaseUser):
         else:
             return None
 
+    def multipart_upload_to_bucket(self, bucket_name, content_length, instance=None):
+        if instance:
+            instance_id, instance_access_key, instance_secret_key = instance
+        else:
+            instance_id, instance_access_key, instance_secret_key = self.instance_id, self.instance_access_key, self.instance_secret_key
+
+        def sign(method, request_url, payload_hash=s3_signing.EMPTY_PAYLOAD_HASH):
+            return s3_signing.sign(method, request_url, instance_access_key, instance_secret_key, "us-east-1", payload_hash)
+
+        filename = f'{uuid.uuid4().hex}-{content_length}.md'
+        url = f'{self.minio_api_url}/{bucket_name}/{filename}'
+        start_time = time.perf_counter()
+        status_code, text = self.client_request_retry('post', f'{url}?uploads', headers=sign('POST', f'{url}?uploads'), name='multipart_upload_create')
+        if status_code != 200:
+            return None
+        upload_id_match = re.search("<UploadId>(.*?)</UploadId>", text)
+        if not upload_id_match:
+            logging.error(f'Missing UploadId in create multipart upload response: {text}')
+            return None
+        upload_url = f'{url}?uploadId={quote(upload_id_match.group(1), safe="-_.~")}'
+        part_size = config.CWM_UPDOWNDEL_MULTIPART_PART_SIZE
+        num_parts = -(-content_length // part_size)
+        aborted = random.randint(1, 100) <= config.CWM_UPDOWNDEL_MULTIPART_ABORT_PERCENT
+        part_numbers = list(range(1, (random.randint(1, num_parts) if aborted else num_parts) + 1))
+
+        def abort():
+            self.client_request_retry('delete', upload_url, headers=sign('DELETE', upload_url), name='multipart_upload_abort')
+
+        try:
+            etags = Pool(config.CWM_UPDOWNDEL_MULTIPART_CONCURRENCY).map(
+                lambda part_number: self.upload_part(
+                    upload_url, part_number, min(part_size, content_length - (part_number - 1) * part_size), sign
+                ),
+                part_numbers,
+            )
+            self.client_request_retry('get', upload_url, headers=sign('GET', upload_url), name='multipart_upload_list_parts')
+        except Exception:
+            # don't leave the uploaded parts behind
+            abort()
+            raise
+        if aborted or None in etags:
+            abort()
+            return None
+        body = ''.join([
+            '<CompleteMultipartUpload>',
+            *(f'<Part><PartNumber>{part_number}</PartNumber><ETag>{etag}</ETag></Part>' for part_number, etag in zip(part_numbers, etags)),
+            '</CompleteMultipartUpload>',
+        ]).encode()
+        status_code, text = self.client_request_retry(
+            'post', upload_url, data=body, headers=sign('POST', upload_url, hashlib.sha256(body).hexdigest()),
+            name='multipart_upload_complete',
+        )
+        # complete multipart upload may fail after returning status 200
+        if status_code != 200 or '<Error>' in text:
+            return None
+        self.shared_state.add_file(instance_id, bucket_name, filename, content_length)
+        # upload throughput in MB/s, reported as the response time of a custom stat
+        custom_stats.log_stat(
+            self.environment, 'throughput', f'multipart_upload_mb_per_second({content_length})',
+            content_length / 1000000 / (time.perf_counter() - start_time),
+        )
+        return filename
+
+    def upload_part(self, upload_url, part_number, part_length, sign):
+        # all the parts of the same length share the same body
+        body, payload_hash = s3_signing.get_payload(part_length)
+        part_url = f'{upload_url}&partNumber={part_number}'
+        etag = None
+
+        def pre_return_hook(res):
+            nonlocal etag
+            if res.status_code == 200:
+                etag = res.headers.get('ETag')
+                res.success()
+            else:
+                res.failure(f'unexpected status code {res.status_code} {res.text}')
+
+        self.client_request_retry(
+            'put', part_url, headers=sign('PUT', part_url, payload_hash), data=body,
+            pre_return_hook=pre_return_hook, name=f'multipart_upload_part({part_length})',
+        )
+        return etag
+
     def delete_from_bucket(self, bucket_name, filename, instance=None):
         if instance:
             instance_id, instance_access_key, instance_secret_key = instance
@@ -86,13 +172,10 @@ class UpDownDel(BaseUser):
             instance_id, instance_access_key, instance_secret_key = self.instance_id, self.instance_access_key, self.instance_secret_key
         self.shared_state.delete_file(instance_id, bucket_name, filename)
         url = f'{self.minio_api_url}/{bucket_name}/{filename}'
-        payload_hash = hashlib.sha256(b"").hexdigest()
-        request = AWSRequest(method="DELETE", url=url, headers={"x-amz-content-sha256": payload_hash})
-        SigV4Auth(Credentials(instance_access_key, instance_secret_key), "s3", "us-east-1").add_auth(request)
         self.client_request_retry(
             'delete',
             url,
-            headers=dict(request.headers),
+            headers=s3_signing.sign('DELETE', url, instance_access_key, instance_secret_key, "us-east-1"),
             name='delete_from_bucket',
         )
 
@@ -123,31 +206,26 @@ class UpDownDel(BaseUser):
         headers = {
             "Content-MD5": body_md5,
             "Content-Type": "application/xml",
-            "x-amz-content-sha256": payload_hash,
         }
-        request = AWSRequest(method="POST", url=url, headers=headers, data=body)
-        SigV4Auth(Credentials(instance_access_key, instance_secret_key), "s3", region_name).add_auth(request)
         self.client_request_retry(
             'post',
             url,
             data=body.decode(),
-            headers=dict(request.headers),
+            headers=s3_signing.sign('POST', url, instance_access_key, instance_secret_key, region_name, payload_hash, headers),
             name=f'{name_prefix}delete_from_bucket_multi',
         )
 
     def get_test_bucket_name(self, instance_id=None):
         instance_id = instance_id or self.instance_id
         is_public = random.choices([True, False], weights=[config.CWM_UPDOWNDEL_PUBLIC_WEIGHT, config.CWM_UPDOWNDEL_PRIVATE_WEIGHT], k=1)[0]
-        bucket_names = self.shared_state.get_bucket_names(instance_id, is_public)
-        if len(bucket_names) > 0:
-            return random.choice(bucket_names), is_public
+        bucket_name = self.shared_state.sample_bucket_name(instance_id, is_public)
+        if bucket_name:
+            return bucket_name, is_public
         else:
             return None, None
 
-    def get_test_filenames(self, bucket_name, instance_id=None):
-        instance_id = instance_id or self.instance_id
-        content_length = random.choices(config.CWM_UPDOWNDEL_CONTENT_LENGTH_VALUES, weights=config.CWM_UPDOWNDEL_CONTENT_LENGTH_WEIGHTS, k=1)[0]
-        return self.shared_state.get_filenames(instance_id, bucket_name), content_length
+    def get_test_content_length(self):
+        return random.choices(config.CWM_UPDOWNDEL_CONTENT_LENGTH_VALUES, weights=config.CWM_UPDOWNDEL_CONTENT_LENGTH_WEIGHTS, k=1)[0]
 
     @task(config.CWM_UPDOWNDEL_UPLOAD_WEIGHT)
     def upload(self):
@@ -155,9 +233,18 @@ class UpDownDel(BaseUser):
         instance_id = instance[0] if instance else None
         bucket_name, _ = self.get_test_bucket_name(instance_id)
         if bucket_name:
-            filenames, content_length = self.get_test_filenames(bucket_name, instance_id)
-            if len(filenames) <= config.CWM_UPDOWNDEL_MAX_FILES_PER_BUCKET:
-                self.upload_to_bucket(bucket_name, content_length, instance)
+            if self.shared_state.count_filenames(instance_id or self.instance_id, bucket_name) <= config.CWM_UPDOWNDEL_MAX_FILES_PER_BUCKET:
+                self.upload_to_bucket(bucket_name, self.get_test_content_length(), instance)
+
+    @task(config.CWM_UPDOWNDEL_MULTIPART_WEIGHT)
+    def multipart_upload(self):
+        instance = None if self.instance_id else self.get_instance()
+        instance_id = instance[0] if instance else None
+        bucket_name, _ = self.get_test_bucket_name(instance_id)
+        if bucket_name:
+            if self.shared_state.count_filenames(instance_id or self.instance_id, bucket_name) <= config.CWM_UPDOWNDEL_MAX_FILES_PER_BUCKET:
+                content_length = random.choices(config.CWM_UPDOWNDEL_MULTIPART_CONTENT_LENGTH_VALUES, weights=config.CWM_UPDOWNDEL_MULTIPART_CONTENT_LENGTH_WEIGHTS, k=1)[0]
+                self.multipart_upload_to_bucket(bucket_name, content_length, instance)
 
     @task(config.CWM_UPDOWNDEL_DOWNLOAD_WEIGHT)
     def download(self):
@@ -165,10 +252,9 @@ class UpDownDel(BaseUser):
         instance_id = instance[0] if instance else None
         bucket_name, is_public = self.get_test_bucket_name(instance_id)
         if bucket_name:
-            filenames, content_length = self.get_test_filenames(bucket_name, instance_id)
+            filenames = self.shared_state.sample_filenames(instance_id or self.instance_id, bucket_name)
             if filenames:
-                filename = random.choice(filenames)
-                self.download_from_bucket_filename(bucket_name, filename, is_public=is_public, instance=instance)
+                self.download_from_bucket_filename(bucket_name, filenames[0], is_public=is_public, instance=instance)
 
     @task(config.CWM_UPDOWNDEL_DELETE_WEIGHT)
     def delete(self):
@@ -176,14 +262,15 @@ class UpDownDel(BaseUser):
         instance_id = instance[0] if instance else None
         bucket_name, is_public = self.get_test_bucket_name(instance_id)
         if bucket_name:
-            filenames, _ = self.get_test_filenames(bucket_name, instance_id)
-            if filenames and len(filenames) > config.CWM_UPDOWNDEL_MIN_FILES_PER_BUCKET:
+            instance_id = instance_id or self.instance_id
+            num_filenames = self.shared_state.count_filenames(instance_id, bucket_name)
+            if num_filenames and num_filenames > config.CWM_UPDOWNDEL_MIN_FILES_PER_BUCKET:
                 num_to_delete = random.randint(1, 3)
                 if num_to_delete == 1:
-                    filename = random.choice(filenames)
+                    filename = self.shared_state.sample_filenames(instance_id, bucket_name)[0]
                     self.delete_from_bucket(bucket_name, filename, instance=instance)
                 else:
-                    filenames = random.sample(filenames, min(num_to_delete, config.CWM_UPDOWNDEL_MIN_FILES_PER_BUCKET))
+                    filenames = self.shared_state.sample_filenames(instance_id, bucket_name, k=min(num_to_delete, config.CWM_UPDOWNDEL_MIN_FILES_PER_BUCKET))
                     self.delete_from_bucket_multi(bucket_name, filenames, instance=instance)
 
     @task(config.CWM_UPDOWNDEL_AWS_WEIGHT)
@@ -1,4 +1,4 @@
-from prometheus_client import CollectorRegistry, Counter, Histogram, REGISTRY, multiprocess
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, multiprocess
 from prometheus_client.utils import INF
 
 from .. import config
@@ -19,6 +19,39 @@ MINIO_MC_CALL_DURATION_SECONDS = Histogram(
     labelnames=("operation", "outcome"),
     buckets=DEFAULT_BUCKETS,
 )
+MINIO_QUEUE_DEPTH = Gauge(
+    "cwm_minio_api_minio_queue_depth",
+    "Number of MinIO operations waiting for an admission slot.",
+    labelnames=("priority",),
+    multiprocess_mode="livesum",
+)
+MINIO_QUEUE_WAIT_SECONDS = Histogram(
+    "cwm_minio_api_minio_queue_wait_seconds",
+    "Time MinIO operations spent waiting for an admission slot.",
+    labelnames=("priority", "outcome"),
+    buckets=(.01, .05, .1, .5, 1.0, 2.0, 5.0, 10.0, 30.0, INF),
+)
+MINIO_IN_FLIGHT = Gauge(
+    "cwm_minio_api_minio_in_flight",
+    "Number of MinIO operations currently executing.",
+    multiprocess_mode="livesum",
+)
+MINIO_HTTP_CALLS_TOTAL = Counter(
+    "cwm_minio_api_minio_http_calls_total",
+    "Total MinIO admin / S3 HTTP API calls made by the API.",
+    labelnames=("operation", "outcome"),
+)
+MINIO_HTTP_CALL_DURATION_SECONDS = Histogram(
+    "cwm_minio_api_minio_http_call_duration_seconds",
+    "Duration of MinIO admin / S3 HTTP API calls made by the API.",
+    labelnames=("operation", "outcome"),
+    buckets=DEFAULT_BUCKETS,
+)
+MINIO_OUTBOX_OPERATIONS_TOTAL = Counter(
+    "cwm_minio_api_minio_outbox_operations_total",
+    "Total MinIO operations executed by the outbox workers.",
+    labelnames=("operation", "outcome"),
+)
 DB_CONN_ACQUIRE_TIME = Histogram(
     "cwm_minio_api_db_connection_acquire_seconds",
     "Time spent acquiring DB connection",
@@ -30,6 +63,21 @@ DB_CONNS_TOTAL = Counter(
     "Total DB connections made",
     labelnames=("outcome",),
 )
+DB_POOL_SIZE = Gauge(
+    "cwm_minio_api_db_pool_size",
+    "Number of connections currently managed by the DB pool (in use and idle)",
+    multiprocess_mode="livesum",
+)
+DB_POOL_IDLE = Gauge(
+    "cwm_minio_api_db_pool_idle",
+    "Number of idle connections in the DB pool",
+    multiprocess_mode="livesum",
+)
+DB_POOL_WAITING = Gauge(
+    "cwm_minio_api_db_pool_waiting",
+    "Number of requests waiting for a DB pool connection",
+    multiprocess_mode="livesum",
+)
 
 
 def get_prometheus_registry():
@@ -1,11 +1,14 @@
+import random
 import asyncio
 import logging
 import tempfile
 import time
+import contextvars
 
 import orjson
 
 from .. import config, common
+from . import http_backend, sim_backend, scheduler
 from ..metrics.prometheus import MINIO_MC_CALLS_TOTAL, MINIO_MC_CALL_DURATION_SECONDS
 
 
@@ -21,39 +24,107 @@ def _mc_operation_name(args: tuple[str, ...]) -> str:
             return "unknown"
 
 
-async def mc_check_call(*args, return_output=False):
-    logging.debug(f'mc_check_call({" ".join(args)})')
-    op = _mc_operation_name(args)
-    start = time.perf_counter()
-    outcome = 'error'
+# mc operations which can be executed again with the same result
+MC_RETRYABLE_OPERATIONS = {
+    'stat', 'ls', 'admin_datausageinfo', 'admin_policy_create', 'admin_user_add', 'admin_user_enable', 'admin_user_disable',
+    'admin_group_enable', 'admin_group_disable', 'anonymous_set_download', 'anonymous_set_none',
+}
+# lower case parts of mc error messages of transient failures
+MC_RETRYABLE_ERRORS = (
+    'connection reset', 'connection refused', 'i/o timeout', 'timeout exceeded', 'unexpected eof', 'broken pipe',
+    '503', 'service unavailable', 'server is not initialized', 'please reduce your request rate', 'slow down',
+)
+
+# number of retries left for the current API request / job, set by start_retry_budget, shared by its tasks
+retry_budget = contextvars.ContextVar('minio_retry_budget', default=None)
+
+
+def start_retry_budget():
+    retry_budget.set([config.MINIO_MC_RETRY_BUDGET])
+
+
+def _use_retry_budget():
+    budget = retry_budget.get()
+    if budget is None:
+        return True
+    if budget[0] <= 0:
+        return False
+    budget[0] -= 1
+    return True
+
+
+def is_retryable_error(op, e):
+    if op not in MC_RETRYABLE_OPERATIONS or not isinstance(e, AssertionError):
+        return False
+    message = str(e).lower()
+    return any(error in message for error in MC_RETRYABLE_ERRORS)
+
+
+def _observe_call(op, outcome):
     try:
-        proc = await asyncio.create_subprocess_exec(
-            config.MINIO_MC_BINARY,
-            *args,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.STDOUT,
-        )
-        stdout, _ = await proc.communicate()
-        stdout = stdout.decode().strip()
-        logging.debug(f'mc_check_call({" ".join(args)}): {stdout}')
-        assert proc.returncode == 0, stdout
-        outcome = 'success'
-        try:
-            MINIO_MC_CALLS_TOTAL.labels(operation=op, outcome="success").inc()
-        except Exception:
-            pass
-        return stdout if return_output else None
+        MINIO_MC_CALLS_TOTAL.labels(operation=op, outcome=outcome).inc()
     except Exception:
+        pass
+
+
+async def _mc_check_call_attempt(op, args, return_output):
+    async with scheduler.admission_slot(op):
+        start = time.perf_counter()
+        outcome = 'error'
         try:
-            MINIO_MC_CALLS_TOTAL.labels(operation=op, outcome="error").inc()
-        except Exception:
-            pass
-        raise
-    finally:
+            timeout = common.get_remaining_seconds(config.MINIO_MC_TIMEOUT_SECONDS)
+            proc = await asyncio.create_subprocess_exec(
+                config.MINIO_MC_BINARY,
+                *args,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.STDOUT,
+            )
+            try:
+                stdout, _ = await asyncio.wait_for(proc.communicate(), timeout)
+            except BaseException as e:
+                # the process must not outlive the request (timeout or cancellation)
+                if proc.returncode is None:
+                    proc.kill()
+                    await proc.wait()
+                if isinstance(e, TimeoutError):
+                    raise common.DeadlineExceededException(f'mc {op} timed out after {timeout:.1f}s')
+                raise
+            stdout = stdout.decode().strip()
+            logging.debug(f'mc_check_call({" ".join(args)}): {stdout}')
+            assert proc.returncode == 0, stdout
+            outcome = 'success'
+            return stdout if return_output else None
+        finally:
+            try:
+                MINIO_MC_CALL_DURATION_SECONDS.labels(operation=op, outcome=outcome).observe(time.perf_counter() - start)
+            except Exception:
+                pass
+
+
+async def mc_check_call(*args, return_output=False, operation=None):
+    logging.debug(f'mc_check_call({" ".join(args)})')
+    op = operation or _mc_operation_name(args)
+    attempt = 1
+    while True:
         try:
-            MINIO_MC_CALL_DURATION_SECONDS.labels(operation=op, outcome=outcome).observe(time.perf_counter() - start)
-        except Exception:
-            pass
+            result = await _mc_check_call_attempt(op, args, return_output)
+        except Exception as e:
+            # capped exponential backoff with full jitter, not retrying if the request deadline would pass while waiting
+            delay = random.uniform(0, min(config.MINIO_MC_RETRY_MAX_SECONDS, config.MINIO_MC_RETRY_BASE_SECONDS * 2 ** (attempt - 1)))
+            deadline = common.request_deadline.get()
+            if (
+                attempt < config.MINIO_MC_RETRY_MAX_ATTEMPTS and is_retryable_error(op, e)
+                and (deadline is None or time.monotonic() + delay < deadline) and _use_retry_budget()
+            ):
+                logging.warning(f'mc_check_call({" ".join(args)}) attempt {attempt} failed, retrying in {delay:.2f}s: {e}')
+                _observe_call(op, 'retry')
+                attempt += 1
+                await asyncio.sleep(delay)
+                continue
+            _observe_call(op, 'error')
+            raise
+        _observe_call(op, 'success')
+        return result
 
 
 async def mc_check_output(*args) -> str:
@@ -62,72 +133,326 @@ async def mc_check_output(*args) -> str:
     return out
 
 
+def get_backend():
+    # module which implements the MinIO operations directly, None if they are executed by running mc
+    if config.MINIO_API_BACKEND == 'http':
+        return http_backend
+    elif config.MINIO_API_BACKEND == 'sim':
+        return sim_backend
+    return None
+
+
+# set by outbox.api.deferred - MinIO mutations are recorded to be executed by the outbox workers instead of running immediately
+deferred_operations = contextvars.ContextVar('minio_deferred_operations', default=None)
+
+
+def defer(op, *args):
+    operations = deferred_operations.get()
+    if operations is None:
+        return False
+    operations.append([op, list(args)])
+    return True
+
+
 async def create_bucket(name, exit_stack=None):
+    if defer('create_bucket', name):
+        return
     if exit_stack:
-        exit_stack.push_async_callback(delete_bucket, name)
-    await mc_check_call('mb', f'{config.MINIO_MC_PROFILE}/{name}')
+        exit_stack.push_async_callback(scheduler.run_compensation, delete_bucket, name)
+    if backend := get_backend():
+        await backend.create_bucket(name)
+    else:
+        await mc_check_call('mb', f'{config.MINIO_MC_PROFILE}/{name}')
 
 
 async def delete_bucket(name):
-    await mc_check_call('rb', f'{config.MINIO_MC_PROFILE}/{name}', '--force')
+    if defer('delete_bucket', name):
+        return
+    if backend := get_backend():
+        await backend.delete_bucket(name)
+    else:
+        await mc_check_call('rb', f'{config.MINIO_MC_PROFILE}/{name}', '--force')
 
 
 async def bucket_exists(name):
     try:
-        await mc_check_call('ls', f'{config.MINIO_MC_PROFILE}/{name}')
+        if backend := get_backend():
+            await backend.bucket_exists(name)
+        else:
+            await mc_check_call('ls', f'{config.MINIO_MC_PROFILE}/{name}')
         return True
     except Exception:
         return False
 
 
 async def create_policy(name, policy_json, exit_stack=None):
+    if defer('create_policy', name, policy_json):
+        return
     if exit_stack:
-        exit_stack.push_async_callback(delete_policy, name)
-    with tempfile.NamedTemporaryFile() as policy_file:
-        policy_file.write(policy_json.encode())
-        policy_file.flush()
-        policy_filename = policy_file.name
-        await mc_check_call('admin', 'policy', 'create', config.MINIO_MC_PROFILE, name, policy_filename)
+        exit_stack.push_async_callback(scheduler.run_compensation, delete_policy, name)
+    if backend := get_backend():
+        await backend.create_policy(name, policy_json)
+    else:
+        with tempfile.NamedTemporaryFile() as policy_file:
+            policy_file.write(policy_json.encode())
+            policy_file.flush()
+            policy_filename = policy_file.name
+            await mc_check_call('admin', 'policy', 'create', config.MINIO_MC_PROFILE, name, policy_filename)
 
 
 async def delete_policy(name):
-    await mc_check_call('admin', 'policy', 'rm', config.MINIO_MC_PROFILE, name)
+    if defer('delete_policy', name):
+        return
+    if backend := get_backend():
+        await backend.delete_policy(name)
+    else:
+        await mc_check_call('admin', 'policy', 'rm', config.MINIO_MC_PROFILE, name)
 
 
 async def create_user(user, password, exit_stack=None):
     if exit_stack:
-        exit_stack.push_async_callback(delete_user, user)
-    await mc_check_call('admin', 'user', 'add', config.MINIO_MC_PROFILE, user, password)
+        exit_stack.push_async_callback(scheduler.run_compensation, delete_user, user)
+    if backend := get_backend():
+        await backend.create_user(user, password)
+    else:
+        await mc_check_call('admin', 'user', 'add', config.MINIO_MC_PROFILE, user, password)
 
 
 async def delete_user(user):
-    await mc_check_call('admin', 'user', 'rm', config.MINIO_MC_PROFILE, user)
+    if defer('delete_user', user):
+        return
+    if backend := get_backend():
+        await backend.delete_user(user)
+    else:
+        await mc_check_call('admin', 'user', 'rm', config.MINIO_MC_PROFILE, user)
+
+
+async def set_user_status(user, enabled, exit_stack=None):
+    if defer('set_user_status', user, enabled):
+        return
+    if exit_stack:
+        exit_stack.push_async_callback(scheduler.run_compensation, set_user_status, user, not enabled)
+    if backend := get_backend():
+        await backend.set_user_status(user, enabled)
+    else:
+        await mc_check_call('admin', 'user', 'enable' if enabled else 'disable', config.MINIO_MC_PROFILE, user)
 
 
 async def attach_policy_to_user(policy_name, user_name, exit_stack=None):
+    if defer('attach_policy_to_user', policy_name, user_name):
+        return
     if exit_stack:
-        exit_stack.push_async_callback(detach_policy_from_user, policy_name, user_name)
-    await mc_check_call('admin', 'policy', 'attach', config.MINIO_MC_PROFILE, policy_name, '--user', user_name)
+        exit_stack.push_async_callback(scheduler.run_compensation, detach_policy_from_user, policy_name, user_name)
+    if backend := get_backend():
+        await backend.attach_policy_to_user(policy_name, user_name)
+    else:
+        await mc_check_call('admin', 'policy', 'attach', config.MINIO_MC_PROFILE, policy_name, '--user', user_name)
 
 
 async def detach_policy_from_user(policy_name, user_name, exit_stack=None):
+    if defer('detach_policy_from_user', policy_name, user_name):
+        return
+    if exit_stack:
+        exit_stack.push_async_callback(scheduler.run_compensation, attach_policy_to_user, policy_name, user_name)
+    if backend := get_backend():
+        await backend.detach_policy_from_user(policy_name, user_name)
+    else:
+        await mc_check_call('admin', 'policy', 'detach', config.MINIO_MC_PROFILE, policy_name, '--user', user_name)
+
+
+class _PolicyBatch:
+
+    def __init__(self):
+        self.policy_names = []
+        # set to True if the merged call succeeded
+        self.future = asyncio.get_running_loop().create_future()
+        self.num_waiters = 0
+
+
+# pending coalesced policy changes by (operation, user name)
+_policy_batches = {}
+
+
+async def _coalesce_policy_change(op, policy_names, user_name, execute):
+    # the first caller waits for the coalesce window and executes the merged policies of all the callers,
+    # if the merged call fails each caller retries its own policies separately so a failure doesn't affect other requests
+    window = config.MINIO_POLICY_COALESCE_WINDOW_SECONDS
+    if window <= 0:
+        return await execute(policy_names, user_name)
+    key = (op, user_name)
+    batch = _policy_batches.get(key)
+    if batch is not None:
+        batch.policy_names.extend(p for p in policy_names if p not in batch.policy_names)
+        batch.num_waiters += 1
+        if not await asyncio.shield(batch.future):
+            await execute(policy_names, user_name)
+        return
+    batch = _policy_batches[key] = _PolicyBatch()
+    batch.policy_names.extend(policy_names)
+    try:
+        try:
+            await asyncio.sleep(window)
+        finally:
+            del _policy_batches[key]
+        await execute(batch.policy_names, user_name)
+    except Exception:
+        batch.future.set_result(False)
+        if not batch.num_waiters:
+            raise
+        await execute(policy_names, user_name)
+    except BaseException:
+        batch.future.set_result(False)
+        raise
+    else:
+        batch.future.set_result(True)
+
+
+async def _attach_policies_to_user(policy_names, user_name):
+    if backend := get_backend():
+        await backend.attach_policies_to_user(policy_names, user_name)
+    else:
+        await mc_check_call('admin', 'policy', 'attach', config.MINIO_MC_PROFILE, *policy_names, '--user', user_name, operation='admin_policy_attach_batch')
+
+
+async def _detach_policies_from_user(policy_names, user_name):
+    if backend := get_backend():
+        await backend.detach_policies_from_user(policy_names, user_name)
+    else:
+        await mc_check_call('admin', 'policy', 'detach', config.MINIO_MC_PROFILE, *policy_names, '--user', user_name, operation='admin_policy_detach_batch')
+
+
+async def attach_policies_to_user(policy_names, user_name, exit_stack=None):
+    # attaches several policies with a single call, the compensation detaches all of them
+    if defer('attach_policies_to_user', policy_names, user_name):
+        return
+    if exit_stack:
+        exit_stack.push_async_callback(scheduler.run_compensation, detach_policies_from_user, policy_names, user_name)
+    await _coalesce_policy_change('attach', policy_names, user_name, _attach_policies_to_user)
+
+
+async def detach_policies_from_user(policy_names, user_name, exit_stack=None):
+    if defer('detach_policies_from_user', policy_names, user_name):
+        return
+    if exit_stack:
+        exit_stack.push_async_callback(scheduler.run_compensation, attach_policies_to_user, policy_names, user_name)
+    await _coalesce_policy_change('detach', policy_names, user_name, _detach_policies_from_user)
+
+
+async def add_users_to_group(group_name, user_names, exit_stack=None):
+    # creates the group if it doesn't exist
+    if defer('add_users_to_group', group_name, user_names):
+        return
     if exit_stack:
-        exit_stack.push_async_callback(attach_policy_to_user, policy_name, user_name)
-    await mc_check_call('admin', 'policy', 'detach', config.MINIO_MC_PROFILE, policy_name, '--user', user_name)
+        exit_stack.push_async_callback(scheduler.run_compensation, remove_users_from_group, group_name, user_names)
+    if backend := get_backend():
+        await backend.update_group_members(group_name, user_names)
+    else:
+        await mc_check_call('admin', 'group', 'add', config.MINIO_MC_PROFILE, group_name, *user_names)
+
+
+async def remove_users_from_group(group_name, user_names, exit_stack=None):
+    # removing a group without specifying members deletes the group, so members must be specified here
+    assert user_names, 'At least one user must be specified'
+    if defer('remove_users_from_group', group_name, user_names):
+        return
+    if exit_stack:
+        exit_stack.push_async_callback(scheduler.run_compensation, add_users_to_group, group_name, user_names)
+    if backend := get_backend():
+        await backend.update_group_members(group_name, user_names, is_remove=True)
+    else:
+        await mc_check_call('admin', 'group', 'rm', config.MINIO_MC_PROFILE, group_name, *user_names)
+
+
+async def create_group(group_name, user_names, exit_stack=None):
+    # MinIO groups can't be empty, they are created by adding the first members
+    assert user_names, 'At least one user must be specified'
+    if defer('create_group', group_name, user_names):
+        return
+    if exit_stack:
+        exit_stack.push_async_callback(scheduler.run_compensation, delete_group, group_name, user_names)
+    await add_users_to_group(group_name, user_names)
+
+
+async def delete_group(group_name, user_names=()):
+    # MinIO only deletes empty groups, policies attached to the group are detached with it
+    if defer('delete_group', group_name, user_names):
+        return
+    if user_names:
+        await remove_users_from_group(group_name, user_names)
+    if backend := get_backend():
+        await backend.update_group_members(group_name, [], is_remove=True)
+    else:
+        await mc_check_call('admin', 'group', 'rm', config.MINIO_MC_PROFILE, group_name)
+
+
+async def set_group_status(group_name, enabled, exit_stack=None):
+    if defer('set_group_status', group_name, enabled):
+        return
+    if exit_stack:
+        exit_stack.push_async_callback(scheduler.run_compensation, set_group_status, group_name, not enabled)
+    if backend := get_backend():
+        await backend.set_group_status(group_name, enabled)
+    else:
+        await mc_check_call('admin', 'group', 'enable' if enabled else 'disable', config.MINIO_MC_PROFILE, group_name)
+
+
+async def attach_policy_to_group(policy_name, group_name, exit_stack=None):
+    if defer('attach_policy_to_group', policy_name, group_name):
+        return
+    if exit_stack:
+        exit_stack.push_async_callback(scheduler.run_compensation, detach_policy_from_group, policy_name, group_name)
+    if backend := get_backend():
+        await backend.attach_policy_to_group(policy_name, group_name)
+    else:
+        await mc_check_call('admin', 'policy', 'attach', config.MINIO_MC_PROFILE, policy_name, '--group', group_name)
+
+
+async def detach_policy_from_group(policy_name, group_name, exit_stack=None):
+    if defer('detach_policy_from_group', policy_name, group_name):
+        return
+    if exit_stack:
+        exit_stack.push_async_callback(scheduler.run_compensation, attach_policy_to_group, policy_name, group_name)
+    if backend := get_backend():
+        await backend.detach_policy_from_group(policy_name, group_name)
+    else:
+        await mc_check_call('admin', 'policy', 'detach', config.MINIO_MC_PROFILE, policy_name, '--group', group_name)
 
 
 async def bucket_anonymous_set_download(bucket_name, exit_stack=None):
+    if defer('bucket_anonymous_set_download', bucket_name):
+        return
     if exit_stack:
-        exit_stack.push_async_callback(bucket_anonymous_set_none, bucket_name)
-    await mc_check_call('anonymous', 'set', 'download', f'{config.MINIO_MC_PROFILE}/{bucket_name}')
+        exit_stack.push_async_callback(scheduler.run_compensation, bucket_anonymous_set_none, bucket_name)
+    if backend := get_backend():
+        await backend.bucket_anonymous_set_download(bucket_name)
+    else:
+        await mc_check_call('anonymous', 'set', 'download', f'{config.MINIO_MC_PROFILE}/{bucket_name}')
 
 
 async def bucket_anonymous_set_none(bucket_name, exit_stack=None):
+    if defer('bucket_anonymous_set_none', bucket_name):
+        return
     if exit_stack:
-        exit_stack.push_async_callback(bucket_anonymous_set_download, bucket_name)
-    await mc_check_call('anonymous', 'set', 'none', f'{config.MINIO_MC_PROFILE}/{bucket_name}')
+        exit_stack.push_async_callback(scheduler.run_compensation, bucket_anonymous_set_download, bucket_name)
+    if backend := get_backend():
+        await backend.bucket_anonymous_set_none(bucket_name)
+    else:
+        await mc_check_call('anonymous', 'set', 'none', f'{config.MINIO_MC_PROFILE}/{bucket_name}')
 
 
 async def get_bucket_size(bucket_name):
+    if backend := get_backend():
+        return await backend.get_bucket_size(bucket_name)
     stat = orjson.loads(await mc_check_output('stat', f'{config.MINIO_MC_PROFILE}/{bucket_name}', '--json'))
     return stat.get('Usage', {}).get('size')
+
+
+async def get_buckets_sizes(bucket_names):
+    # returns dict of bucket name to size in bytes, size is None for buckets which failed to get size (e.g. don't exist)
+    if backend := get_backend():
+        return await backend.get_buckets_sizes(bucket_names)
+    sizes = await common.async_run_window((get_bucket_size(bucket_name) for bucket_name in bucket_names), return_exceptions=True)
+    return {
+        bucket_name: None if isinstance(size, Exception) else size
+        for bucket_name, size in zip(bucket_names, sizes)
+    }
@@ -0,0 +1,69 @@
+import logging
+
+from .. import common
+from . import scheduler
+
+
+def _callback_name(callback, args):
+    if callback is scheduler.run_compensation and args:
+        callback, args = args[0], args[1:]
+    return f'{getattr(callback, "__name__", callback)}({", ".join(map(str, args))})'
+
+
+class CompensationStack:
+    # replacement of contextlib.AsyncExitStack for compensations (push_async_callback / pop_all / aclose),
+    # consecutive callbacks of the same function are independent of each other (e.g. detach policies from different users,
+    # delete different policies), so each such group runs concurrently, the groups run in LIFO order so ordering
+    # dependencies are kept (e.g. policies are deleted before the bucket).
+    # failed compensations don't hide the original exception, they are logged and added to it as a note
+
+    def __init__(self):
+        self._callbacks = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        failed = await self.aclose()
+        if failed:
+            message = 'Failed compensations:\n' + '\n'.join(f'{name}: {common.format_error(e)}' for name, e in failed)
+            if exc is None:
+                raise Exception(message)
+            exc.add_note(message)
+        return False
+
+    def push_async_callback(self, callback, *args, **kwargs):
+        self._callbacks.append((callback, args, kwargs))
+        return callback
+
+    def pop_all(self):
+        stack = CompensationStack()
+        stack._callbacks, self._callbacks = self._callbacks, []
+        return stack
+
+    def groups(self):
+        groups = []
+        for callback, args, kwargs in reversed(self._callbacks):
+            key = args[0] if callback is scheduler.run_compensation and args else callback
+            if groups and groups[-1][0] == key:
+                groups[-1][1].append((callback, args, kwargs))
+            else:
+                groups.append((key, [(callback, args, kwargs)]))
+        return [group for _, group in groups]
+
+    async def aclose(self):
+        # runs all the compensations, returns list of (name, exception) of the failed compensations
+        groups = self.groups()
+        self._callbacks = []
+        failed = []
+        for group in groups:
+            results = await common.async_run_window(
+                (callback(*args, **kwargs) for callback, args, kwargs in group),
+                return_exceptions=True,
+            )
+            for (callback, args, kwargs), result in zip(group, results):
+                if isinstance(result, BaseException):
+                    name = _callback_name(callback, args)
+                    logging.error(f'Compensation {name} failed: {common.format_error(result)}')
+                    failed.append((name, result))
+        return failed
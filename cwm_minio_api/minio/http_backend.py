@@ -0,0 +1,325 @@
+import os
+import hmac
+import asyncio
+import hashlib
+import logging
+import time
+import datetime
+from urllib.parse import quote
+from xml.etree import ElementTree
+
+import httpx
+import orjson
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+from .. import config, common
+from . import scheduler
+from ..metrics.prometheus import MINIO_HTTP_CALLS_TOTAL, MINIO_HTTP_CALL_DURATION_SECONDS
+
+
+ADMIN_API_PREFIX = '/minio/admin/v3'
+
+# madmin-go encrypted payload format (see madmin-go encrypt.go and sio-go):
+# salt (32 bytes) | AEAD ID (1 byte) | nonce (8 bytes) | 16 KiB chunks encrypted with AES-256-GCM + 16 bytes tag
+# we use the PBKDF2 + AES-GCM variant which MinIO always accepts and is much cheaper than Argon2id
+_MADMIN_PBKDF2_AES_GCM_ID = b'\x02'
+_MADMIN_PBKDF2_COST = 8192
+_MADMIN_CHUNK_SIZE = 16 * 1024
+
+_client = None
+_client_loop = None
+
+
+class MinioHttpException(Exception):
+
+    def __init__(self, op, status_code, code, message):
+        super().__init__(f'{op}: {status_code} {code}: {message}')
+        self.status_code = status_code
+        self.code = code
+
+
+def madmin_encrypt_data(password, data):
+    salt = os.urandom(32)
+    nonce = os.urandom(8)
+    aead = AESGCM(hashlib.pbkdf2_hmac('sha256', password.encode(), salt, _MADMIN_PBKDF2_COST, 32))
+    additional_data = b'\x00' + aead.encrypt(nonce + (0).to_bytes(4, 'little'), b'', None)
+    res = [salt, _MADMIN_PBKDF2_AES_GCM_ID, nonce]
+    offsets = range(0, len(data), _MADMIN_CHUNK_SIZE) or [0]
+    for seq_num, offset in enumerate(offsets, start=1):
+        if offset == offsets[-1]:
+            additional_data = b'\x80' + additional_data[1:]
+        res.append(aead.encrypt(nonce + seq_num.to_bytes(4, 'little'), data[offset:offset + _MADMIN_CHUNK_SIZE], additional_data))
+    return b''.join(res)
+
+
+def _sigv4_hmac(key, msg):
+    return hmac.new(key, msg.encode(), hashlib.sha256).digest()
+
+
+def sigv4_headers(method, host, path, canonical_query, payload_hash, access_key, secret_key, region, now=None, service='s3'):
+    now = now or datetime.datetime.now(datetime.UTC)
+    amz_date = now.strftime('%Y%m%dT%H%M%SZ')
+    date_stamp = amz_date[:8]
+    headers = {
+        'host': host,
+        'x-amz-content-sha256': payload_hash,
+        'x-amz-date': amz_date,
+    }
+    signed_headers = ';'.join(sorted(headers))
+    canonical_request = '\n'.join([
+        method,
+        quote(path, safe='/-_.~'),
+        canonical_query,
+        ''.join(f'{k}:{headers[k]}\n' for k in sorted(headers)),
+        signed_headers,
+        payload_hash,
+    ])
+    scope = f'{date_stamp}/{region}/{service}/aws4_request'
+    string_to_sign = '\n'.join([
+        'AWS4-HMAC-SHA256',
+        amz_date,
+        scope,
+        hashlib.sha256(canonical_request.encode()).hexdigest(),
+    ])
+    signing_key = _sigv4_hmac(_sigv4_hmac(_sigv4_hmac(_sigv4_hmac(f'AWS4{secret_key}'.encode(), date_stamp), region), service), 'aws4_request')
+    signature = hmac.new(signing_key, string_to_sign.encode(), hashlib.sha256).hexdigest()
+    headers['authorization'] = f'AWS4-HMAC-SHA256 Credential={access_key}/{scope}, SignedHeaders={signed_headers}, Signature={signature}'
+    return headers
+
+
+def get_client():
+    global _client, _client_loop
+    loop = asyncio.get_running_loop()
+    if _client is None or _client_loop is not loop:
+        # the client's connection pool is bound to the event loop it was created in
+        _client = httpx.AsyncClient(
+            base_url=config.MINIO_HTTP_URL,
+            limits=httpx.Limits(
+                max_connections=config.MINIO_HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=config.MINIO_HTTP_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=config.MINIO_HTTP_KEEPALIVE_EXPIRY_SECONDS,
+            ),
+            timeout=config.MINIO_HTTP_TIMEOUT_SECONDS,
+        )
+        _client_loop = loop
+    return _client
+
+
+async def close():
+    global _client, _client_loop
+    if _client is not None:
+        client, _client, _client_loop = _client, None, None
+        await client.aclose()
+
+
+async def http_check_call(op, method, path, query=None, body=b'', headers=None, allowed_error_codes=(), return_output=False):
+    logging.debug(f'http_check_call({op} {method} {path} {query or ""})')
+    async with scheduler.admission_slot(op):
+        start = time.perf_counter()
+        outcome = 'error'
+        try:
+            client = get_client()
+            canonical_query = '&'.join(
+                f'{quote(k, safe="-_.~")}={quote(v, safe="-_.~")}'
+                for k, v in sorted((query or {}).items())
+            )
+            request_headers = {
+                **(headers or {}),
+                **sigv4_headers(
+                    method, client.base_url.netloc.decode(), path, canonical_query, hashlib.sha256(body).hexdigest(),
+                    config.MINIO_HTTP_ACCESS_KEY, config.MINIO_HTTP_SECRET_KEY, config.MINIO_HTTP_REGION,
+                ),
+            }
+            url = quote(path, safe='/-_.~') + (f'?{canonical_query}' if canonical_query else '')
+            timeout = common.get_remaining_seconds(config.MINIO_HTTP_TIMEOUT_SECONDS)
+            try:
+                res = await client.request(method, url, content=body, headers=request_headers, timeout=timeout)
+            except httpx.TimeoutException as e:
+                raise common.DeadlineExceededException(f'{op} timed out after {timeout:.1f}s: {e}')
+            if res.status_code >= 300:
+                code, message = _parse_error(res)
+                if code not in allowed_error_codes:
+                    raise MinioHttpException(op, res.status_code, code, message)
+            outcome = 'success'
+            try:
+                MINIO_HTTP_CALLS_TOTAL.labels(operation=op, outcome="success").inc()
+            except Exception:
+                pass
+            return res.content if return_output else None
+        except Exception:
+            try:
+                MINIO_HTTP_CALLS_TOTAL.labels(operation=op, outcome="error").inc()
+            except Exception:
+                pass
+            raise
+        finally:
+            try:
+                MINIO_HTTP_CALL_DURATION_SECONDS.labels(operation=op, outcome=outcome).observe(time.perf_counter() - start)
+            except Exception:
+                pass
+
+
+def _parse_error(res):
+    # admin API returns JSON errors, S3 API returns XML errors, HEAD requests have no body at all
+    text = res.text.strip()
+    if text.startswith('{'):
+        try:
+            data = orjson.loads(text)
+            return data.get('Code'), data.get('Message')
+        except orjson.JSONDecodeError:
+            pass
+    elif '<Code>' in text:
+        return text.split('<Code>', 1)[1].split('</Code>', 1)[0], text
+    return None, text
+
+
+def _admin_encrypted_body(data):
+    return madmin_encrypt_data(config.MINIO_HTTP_SECRET_KEY, orjson.dumps(data))
+
+
+async def create_bucket(name):
+    await http_check_call('mb', 'PUT', f'/{name}')
+
+
+async def delete_bucket(name):
+    await http_check_call('rb', 'DELETE', f'/{name}', headers={'x-minio-force-delete': 'true'})
+
+
+async def bucket_exists(name):
+    await http_check_call('ls', 'HEAD', f'/{name}')
+
+
+async def create_policy(name, policy_json):
+    await http_check_call('admin_policy_create', 'PUT', f'{ADMIN_API_PREFIX}/add-canned-policy', {'name': name}, policy_json.encode())
+
+
+async def delete_policy(name):
+    await http_check_call('admin_policy_rm', 'DELETE', f'{ADMIN_API_PREFIX}/remove-canned-policy', {'name': name})
+
+
+async def create_user(user, password):
+    await http_check_call(
+        'admin_user_add', 'PUT', f'{ADMIN_API_PREFIX}/add-user', {'accessKey': user},
+        _admin_encrypted_body({'secretKey': password, 'status': 'enabled'}),
+    )
+
+
+async def delete_user(user):
+    await http_check_call('admin_user_rm', 'DELETE', f'{ADMIN_API_PREFIX}/remove-user', {'accessKey': user})
+
+
+async def set_user_status(user_name, enabled):
+    await http_check_call(
+        f'admin_user_{"enable" if enabled else "disable"}', 'PUT', f'{ADMIN_API_PREFIX}/set-user-status',
+        {'accessKey': user_name, 'status': 'enabled' if enabled else 'disabled'},
+    )
+
+
+async def attach_policy_to_user(policy_name, user_name):
+    await http_check_call(
+        'admin_policy_attach', 'POST', f'{ADMIN_API_PREFIX}/idp/builtin/policy/attach', body=_admin_encrypted_body({'policies': [policy_name], 'user': user_name}),
+    )
+
+
+async def detach_policy_from_user(policy_name, user_name):
+    # same as mc - detaching a policy which is not attached is not an error
+    await http_check_call(
+        'admin_policy_detach', 'POST', f'{ADMIN_API_PREFIX}/idp/builtin/policy/detach', body=_admin_encrypted_body({'policies': [policy_name], 'user': user_name}),
+        allowed_error_codes=('XMinioAdminPolicyChangeAlreadyApplied',),
+    )
+
+
+async def attach_policies_to_user(policy_names, user_name):
+    await http_check_call(
+        'admin_policy_attach_batch', 'POST', f'{ADMIN_API_PREFIX}/idp/builtin/policy/attach', body=_admin_encrypted_body({'policies': list(policy_names), 'user': user_name}),
+    )
+
+
+async def detach_policies_from_user(policy_names, user_name):
+    # same as mc - detaching a policy which is not attached is not an error
+    await http_check_call(
+        'admin_policy_detach_batch', 'POST', f'{ADMIN_API_PREFIX}/idp/builtin/policy/detach', body=_admin_encrypted_body({'policies': list(policy_names), 'user': user_name}),
+        allowed_error_codes=('XMinioAdminPolicyChangeAlreadyApplied',),
+    )
+
+
+async def update_group_members(group_name, user_names, is_remove=False):
+    # adding members creates the group, removing without members deletes the group
+    op = 'admin_group_rm' if is_remove else 'admin_group_add'
+    await http_check_call(
+        op, 'PUT', f'{ADMIN_API_PREFIX}/update-group-members',
+        body=orjson.dumps({'group': group_name, 'members': list(user_names), 'isRemove': is_remove}),
+    )
+
+
+async def set_group_status(group_name, enabled):
+    status = 'enabled' if enabled else 'disabled'
+    await http_check_call(
+        f'admin_group_{"enable" if enabled else "disable"}', 'PUT', f'{ADMIN_API_PREFIX}/set-group-status',
+        {'group': group_name, 'status': status},
+    )
+
+
+async def attach_policy_to_group(policy_name, group_name):
+    await http_check_call(
+        'admin_policy_attach', 'POST', f'{ADMIN_API_PREFIX}/idp/builtin/policy/attach', body=_admin_encrypted_body({'policies': [policy_name], 'group': group_name}),
+    )
+
+
+async def detach_policy_from_group(policy_name, group_name):
+    await http_check_call(
+        'admin_policy_detach', 'POST', f'{ADMIN_API_PREFIX}/idp/builtin/policy/detach', body=_admin_encrypted_body({'policies': [policy_name], 'group': group_name}),
+        allowed_error_codes=('XMinioAdminPolicyChangeAlreadyApplied',),
+    )
+
+
+async def bucket_anonymous_set_download(bucket_name):
+    # equivalent to the policy generated by `mc anonymous set download`
+    policy = {
+        'Version': '2012-10-17',
+        'Statement': [
+            {
+                'Effect': 'Allow',
+                'Principal': {'AWS': ['*']},
+                'Action': ['s3:GetBucketLocation', 's3:ListBucket'],
+                'Resource': [f'arn:aws:s3:::{bucket_name}'],
+            },
+            {
+                'Effect': 'Allow',
+                'Principal': {'AWS': ['*']},
+                'Action': ['s3:GetObject'],
+                'Resource': [f'arn:aws:s3:::{bucket_name}/*'],
+            },
+        ],
+    }
+    await http_check_call('anonymous_set_download', 'PUT', f'/{bucket_name}', {'policy': ''}, orjson.dumps(policy))
+
+
+async def bucket_anonymous_set_none(bucket_name):
+    await http_check_call('anonymous_set_none', 'DELETE', f'/{bucket_name}', {'policy': ''})
+
+
+async def get_data_usage_info():
+    return orjson.loads(await http_check_call('admin_datausageinfo', 'GET', f'{ADMIN_API_PREFIX}/datausageinfo', return_output=True))
+
+
+async def list_buckets():
+    res = ElementTree.fromstring(await http_check_call('list_buckets', 'GET', '/', return_output=True))
+    return [el.text for el in res.iter() if el.tag.endswith('}Name') or el.tag == 'Name']
+
+
+async def get_buckets_sizes(bucket_names):
+    # one call to list the existing buckets and one call to get usage of all buckets
+    existing_bucket_names = set(await list_buckets())
+    buckets_usage = (await get_data_usage_info()).get('bucketsUsageInfo') or {}
+    return {
+        bucket_name: ((buckets_usage.get(bucket_name) or {}).get('size', 0) if bucket_name in existing_bucket_names else None)
+        for bucket_name in bucket_names
+    }
+
+
+async def get_bucket_size(bucket_name):
+    # like mc stat - fails for a missing bucket, size is 0 until the scanner reports usage for the bucket
+    await bucket_exists(bucket_name)
+    usage = await get_data_usage_info()
+    return ((usage.get('bucketsUsageInfo') or {}).get(bucket_name) or {}).get('size', 0)
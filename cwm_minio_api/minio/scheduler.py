@@ -0,0 +1,164 @@
+import time
+import heapq
+import asyncio
+import itertools
+import contextvars
+from contextlib import asynccontextmanager
+
+from .. import config, common
+from ..metrics.prometheus import MINIO_QUEUE_DEPTH, MINIO_QUEUE_WAIT_SECONDS, MINIO_IN_FLIGHT
+
+
+# lower value is scheduled first
+PRIORITY_COMPENSATION = 0
+PRIORITY_MUTATION = 1
+PRIORITY_READ = 2
+
+PRIORITY_NAMES = {
+    PRIORITY_COMPENSATION: 'compensation',
+    PRIORITY_MUTATION: 'mutation',
+    PRIORITY_READ: 'read',
+}
+
+READ_OPERATIONS = {'stat', 'ls', 'admin_datausageinfo', 'list_buckets'}
+
+# set while running compensations (rollback callbacks) so that all the MinIO calls they make get the highest priority
+current_priority = contextvars.ContextVar('minio_scheduler_priority', default=None)
+
+
+def get_operation_priority(op):
+    priority = current_priority.get()
+    if priority is not None:
+        return priority
+    return PRIORITY_READ if op in READ_OPERATIONS else PRIORITY_MUTATION
+
+
+async def run_compensation(callback, *args, **kwargs):
+    from . import api as minio_api
+    # compensations also run after the request deadline expired, only the per call timeouts apply
+    token = current_priority.set(PRIORITY_COMPENSATION)
+    deadline_token = common.request_deadline.set(None)
+    # compensations undo MinIO changes which were already executed, they are never deferred to the outbox
+    # (the deferred operations of a failed transaction are not committed)
+    deferred_token = minio_api.deferred_operations.set(None)
+    try:
+        return await callback(*args, **kwargs)
+    finally:
+        minio_api.deferred_operations.reset(deferred_token)
+        common.request_deadline.reset(deadline_token)
+        current_priority.reset(token)
+
+
+class AdmissionController:
+
+    def __init__(self, max_in_flight, max_queue_wait_seconds):
+        self.max_in_flight = max_in_flight
+        self.max_queue_wait_seconds = max_queue_wait_seconds
+        self.in_flight = 0
+        self.avg_duration_seconds = 0.0
+        self._queue = []
+        self._seq = itertools.count()
+
+    def _update_metrics(self):
+        try:
+            depths = {priority: 0 for priority in PRIORITY_NAMES}
+            for priority, _, future in self._queue:
+                if not future.done():
+                    depths[priority] += 1
+            for priority, depth in depths.items():
+                MINIO_QUEUE_DEPTH.labels(priority=PRIORITY_NAMES[priority]).set(depth)
+            MINIO_IN_FLIGHT.set(self.in_flight)
+        except Exception:
+            pass
+
+    def _observe_wait(self, priority, outcome, start_time):
+        try:
+            MINIO_QUEUE_WAIT_SECONDS.labels(priority=PRIORITY_NAMES[priority], outcome=outcome).observe(time.perf_counter() - start_time)
+        except Exception:
+            pass
+
+    def estimate_queue_wait_seconds(self, priority):
+        ahead = sum(1 for p, _, future in self._queue if p <= priority and not future.done())
+        return (ahead // self.max_in_flight + 1) * self.avg_duration_seconds
+
+    async def _acquire(self, priority):
+        if self.in_flight < self.max_in_flight and not self._queue:
+            self.in_flight += 1
+            return
+        start_time = time.perf_counter()
+        # compensations are never shed, failing them would leave partial changes in MinIO
+        can_shed = priority != PRIORITY_COMPENSATION
+        if can_shed and self.estimate_queue_wait_seconds(priority) > self.max_queue_wait_seconds:
+            self._observe_wait(priority, 'shed', start_time)
+            raise common.ServerOverloadedException('MinIO operations queue is full, try again later')
+        # queued operations don't wait beyond the request deadline
+        wait_seconds = common.get_remaining_seconds(self.max_queue_wait_seconds) if can_shed else None
+        future = asyncio.get_running_loop().create_future()
+        item = (priority, next(self._seq), future)
+        heapq.heappush(self._queue, item)
+        self._update_metrics()
+        try:
+            if can_shed:
+                await asyncio.wait_for(asyncio.shield(future), timeout=wait_seconds)
+            else:
+                await future
+        except BaseException as e:
+            if future.done() and not future.cancelled():
+                # slot was already handed to us, pass it on
+                self._release()
+            else:
+                future.cancel()
+                self._queue.remove(item)
+                heapq.heapify(self._queue)
+                self._update_metrics()
+            if isinstance(e, TimeoutError):
+                self._observe_wait(priority, 'timeout', start_time)
+                if wait_seconds is not None and wait_seconds < self.max_queue_wait_seconds:
+                    raise common.DeadlineExceededException('Request deadline exceeded waiting for MinIO operations queue')
+                raise common.ServerOverloadedException('Timeout waiting for MinIO operations queue, try again later')
+            raise
+        self._observe_wait(priority, 'admitted', start_time)
+
+    def _release(self):
+        while self._queue:
+            _, _, future = heapq.heappop(self._queue)
+            if not future.done():
+                # hand the slot over directly to the next waiter, in_flight stays the same
+                future.set_result(None)
+                self._update_metrics()
+                return
+        self.in_flight -= 1
+        self._update_metrics()
+
+    @asynccontextmanager
+    async def slot(self, op):
+        priority = get_operation_priority(op)
+        await self._acquire(priority)
+        self._update_metrics()
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start_time
+            self.avg_duration_seconds = duration if not self.avg_duration_seconds else 0.9 * self.avg_duration_seconds + 0.1 * duration
+            self._release()
+
+
+_controller = None
+
+
+def get_controller():
+    global _controller
+    if _controller is None:
+        _controller = AdmissionController(config.MINIO_MAX_IN_FLIGHT, config.MINIO_MAX_QUEUE_WAIT_SECONDS)
+    return _controller
+
+
+@asynccontextmanager
+async def admission_slot(op):
+    common.count_operation('minio_calls')
+    if config.MINIO_MAX_IN_FLIGHT > 0:
+        async with get_controller().slot(op):
+            yield
+    else:
+        yield
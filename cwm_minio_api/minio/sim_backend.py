@@ -0,0 +1,213 @@
+import random
+import asyncio
+import logging
+
+from .. import config
+from . import scheduler
+from .http_backend import MinioHttpException
+
+
+# in-memory stand-in for MinIO used for offline tests and benchmarks (MINIO_API_BACKEND=sim),
+# implements the same functions as http_backend and fails with the same error codes as MinIO,
+# the state is per worker process and is lost on restart
+_state = None
+
+
+class _State:
+
+    def __init__(self):
+        # bucket name: {'anonymous': bool, 'size': int}
+        self.buckets = {}
+        # policy name: policy json
+        self.policies = {}
+        # user name: {'secret_key': str, 'enabled': bool, 'policies': set}
+        self.users = {}
+        # group name: {'members': set, 'enabled': bool, 'policies': set}
+        self.groups = {}
+        # operation name: number of calls
+        self.calls = {}
+
+
+def get_state():
+    global _state
+    if _state is None:
+        _state = _State()
+    return _state
+
+
+def reset():
+    global _state
+    _state = None
+
+
+def _get_latency(op):
+    # latency distribution of the operation: [mean seconds, standard deviation seconds]
+    mean, stddev = config.MINIO_SIM_LATENCY.get(op, config.MINIO_SIM_LATENCY.get('default', (0, 0)))
+    return max(0.0, random.gauss(mean, stddev)) if stddev else mean
+
+
+async def _call(op):
+    logging.debug(f'sim_call({op})')
+    async with scheduler.admission_slot(op):
+        latency = _get_latency(op)
+        if latency:
+            await asyncio.sleep(latency)
+        state = get_state()
+        state.calls[op] = state.calls.get(op, 0) + 1
+        if random.random() < config.MINIO_SIM_FAILURE_RATES.get(op, config.MINIO_SIM_FAILURE_RATES.get('default', 0)):
+            raise MinioHttpException(op, 503, 'XMinioServerNotInitialized', 'Simulated failure')
+        return state
+
+
+def _get_bucket(op, state, name):
+    if name not in state.buckets:
+        raise MinioHttpException(op, 404, 'NoSuchBucket', f'The specified bucket does not exist: {name}')
+    return state.buckets[name]
+
+
+def _get_user(op, state, name):
+    if name not in state.users:
+        raise MinioHttpException(op, 404, 'XMinioAdminNoSuchUser', f'The specified user does not exist: {name}')
+    return state.users[name]
+
+
+def _get_group(op, state, name):
+    if name not in state.groups:
+        raise MinioHttpException(op, 404, 'XMinioAdminNoSuchGroup', f'The specified group does not exist: {name}')
+    return state.groups[name]
+
+
+def _check_policies(op, state, policy_names):
+    for policy_name in policy_names:
+        if policy_name not in state.policies:
+            raise MinioHttpException(op, 404, 'XMinioAdminNoSuchPolicy', f'The canned policy does not exist: {policy_name}')
+
+
+async def create_bucket(name):
+    state = await _call('mb')
+    if name in state.buckets:
+        raise MinioHttpException('mb', 409, 'BucketAlreadyOwnedByYou', f'Your previous request to create the named bucket succeeded and you already own it: {name}')
+    state.buckets[name] = {'anonymous': False, 'size': 0}
+
+
+async def delete_bucket(name):
+    state = await _call('rb')
+    _get_bucket('rb', state, name)
+    del state.buckets[name]
+
+
+async def bucket_exists(name):
+    _get_bucket('ls', await _call('ls'), name)
+
+
+async def create_policy(name, policy_json):
+    state = await _call('admin_policy_create')
+    state.policies[name] = policy_json
+
+
+async def delete_policy(name):
+    state = await _call('admin_policy_rm')
+    if name not in state.policies:
+        raise MinioHttpException('admin_policy_rm', 404, 'XMinioAdminNoSuchPolicy', f'The canned policy does not exist: {name}')
+    del state.policies[name]
+    for entity in (*state.users.values(), *state.groups.values()):
+        entity['policies'].discard(name)
+
+
+async def create_user(user, password):
+    state = await _call('admin_user_add')
+    if user in state.users:
+        state.users[user]['secret_key'] = password
+    else:
+        state.users[user] = {'secret_key': password, 'enabled': True, 'policies': set()}
+
+
+async def delete_user(user):
+    state = await _call('admin_user_rm')
+    _get_user('admin_user_rm', state, user)
+    del state.users[user]
+    for group in state.groups.values():
+        group['members'].discard(user)
+
+
+async def set_user_status(user_name, enabled):
+    op = f'admin_user_{"enable" if enabled else "disable"}'
+    _get_user(op, await _call(op), user_name)['enabled'] = enabled
+
+
+def _attach_policies(op, state, entity, policy_names):
+    _check_policies(op, state, policy_names)
+    if set(policy_names) <= entity['policies']:
+        raise MinioHttpException(op, 400, 'XMinioAdminPolicyChangeAlreadyApplied', 'The specified policy change is already in effect.')
+    entity['policies'].update(policy_names)
+
+
+async def attach_policy_to_user(policy_name, user_name):
+    await attach_policies_to_user([policy_name], user_name, op='admin_policy_attach')
+
+
+async def detach_policy_from_user(policy_name, user_name):
+    await detach_policies_from_user([policy_name], user_name, op='admin_policy_detach')
+
+
+async def attach_policies_to_user(policy_names, user_name, op='admin_policy_attach_batch'):
+    state = await _call(op)
+    _attach_policies(op, state, _get_user(op, state, user_name), policy_names)
+
+
+async def detach_policies_from_user(policy_names, user_name, op='admin_policy_detach_batch'):
+    # same as http_backend - detaching a policy which is not attached is not an error
+    state = await _call(op)
+    _get_user(op, state, user_name)['policies'].difference_update(policy_names)
+
+
+async def update_group_members(group_name, user_names, is_remove=False):
+    # adding members creates the group, removing without members deletes the group (only if it's empty)
+    op = 'admin_group_rm' if is_remove else 'admin_group_add'
+    state = await _call(op)
+    if not is_remove:
+        for user_name in user_names:
+            _get_user(op, state, user_name)
+        group = state.groups.setdefault(group_name, {'members': set(), 'enabled': True, 'policies': set()})
+        group['members'].update(user_names)
+    elif user_names:
+        _get_group(op, state, group_name)['members'].difference_update(user_names)
+    else:
+        if _get_group(op, state, group_name)['members']:
+            raise MinioHttpException(op, 400, 'XMinioAdminGroupNotEmpty', f'The specified group is not empty: {group_name}')
+        del state.groups[group_name]
+
+
+async def set_group_status(group_name, enabled):
+    op = f'admin_group_{"enable" if enabled else "disable"}'
+    _get_group(op, await _call(op), group_name)['enabled'] = enabled
+
+
+async def attach_policy_to_group(policy_name, group_name):
+    state = await _call('admin_policy_attach')
+    _attach_policies('admin_policy_attach', state, _get_group('admin_policy_attach', state, group_name), [policy_name])
+
+
+async def detach_policy_from_group(policy_name, group_name):
+    state = await _call('admin_policy_detach')
+    _get_group('admin_policy_detach', state, group_name)['policies'].discard(policy_name)
+
+
+async def bucket_anonymous_set_download(bucket_name):
+    _get_bucket('anonymous_set_download', await _call('anonymous_set_download'), bucket_name)['anonymous'] = True
+
+
+async def bucket_anonymous_set_none(bucket_name):
+    _get_bucket('anonymous_set_none', await _call('anonymous_set_none'), bucket_name)['anonymous'] = False
+
+
+async def get_buckets_sizes(bucket_names):
+    state = await _call('admin_datausageinfo')
+    return {
+        bucket_name: state.buckets[bucket_name]['size'] if bucket_name in state.buckets else None
+        for bucket_name in bucket_names
+    }
+
+
+async def get_bucket_size(bucket_name):
+    return _get_bucket('stat', await _call('stat'), bucket_name)['size']
@@ -0,0 +1,253 @@
+import asyncio
+import logging
+import functools
+
+from psycopg.types.json import Jsonb
+
+from .. import db, config, common
+from ..minio import api as minio_api, http_backend as minio_http_backend
+from ..metrics.prometheus import MINIO_OUTBOX_OPERATIONS_TOTAL
+
+
+# MinIO errors which mean that a retried operation was already applied by a previous attempt:
+# error codes returned by the HTTP backend and a lower case part of the error message returned by mc
+_ERROR_ALREADY_EXISTS = ({'BucketAlreadyOwnedByYou'}, 'already own it')
+_ERROR_NOT_FOUND = ({'NoSuchBucket', 'XMinioAdminNoSuchPolicy', 'XMinioAdminNoSuchUser', 'XMinioAdminNoSuchGroup'}, 'does not exist')
+_ERROR_ALREADY_APPLIED = ({'XMinioAdminPolicyChangeAlreadyApplied'}, 'already in effect')
+
+# operations which can be deferred to the outbox and the errors which are ignored when executing them
+OPERATIONS = {
+    'create_bucket': (_ERROR_ALREADY_EXISTS,),
+    'delete_bucket': (_ERROR_NOT_FOUND,),
+    'create_policy': (),
+    'delete_policy': (_ERROR_NOT_FOUND,),
+    'delete_user': (_ERROR_NOT_FOUND,),
+    'set_user_status': (),
+    'attach_policy_to_user': (_ERROR_ALREADY_APPLIED,),
+    'detach_policy_from_user': (_ERROR_ALREADY_APPLIED, _ERROR_NOT_FOUND),
+    'attach_policies_to_user': (_ERROR_ALREADY_APPLIED,),
+    'detach_policies_from_user': (_ERROR_ALREADY_APPLIED, _ERROR_NOT_FOUND),
+    'add_users_to_group': (),
+    'remove_users_from_group': (_ERROR_NOT_FOUND,),
+    'create_group': (),
+    'delete_group': (_ERROR_NOT_FOUND,),
+    'set_group_status': (),
+    'attach_policy_to_group': (_ERROR_ALREADY_APPLIED,),
+    'detach_policy_from_group': (_ERROR_ALREADY_APPLIED, _ERROR_NOT_FOUND),
+    'bucket_anonymous_set_download': (),
+    'bucket_anonymous_set_none': (),
+}
+
+
+def deferred(func):
+    # when the outbox is enabled, MinIO mutations made by the decorated function are recorded instead of executed,
+    # commit() stores them in the same transaction as the DB changes
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        if not config.MINIO_OUTBOX_ENABLED:
+            return await func(*args, **kwargs)
+        token = minio_api.deferred_operations.set([])
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            minio_api.deferred_operations.reset(token)
+    return wrapper
+
+
+async def commit(conn, cur, resource_key):
+    operations = minio_api.deferred_operations.get()
+    if operations:
+        await cur.execute('''
+            INSERT INTO minio_outbox (resource_key, operations)
+            VALUES (%s, %s)
+        ''', (resource_key, Jsonb(operations)))
+        operations.clear()
+    await conn.commit()
+
+
+def is_already_applied(op, e):
+    for codes, message in OPERATIONS[op]:
+        if isinstance(e, minio_http_backend.MinioHttpException):
+            if e.code in codes:
+                return True
+        elif message in str(e).lower():
+            return True
+    return False
+
+
+def _observe_operation(op, outcome):
+    try:
+        MINIO_OUTBOX_OPERATIONS_TOTAL.labels(operation=op, outcome=outcome).inc()
+    except Exception:
+        pass
+
+
+async def execute_operation(op, args):
+    assert op in OPERATIONS, f'Invalid outbox operation: {op}'
+    try:
+        await getattr(minio_api, op)(*args)
+    except Exception as e:
+        if not is_already_applied(op, e):
+            _observe_operation(op, 'error')
+            raise
+        logging.info(f'Outbox operation {op} was already applied: {e}')
+        _observe_operation(op, 'already_applied')
+    else:
+        _observe_operation(op, 'success')
+
+
+async def claim():
+    async with db.connection_cursor() as (conn, cur):
+        # batches of the same resource are executed in order, a failed batch blocks the following batches until retried
+        await cur.execute('''
+            UPDATE minio_outbox
+            SET attempts = attempts + 1, locked_until = now() + make_interval(secs => %s), updated_at = now()
+            WHERE id = (
+                SELECT id
+                FROM minio_outbox o
+                WHERE status = 'pending' AND next_attempt_at <= now() AND (locked_until IS NULL OR locked_until < now())
+                AND NOT EXISTS (
+                    SELECT 1 FROM minio_outbox prev
+                    WHERE prev.resource_key = o.resource_key AND prev.status != 'done' AND prev.id < o.id
+                )
+                ORDER BY id
+                LIMIT 1
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, operations, next_operation, attempts
+        ''', (config.MINIO_OUTBOX_LEASE_SECONDS,))
+        batch = await cur.fetchone()
+        await conn.commit()
+        return batch
+
+
+class LeaseLostException(Exception):
+    pass
+
+
+async def _update_claimed(batch, set_sql, *params):
+    # fenced by the claimed attempt, once the lease expired and the batch was claimed again only the new owner updates it
+    async with db.connection_cursor() as (conn, cur):
+        await cur.execute(f'''
+            UPDATE minio_outbox
+            SET {set_sql}, updated_at = now()
+            WHERE id = %s AND attempts = %s AND status = 'pending'
+        ''', (*params, batch['id'], batch['attempts']))
+        await conn.commit()
+        return cur.rowcount > 0
+
+
+async def _heartbeat(batch):
+    # extends the lease while the batch is running, a single group of operations can take longer than the lease
+    while True:
+        await asyncio.sleep(config.MINIO_OUTBOX_LEASE_SECONDS / 3)
+        try:
+            if not await _update_claimed(batch, 'locked_until = now() + make_interval(secs => %s)', config.MINIO_OUTBOX_LEASE_SECONDS):
+                return
+        except Exception:
+            logging.exception(f'Outbox batch {batch["id"]} heartbeat failed')
+
+
+async def process(batch):
+    heartbeat = asyncio.create_task(_heartbeat(batch))
+    try:
+        return await _process(batch, heartbeat)
+    finally:
+        heartbeat.cancel()
+
+
+async def _process(batch, heartbeat):
+    operations = batch['operations']
+    next_operation = batch['next_operation']
+    try:
+        while next_operation < len(operations):
+            if heartbeat.done():
+                raise LeaseLostException()
+            # consecutive operations of the same type are independent of each other, so they run concurrently
+            end = next_operation
+            while end < len(operations) and operations[end][0] == operations[next_operation][0]:
+                end += 1
+            await common.async_run_window(
+                execute_operation(op, args)
+                for op, args in operations[next_operation:end]
+            )
+            next_operation = end
+            if not await _update_claimed(
+                batch, 'next_operation = %s, locked_until = now() + make_interval(secs => %s)',
+                next_operation, config.MINIO_OUTBOX_LEASE_SECONDS,
+            ):
+                raise LeaseLostException()
+    except LeaseLostException:
+        logging.warning(f'Outbox batch {batch["id"]} lease was lost (attempt {batch["attempts"]}), stopped processing')
+        return False
+    except Exception as e:
+        logging.exception(f'Outbox batch {batch["id"]} failed (attempt {batch["attempts"]})')
+        status = 'failed' if batch['attempts'] >= config.MINIO_OUTBOX_MAX_ATTEMPTS else 'pending'
+        await _update_claimed(
+            batch, 'status = %s, last_error = %s, locked_until = NULL, next_attempt_at = now() + make_interval(secs => %s)',
+            status, common.format_error(e), min(2 ** batch['attempts'], 300),
+        )
+        return False
+    if not await _update_claimed(batch, "status = 'done', last_error = NULL, locked_until = NULL"):
+        logging.warning(f'Outbox batch {batch["id"]} lease was lost (attempt {batch["attempts"]}) before it was marked done')
+        return False
+    return True
+
+
+async def process_next():
+    batch = await claim()
+    if batch is None:
+        return False
+    await process(batch)
+    return True
+
+
+async def process_pending():
+    # process batches until there are no more batches ready to execute
+    num_batches = 0
+    while await process_next():
+        num_batches += 1
+    return {'processed_batches': num_batches}
+
+
+async def worker_loop():
+    while True:
+        try:
+            if await process_next():
+                continue
+        except Exception:
+            logging.exception('Outbox worker failed')
+        await asyncio.sleep(config.MINIO_OUTBOX_POLL_INTERVAL_SECONDS)
+
+
+async def list_iterator(status=None):
+    async with db.connection_cursor() as (conn, cur):
+        if status:
+            await cur.execute('SELECT * FROM minio_outbox WHERE status = %s ORDER BY id', (status,))
+        else:
+            await cur.execute('SELECT * FROM minio_outbox ORDER BY id')
+        async for row in cur:
+            yield {
+                'id': row['id'],
+                'resource_key': row['resource_key'],
+                'status': row['status'],
+                'operations_done': row['next_operation'],
+                'operations_total': len(row['operations']),
+                'attempts': row['attempts'],
+                'last_error': row['last_error'],
+                'created_at': row['created_at'].isoformat(),
+                'updated_at': row['updated_at'].isoformat(),
+            }
+
+
+async def retry(batch_id):
+    async with db.connection_cursor() as (conn, cur):
+        await cur.execute('''
+            UPDATE minio_outbox
+            SET status = 'pending', attempts = 0, next_attempt_at = now(), updated_at = now()
+            WHERE id = %s AND status = 'failed'
+            RETURNING id
+        ''', (batch_id,))
+        if await cur.fetchone() is None:
+            raise Exception('Failed outbox batch not found')
+        await conn.commit()
@@ -0,0 +1,39 @@
+import asyncclick as click
+from fastapi import APIRouter
+
+from . import api
+from .. import common
+
+
+router = APIRouter()
+
+
+@click.group()
+async def main():
+    pass
+
+
+@main.command(name='list')
+@click.option('--status')
+@router.get('/outbox/list', tags=['outbox'])
+async def list_batches(status: str | None = None):
+    batches = [batch async for batch in api.list_iterator(status)]
+    if common.is_cli():
+        common.cli_print_json(batches)
+        return click.echo(f'Total batches: {len(batches)}', err=True)
+    else:
+        return batches
+
+
+@main.command()
+@click.argument('batch_id', type=int)
+@router.post('/outbox/retry', tags=['outbox'])
+async def retry(batch_id: int):
+    await api.retry(batch_id)
+    return common.cli_print_json({'ok': True})
+
+
+@main.command()
+async def process():
+    # process all pending batches which are ready to execute and exit
+    return common.cli_print_json(await api.process_pending())
@@ -19,6 +19,8 @@ for submodule in [
     'buckets',
     'credentials',
     'tenant',
+    'outbox',
+    'jobs',
     'metrics',
 ]:
     router.include_router(getattr(importlib.import_module(f'.{submodule}.router', __package__), 'router'))
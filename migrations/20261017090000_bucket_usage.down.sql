@@ -0,0 +1,3 @@
+drop table if exists bucket_usage_collector;
+
+drop table if exists bucket_usage;
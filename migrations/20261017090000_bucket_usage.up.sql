@@ -0,0 +1,13 @@
+create table bucket_usage (
+    bucket_name text primary key,
+    size_bytes bigint,
+    updated_at timestamptz not null
+);
+
+-- single row used by the API workers to make sure only one of them runs the periodic usage collection
+create table bucket_usage_collector (
+    id integer primary key,
+    last_run_at timestamptz not null
+);
+
+insert into bucket_usage_collector (id, last_run_at) values (1, 'epoch');
@@ -0,0 +1 @@
+alter table buckets drop column iam_mode;
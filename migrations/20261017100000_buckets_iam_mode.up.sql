@@ -0,0 +1,3 @@
+-- policies - bucket policies are attached to each user directly
+-- groups - bucket policies are attached to per bucket-permission groups which users are members of
+alter table buckets add column iam_mode text not null default 'policies';
@@ -0,0 +1 @@
+drop table minio_outbox;
@@ -0,0 +1,20 @@
+-- MinIO operations recorded by API mutations in the same transaction as their DB changes, executed by the outbox workers
+create table minio_outbox (
+    id bigserial primary key,
+    -- batches with the same resource key are executed in order of id
+    resource_key text not null,
+    -- list of [operation, args]
+    operations jsonb not null,
+    -- index of the next operation to execute, so a retried batch continues where the previous attempt stopped
+    next_operation integer not null default 0,
+    -- pending / done / failed
+    status text not null default 'pending',
+    attempts integer not null default 0,
+    last_error text,
+    next_attempt_at timestamptz not null default now(),
+    locked_until timestamptz,
+    created_at timestamptz not null default now(),
+    updated_at timestamptz not null default now()
+);
+
+create index idx_minio_outbox_status_resource_key on minio_outbox (status, resource_key, id);
@@ -0,0 +1 @@
+drop table jobs;
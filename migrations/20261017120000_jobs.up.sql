@@ -0,0 +1,21 @@
+create table jobs (
+    id bigserial primary key,
+    kind text not null,
+    params jsonb not null,
+    -- same kind and params, used to return the existing job when the same job is submitted again
+    dedupe_key text not null,
+    -- queued / running / done / failed
+    status text not null default 'queued',
+    items_done integer not null default 0,
+    items_total integer not null default 0,
+    attempts integer not null default 0,
+    result jsonb,
+    error text,
+    locked_until timestamptz,
+    created_at timestamptz not null default now(),
+    started_at timestamptz,
+    finished_at timestamptz
+);
+
+create unique index idx_jobs_dedupe_key_active on jobs (dedupe_key) where status in ('queued', 'running');
+create index idx_jobs_status on jobs (status, id);
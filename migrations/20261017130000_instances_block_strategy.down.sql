@@ -0,0 +1 @@
+alter table instances drop column block_strategy;
@@ -0,0 +1,4 @@
+-- strategy which was applied to block the instance, null when not blocked (or blocked before this column was added = policies)
+-- policies - buckets are blocked and policies are detached from the users
+-- users - the instance and credential users are disabled
+alter table instances add column block_strategy text;
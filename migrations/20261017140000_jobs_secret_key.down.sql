@@ -0,0 +1 @@
+alter table jobs drop column secret_key;
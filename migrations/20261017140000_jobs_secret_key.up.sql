@@ -0,0 +1,3 @@
+-- new secret key of an instance update job with reset_access_key, it's not stored in the result
+-- and is cleared when it's fetched (once) or when it expires
+alter table jobs add column secret_key text;
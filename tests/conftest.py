@@ -1,6 +1,7 @@
 import os
 import sys
 import logging
+import functools
 from uuid import uuid1
 
 import pytest
@@ -8,6 +9,7 @@ import pytest
 from cwm_minio_api.common import async_subprocess_check_call
 from cwm_minio_api.config import MINIO_MC_BINARY
 from cwm_minio_api.buckets import api as buckets_api
+from cwm_minio_api import db
 
 
 logging.basicConfig(
@@ -32,6 +34,7 @@ async def test_db(monkeypatch):
         })
         yield
     finally:
+        await db.close_pool()
         await async_subprocess_check_call('docker', 'compose', 'exec', '--user', 'postgres', 'db', 'dropdb', '--force', db_name)
 
 
@@ -45,7 +48,7 @@ async def cwm_test_db(monkeypatch, test_db):
         "tracker": tracker,
     }
 
-    async def mc_check_call(*args):
+    async def mc_check_call(*args, **kwargs):
         nargs = []
         for arg in args:
             if arg.startswith('/'):
@@ -55,9 +58,9 @@ async def cwm_test_db(monkeypatch, test_db):
             nargs.append(arg)
         tracker.append(('mc_check_call', tuple(nargs)))
         if 'intercept' in state:
-            return await state['intercept'](_mc_check_call, "mc_check_call", *args)
+            return await state['intercept'](functools.partial(_mc_check_call, **kwargs), "mc_check_call", *args)
         else:
-            return await _mc_check_call(*args)
+            return await _mc_check_call(*args, **kwargs)
 
     async def mc_check_output(*args):
         tracker.append(('mc_check_output', args))
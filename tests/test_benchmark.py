@@ -0,0 +1,22 @@
+import random
+
+from cwm_minio_api.load_tests import benchmark
+from cwm_minio_api.minio import sim_backend
+
+
+async def test_benchmark(test_db, monkeypatch):
+    random.seed(0)
+    monkeypatch.setattr('cwm_minio_api.config.MINIO_API_BACKEND', 'sim')
+    sim_backend.reset()
+    results = await benchmark.run(concurrency=4, duration_seconds=0, num_operations=60)
+    assert results['total']['count'] == 60
+    assert results['total']['errors'] == 0
+    assert results['total']['db_connections_max_in_use'] >= 1
+    assert all(stats['db_connections_per_op'] >= 1 for stats in results['operations'].values())
+    assert results['operations']['buckets_create']['minio_calls_per_op'] >= 2
+    # all the created resources were deleted
+    state = sim_backend.get_state()
+    assert (state.buckets, state.policies, state.users) == ({}, {}, {})
+    comparison = benchmark.compare(results, results)
+    assert comparison['total']['ops_per_second'] == 0
+    assert 'total' in benchmark.format_results(results, comparison)
@@ -2,6 +2,7 @@ import pytest
 
 from cwm_minio_api.instances import api as instances_api
 from cwm_minio_api.buckets import api as buckets_api
+from cwm_minio_api.buckets import usage as buckets_usage
 from cwm_minio_api import common, config
 from cwm_minio_api.minio import api as minio_api
 from cwm_minio_api.credentials import api as credentials_api
@@ -23,9 +24,7 @@ async def test_crud(cwm_test_db):
         ("mc_check_call", ('admin', 'policy', 'create', 'cwm', f'{bucket_name}_read', cwm_test_db['get_bucket_policy_arg']('read', bucket_name))),
         ("mc_check_call", ('admin', 'policy', 'create', 'cwm', f'{bucket_name}_write', cwm_test_db['get_bucket_policy_arg']('write', bucket_name))),
         ("mc_check_call", ('admin', 'policy', 'create', 'cwm', f'{bucket_name}_delete', cwm_test_db['get_bucket_policy_arg']('delete', bucket_name))),
-        ("mc_check_call", ('admin', 'policy', 'attach', 'cwm', f'{bucket_name}_read', '--user', access_key)),
-        ("mc_check_call", ('admin', 'policy', 'attach', 'cwm', f'{bucket_name}_write', '--user', access_key)),
-        ("mc_check_call", ('admin', 'policy', 'attach', 'cwm', f'{bucket_name}_delete', '--user', access_key)),
+        ("mc_check_call", ('admin', 'policy', 'attach', 'cwm', f'{bucket_name}_read', f'{bucket_name}_write', f'{bucket_name}_delete', '--user', access_key)),
     ]
     assert [bucket_name async for bucket_name in buckets_api.list_iterator(instance_id)] == [bucket_name]
     bucket = await buckets_api.get(instance_id, bucket_name)
@@ -39,10 +38,7 @@ async def test_crud(cwm_test_db):
     assert tw() == [
         ('mc_check_call', ('anonymous', 'set', 'download', f'cwm/{bucket_name}')),
         ('mc_check_call', ('anonymous', 'set', 'none', f'cwm/{bucket_name}')),
-        *[
-            ('mc_check_call', ('admin', 'policy', 'detach', 'cwm', f'{bucket_name}_{p}', '--user', access_key))
-            for p in ['read', 'write', 'delete']
-        ]
+        ('mc_check_call', ('admin', 'policy', 'detach', 'cwm', f'{bucket_name}_read', f'{bucket_name}_write', f'{bucket_name}_delete', '--user', access_key)),
     ]
     assert updated_bucket == {
         **bucket,
@@ -55,10 +51,7 @@ async def test_crud(cwm_test_db):
     await buckets_api.update(instance_id, bucket_name, blocked=False, public=False)
     assert tw() == [
         ('mc_check_call', ('anonymous', 'set', 'none', f'cwm/{bucket_name}')),
-        *[
-            ('mc_check_call', ('admin', 'policy', 'attach', 'cwm', f'{bucket_name}_{p}', '--user', access_key))
-            for p in ['read', 'write', 'delete']
-        ]
+        ('mc_check_call', ('admin', 'policy', 'attach', 'cwm', f'{bucket_name}_read', f'{bucket_name}_write', f'{bucket_name}_delete', '--user', access_key)),
     ]
     with pytest.raises(Exception, match="Credentials not found"):
         await buckets_api.credentials_create(instance_id, bucket_name, "", True, False, True)
@@ -69,8 +62,7 @@ async def test_crud(cwm_test_db):
     ]
     bucket_credentials = await buckets_api.credentials_create(instance_id, bucket_name, credentials_access_key, True, False, True)
     assert tw() == [
-        ('mc_check_call', ('admin', 'policy', 'attach', 'cwm', f'{bucket_name}_{p}', '--user', credentials_access_key))
-        for p in ['read', 'delete']
+        ('mc_check_call', ('admin', 'policy', 'attach', 'cwm', f'{bucket_name}_read', f'{bucket_name}_delete', '--user', credentials_access_key)),
     ]
     assert bucket_credentials == {
         'access_key': credentials_access_key,
@@ -80,14 +72,8 @@ async def test_crud(cwm_test_db):
     }
     await buckets_api.delete(instance_id, bucket_name)
     assert tw() == [
-        *[
-            ('mc_check_call', ('admin', 'policy', 'detach', 'cwm', f'{bucket_name}_{p}', '--user', access_key))
-            for p in ['read', 'write', 'delete']
-        ],
-        *[
-            ('mc_check_call', ('admin', 'policy', 'detach', 'cwm', f'{bucket_name}_{p}', '--user', credentials_access_key))
-            for p in ['read', 'write', 'delete']
-        ],
+        ('mc_check_call', ('admin', 'policy', 'detach', 'cwm', f'{bucket_name}_read', f'{bucket_name}_write', f'{bucket_name}_delete', '--user', access_key)),
+        ('mc_check_call', ('admin', 'policy', 'detach', 'cwm', f'{bucket_name}_read', f'{bucket_name}_write', f'{bucket_name}_delete', '--user', credentials_access_key)),
         *[
             ('mc_check_call', ('admin', 'policy', 'rm', 'cwm', f'{bucket_name}_{p}'))
             for p in ['read', 'write', 'delete']
@@ -111,6 +97,7 @@ async def test_bucket_get_size(cwm_test_minio):
     await common.async_subprocess_check_call(config.MINIO_MC_BINARY, 'cp', '-r', 'cwm_minio_api', f'{profile}/{bucket_with_objects}/')
 
     async def bucket_has_size():
+        await buckets_usage.refresh(instance_id)
         return (await buckets_api.get(instance_id, bucket_with_objects, with_size=True))['size_bytes'] > 0
 
     await common.wait_for(bucket_has_size, 60, 1)
@@ -119,6 +106,7 @@ async def test_bucket_get_size(cwm_test_minio):
     res = await buckets_api.get(instance_id, empty_bucket, with_size=True)
     assert res['size_bytes'] == 0
     await common.async_subprocess_check_call(config.MINIO_MC_BINARY, 'rb', f'{profile}/{invalid_bucket}', '--force')
+    await buckets_usage.refresh(instance_id)
     res = await buckets_api.get(instance_id, invalid_bucket, with_size=True)
     assert res['size_bytes'] is None
     async for b in buckets_api.list_iterator(instance_id, with_size=True):
@@ -134,6 +122,125 @@ async def test_bucket_get_size(cwm_test_minio):
             raise AssertionError(f'Unexpected bucket name: {b["name"]}')
 
 
+async def test_iam_groups(cwm_test_db, monkeypatch):
+    tw = cwm_test_db["tracker_get_calls"]
+    monkeypatch.setattr('cwm_minio_api.config.BUCKETS_IAM_MODE', 'groups')
+    instance_id = 'test_instance_1'
+    bucket_name = 'test-bucket-1'
+    access_key = (await instances_api.create(instance_id))['access_key']
+    credentials_access_key = (await credentials_api.create(instance_id))['access_key']
+    tw()
+    await buckets_api.create(instance_id, bucket_name)
+    assert sorted(tw()[4:]) == sorted([
+        *[
+            ('mc_check_call', ('admin', 'group', 'add', 'cwm', f'{bucket_name}_{p}', access_key))
+            for p in ['read', 'write', 'delete']
+        ],
+        *[
+            ('mc_check_call', ('admin', 'policy', 'attach', 'cwm', f'{bucket_name}_{p}', '--group', f'{bucket_name}_{p}'))
+            for p in ['read', 'write', 'delete']
+        ],
+    ])
+    await buckets_api.credentials_create(instance_id, bucket_name, credentials_access_key, True, False, True)
+    assert sorted(tw()) == [
+        ('mc_check_call', ('admin', 'group', 'add', 'cwm', f'{bucket_name}_{p}', credentials_access_key))
+        for p in ['delete', 'read']
+    ]
+    await buckets_api.update(instance_id, bucket_name, blocked=True, public=False)
+    assert sorted(tw()) == [
+        ('mc_check_call', ('admin', 'group', 'disable', 'cwm', f'{bucket_name}_{p}'))
+        for p in ['delete', 'read', 'write']
+    ]
+    await buckets_api.update(instance_id, bucket_name, blocked=False, public=False)
+    assert sorted(tw()) == [
+        ('mc_check_call', ('admin', 'group', 'enable', 'cwm', f'{bucket_name}_{p}'))
+        for p in ['delete', 'read', 'write']
+    ]
+    await buckets_api.credentials_update(instance_id, bucket_name, credentials_access_key, True, True, False)
+    assert sorted(tw()) == [
+        ('mc_check_call', ('admin', 'group', 'add', 'cwm', f'{bucket_name}_write', credentials_access_key)),
+        ('mc_check_call', ('admin', 'group', 'rm', 'cwm', f'{bucket_name}_delete', credentials_access_key)),
+    ]
+    await buckets_api.delete(instance_id, bucket_name)
+    calls = tw()
+    assert sorted(calls[:6]) == sorted([
+        ('mc_check_call', ('admin', 'group', 'rm', 'cwm', f'{bucket_name}_delete', access_key)),
+        ('mc_check_call', ('admin', 'group', 'rm', 'cwm', f'{bucket_name}_delete')),
+        ('mc_check_call', ('admin', 'group', 'rm', 'cwm', f'{bucket_name}_read', access_key, credentials_access_key)),
+        ('mc_check_call', ('admin', 'group', 'rm', 'cwm', f'{bucket_name}_read')),
+        ('mc_check_call', ('admin', 'group', 'rm', 'cwm', f'{bucket_name}_write', access_key, credentials_access_key)),
+        ('mc_check_call', ('admin', 'group', 'rm', 'cwm', f'{bucket_name}_write')),
+    ])
+    assert [c[1][:3] for c in calls[6:]] == [('admin', 'policy', 'rm')] * 3 + [('rb', f'cwm/{bucket_name}', '--force')]
+
+
+async def test_migrate_iam_groups(cwm_test_db):
+    tw = cwm_test_db["tracker_get_calls"]
+    instance_id = 'test_instance_1'
+    access_key = (await instances_api.create(instance_id))['access_key']
+    credentials_access_key = (await credentials_api.create(instance_id))['access_key']
+    await buckets_api.create(instance_id, 'test-bucket-1')
+    await buckets_api.create(instance_id, 'test-bucket-2')
+    await buckets_api.credentials_create(instance_id, 'test-bucket-1', credentials_access_key, True, False, False)
+    await buckets_api.update(instance_id, 'test-bucket-2', blocked=True, public=False)
+    tw()
+    assert await buckets_api.migrate_iam_groups(instance_id) == {'migrated_buckets': 2}
+    calls = tw()
+    bucket_1_calls = sorted(c for c in calls if 'test-bucket-1_read' in c[1])
+    assert bucket_1_calls == sorted([
+        ('mc_check_call', ('admin', 'group', 'add', 'cwm', 'test-bucket-1_read', access_key, credentials_access_key)),
+        ('mc_check_call', ('admin', 'policy', 'attach', 'cwm', 'test-bucket-1_read', '--group', 'test-bucket-1_read')),
+        ('mc_check_call', ('admin', 'policy', 'detach', 'cwm', 'test-bucket-1_read', 'test-bucket-1_write', 'test-bucket-1_delete', '--user', access_key)),
+        ('mc_check_call', ('admin', 'policy', 'detach', 'cwm', 'test-bucket-1_read', 'test-bucket-1_write', 'test-bucket-1_delete', '--user', credentials_access_key)),
+    ])
+    # blocked bucket groups are disabled before the policies are attached, policies were already detached from users
+    assert [c for c in calls if 'test-bucket-2_read' in c[1]] == [
+        ('mc_check_call', ('admin', 'group', 'add', 'cwm', 'test-bucket-2_read', access_key)),
+        ('mc_check_call', ('admin', 'group', 'disable', 'cwm', 'test-bucket-2_read')),
+        ('mc_check_call', ('admin', 'policy', 'attach', 'cwm', 'test-bucket-2_read', '--group', 'test-bucket-2_read')),
+    ]
+    assert await buckets_api.get_iam_mode(instance_id, 'test-bucket-1') == 'groups'
+    assert await buckets_api.migrate_iam_groups() == {'migrated_buckets': 0}
+    await buckets_api.update(instance_id, 'test-bucket-2', blocked=False, public=False)
+    assert sorted(tw()) == [
+        ('mc_check_call', ('admin', 'group', 'enable', 'cwm', f'test-bucket-2_{p}'))
+        for p in ['delete', 'read', 'write']
+    ]
+
+
+async def test_bucket_usage_cache(cwm_test_db):
+    instance_id = 'test_instance_1'
+    await instances_api.create(instance_id)
+    await buckets_api.create(instance_id, 'test-bucket-1')
+    await buckets_api.create(instance_id, 'test-bucket-2')
+
+    async def intercept(f, n, *args):
+        if n == 'mc_check_output' and args[0] == 'stat':
+            if args[1].endswith('/test-bucket-2'):
+                raise Exception('bucket not found')
+            return '{"Usage": {"size": 123}}'
+        return await f(*args)
+
+    cwm_test_db['intercept'] = intercept
+    res = await buckets_api.get(instance_id, 'test-bucket-1', with_size=True)
+    assert res['size_bytes'] is None and res['size_age_seconds'] is None
+    assert await buckets_usage.collect_if_due(3600)
+    # another worker does not collect again within the interval
+    assert not await buckets_usage.collect_if_due(3600)
+    res = await buckets_api.get(instance_id, 'test-bucket-1', with_size=True)
+    assert res['size_bytes'] == 123 and 0 <= res['size_age_seconds'] < 60
+    assert [
+        (b['name'], b['size_bytes'])
+        async for b in buckets_api.list_iterator(instance_id, with_size=True)
+    ] == [('test-bucket-1', 123), ('test-bucket-2', None), ('*', 123)]
+    await buckets_api.delete(instance_id, 'test-bucket-1')
+    await buckets_usage.refresh()
+    assert [
+        (b['name'], b['size_bytes'])
+        async for b in buckets_api.list_iterator(instance_id, with_size=True)
+    ] == [('test-bucket-2', None), ('*', 0)]
+
+
 async def test_bucket_create_minio_exception(cwm_test_db, monkeypatch):
     instance_id = 'test_instance_1'
     bucket_name = 'test-bucket-1'
@@ -152,3 +259,72 @@ async def test_bucket_create_minio_exception(cwm_test_db, monkeypatch):
         assert str(e) == 'simulated error'
     else:
         raise AssertionError('Expected exception was not raised')
+
+
+async def test_bucket_bulk_create(cwm_test_db):
+    tw = cwm_test_db["tracker_get_calls"]
+    instance_id = 'test_instance_1'
+    await instances_api.create(instance_id)
+    await buckets_api.create(instance_id, 'test-bucket-1')
+    with pytest.raises(ValueError):
+        await buckets_api.bulk_create(instance_id, [{'bucket_name': 'test-bucket-2'}, {'bucket_name': 'x'}])
+    tw()
+
+    async def intercept(f, n, *args):
+        if n == 'mc_check_call' and args[0:3] == ('admin', 'policy', 'attach') and 'test-bucket-3_write' in args:
+            raise Exception('attach failed')
+        return await f(*args)
+
+    cwm_test_db['intercept'] = intercept
+    assert await buckets_api.bulk_create(instance_id, [
+        {'bucket_name': 'test-bucket-1', 'public': False},
+        {'bucket_name': 'test-bucket-2', 'public': True},
+        {'bucket_name': 'test-bucket-3', 'public': False},
+    ]) == [
+        {'bucket_name': 'test-bucket-1', 'public': False, 'created': False, 'error': 'Bucket already exists'},
+        {'bucket_name': 'test-bucket-2', 'public': True, 'created': True, 'error': None},
+        {'bucket_name': 'test-bucket-3', 'public': False, 'created': False, 'error': 'Exception: attach failed'},
+    ]
+    assert [b async for b in buckets_api.list_iterator(instance_id)] == ['test-bucket-1', 'test-bucket-2']
+    calls = tw()
+    # failed bucket is rolled back
+    assert ('mc_check_call', ('rb', 'cwm/test-bucket-3', '--force')) in calls
+    assert ('mc_check_call', ('admin', 'policy', 'rm', 'cwm', 'test-bucket-3_read')) in calls
+    assert ('mc_check_call', ('anonymous', 'set', 'download', 'cwm/test-bucket-2')) in calls
+    assert not any(c[1][0] == 'rb' and c[1][1] == 'cwm/test-bucket-2' for c in calls)
+
+
+async def test_credentials_bulk_create(cwm_test_db):
+    tw = cwm_test_db["tracker_get_calls"]
+    instance_id = 'test_instance_1'
+    await instances_api.create(instance_id)
+    await buckets_api.create(instance_id, 'test-bucket-1')
+    await buckets_api.create(instance_id, 'test-bucket-2')
+    access_key_1 = (await credentials_api.create(instance_id))['access_key']
+    access_key_2 = (await credentials_api.create(instance_id))['access_key']
+    tw()
+    with pytest.raises(Exception, match='Bucket not found: test-bucket-3'):
+        await buckets_api.credentials_bulk_create(instance_id, [
+            {'bucket_name': 'test-bucket-1', 'access_key': access_key_1, 'read': True, 'write': False, 'delete': False},
+            {'bucket_name': 'test-bucket-3', 'access_key': access_key_1, 'read': True, 'write': False, 'delete': False},
+        ])
+    assert await buckets_api.credentials_bulk_create(instance_id, [
+        {'bucket_name': 'test-bucket-1', 'access_key': access_key_1, 'read': True, 'write': False, 'delete': False},
+        {'bucket_name': 'test-bucket-2', 'access_key': access_key_1, 'read': True, 'write': True, 'delete': False},
+        {'bucket_name': 'test-bucket-2', 'access_key': access_key_2, 'read': False, 'write': False, 'delete': True},
+    ]) == {'num_credentials': 3}
+    # one call per user
+    assert sorted(tw()) == sorted([
+        ('mc_check_call', ('admin', 'policy', 'attach', 'cwm', 'test-bucket-1_read', 'test-bucket-2_read', 'test-bucket-2_write', '--user', access_key_1)),
+        ('mc_check_call', ('admin', 'policy', 'attach', 'cwm', 'test-bucket-2_delete', '--user', access_key_2)),
+    ])
+    assert sorted([
+        (c['access_key'], c['permission_read'], c['permission_write'], c['permission_delete'])
+        async for c in buckets_api.credentials_list_iterator(instance_id, 'test-bucket-2')
+    ]) == sorted([(access_key_1, True, True, False), (access_key_2, False, False, True)])
+    with pytest.raises(Exception, match='Credentials already assigned'):
+        await buckets_api.credentials_bulk_create(instance_id, [
+            {'bucket_name': 'test-bucket-1', 'access_key': access_key_2, 'read': True, 'write': False, 'delete': False},
+            {'bucket_name': 'test-bucket-1', 'access_key': access_key_1, 'read': True, 'write': False, 'delete': False},
+        ])
+    assert tw() == []
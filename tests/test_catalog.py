@@ -0,0 +1,71 @@
+from cwm_minio_api.load_tests.catalog import Catalog
+
+
+def test_catalog():
+    catalog = Catalog.from_items([('c', 3, 300), ('a', 1, 100), ('b', 2, 200)])
+    assert list(catalog.items()) == [('a', 1, 100), ('b', 2, 200), ('c', 3, 300)]
+    assert catalog.get('b') == (2, 200)
+    assert catalog.get('x') is None
+    # ttl 0 returns all the entries
+    assert catalog.get_names(0, 1000) == ['a', 'b', 'c']
+    assert catalog.get_names(150, 400) == ['a', 'b']
+    assert catalog.count(150, 400) == 2
+    assert sorted(catalog.sample(150, 400, k=5)) == ['a', 'b']
+    assert catalog.sample(1000, 400) == []
+    catalog.delete('a')
+    assert 'a' not in catalog and len(catalog) == 2
+    assert catalog.count(150, 400) == 1
+    assert catalog.sample(150, 400) == ['b']
+    # out of order timestamp
+    catalog.add('d', 4, 50)
+    assert catalog.get_names(0, 1000) == ['d', 'b', 'c']
+    # re-adding an existing name moves it to its new timestamp
+    catalog.add('d', 5, 400)
+    assert list(catalog.items())[-1] == ('d', 5, 400)
+    for name in ['b', 'c']:
+        catalog.delete(name)
+    # tombstones were compacted when deleting 'b', 'c' is the only tombstone left
+    assert catalog.names == [None, 'd'] and list(catalog.deleted_positions) == [0]
+
+
+def test_catalog_sample_large():
+    catalog = Catalog.from_items((f'file-{i}', i, i) for i in range(10000))
+    for i in range(0, 10000, 3):
+        catalog.delete(f'file-{i}')
+    assert catalog.count(5000, 10000) == len([i for i in range(5000) if i % 3])
+    names = catalog.sample(5000, 10000, k=3)
+    assert len(set(names)) == 3
+    assert all(int(name.split('-')[1]) < 5000 and int(name.split('-')[1]) % 3 for name in names)
+
+
+def test_catalog_object_values():
+    catalog = Catalog(None)
+    catalog.add('bucket', {'public': True}, 100)
+    assert catalog.get('bucket') == ({'public': True}, 100)
+
+
+def test_catalog_sample_old_tombstones():
+    catalog = Catalog.from_items((f'file-{i}', i, i) for i in range(10000))
+    # tombstones concentrated in the entries older than the TTL, below the compaction threshold
+    for i in range(4900):
+        catalog.delete(f'file-{i}')
+    assert len(catalog.deleted_positions) == 4900
+    assert catalog.count(5000, 10000) == 100
+    for _ in range(100):
+        names = catalog.sample(5000, 10000, k=10)
+        assert len(set(names)) == 10
+        assert all(4900 <= int(name.split('-')[1]) < 5000 for name in names)
+    assert sorted(catalog.sample(5000, 10000, k=1000)) == sorted(f'file-{i}' for i in range(4900, 5000))
+
+
+def test_catalog_add_out_of_order_with_tombstones():
+    catalog = Catalog.from_items([('a', 1, 100), ('b', 2, 200), ('c', 3, 300), ('d', 4, 400)])
+    catalog.delete('c')
+    catalog.add('x', 9, 250)
+    assert list(catalog.items()) == [('a', 1, 100), ('b', 2, 200), ('x', 9, 250), ('d', 4, 400)]
+    assert catalog.get('d') == (4, 400) and catalog.get('x') == (9, 250)
+    assert list(catalog.deleted_positions) == [3]
+    assert catalog.get_names(0, 1000) == ['a', 'b', 'x', 'd']
+    assert sorted(catalog.sample(0, 1000, k=10)) == ['a', 'b', 'd', 'x']
+    catalog.delete('d')
+    assert catalog.get_names(0, 1000) == ['a', 'b', 'x']
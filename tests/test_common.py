@@ -0,0 +1,72 @@
+import asyncio
+
+import httpx
+import pytest
+
+from cwm_minio_api import common
+from cwm_minio_api.app import app
+
+
+async def test_async_run_window_sliding():
+    running = 0
+    max_running = 0
+    started = []
+
+    async def task(i, delay):
+        nonlocal running, max_running
+        started.append(i)
+        running += 1
+        max_running = max(max_running, running)
+        await asyncio.sleep(delay)
+        running -= 1
+        return i
+
+    # task 0 is slow, the other tasks should not wait for it
+    delays = [0.2] + [0.01] * 9
+
+    async def tasks():
+        for i, delay in enumerate(delays):
+            yield task(i, delay)
+
+    start_time = asyncio.get_event_loop().time()
+    assert await common.async_run_window(tasks(), window=2) == list(range(10))
+    assert asyncio.get_event_loop().time() - start_time < 0.3
+    assert max_running == 2
+    assert started == list(range(10))
+
+
+async def test_async_run_window_return_exceptions():
+
+    async def task(i):
+        if i % 2:
+            raise ValueError(i)
+        return i
+
+    results = await common.async_run_window((task(i) for i in range(5)), window=2, return_exceptions=True)
+    assert [r if not isinstance(r, ValueError) else 'error' for r in results] == [0, 'error', 2, 'error', 4]
+
+
+async def test_async_run_window_fail_fast():
+    cancelled = []
+
+    async def task(i):
+        if i == 1:
+            raise ValueError(i)
+        try:
+            await asyncio.sleep(1)
+        except asyncio.CancelledError:
+            cancelled.append(i)
+            raise
+
+    with pytest.raises(ExceptionGroup) as e:
+        await common.async_run_window([task(i) for i in range(10)], window=3)
+    assert [str(ex) for ex in e.value.exceptions] == ['1']
+    assert sorted(cancelled) == [0, 2]
+
+
+async def test_invalid_request_timeout_header(cwm_test_db):
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app()), base_url='http://test') as client:
+        res = await client.get('/jobs/list', headers={'x-request-timeout': 'abc'})
+        assert res.status_code == 400
+        res = await client.get('/jobs/list', headers={'x-request-timeout': '5'})
+        assert res.status_code == 200
@@ -64,20 +64,31 @@ async def test_crud(cwm_test_db):
         'permission_read': False,
         'permission_write': True,
         'permission_delete': True,
+        'plan': {
+            'attach': [f'{bucket_name}_write', f'{bucket_name}_delete'],
+            'detach': [f'{bucket_name}_read'],
+            'minio_operations': 2,
+        },
     }
+    # only the changed policies are attached / detached
     assert set(tracker_get_calls()) == {
         ('mc_check_call', ('admin', 'policy', 'detach', 'cwm', f'{bucket_name}_read', '--user', created_credentials['access_key'])),
-        ('mc_check_call', ('admin', 'policy', 'detach', 'cwm', f'{bucket_name}_write', '--user', created_credentials['access_key'])),
-        ('mc_check_call', ('admin', 'policy', 'detach', 'cwm', f'{bucket_name}_delete', '--user', created_credentials['access_key'])),
-        ('mc_check_call', ('admin', 'policy', 'attach', 'cwm', f'{bucket_name}_write', '--user', created_credentials['access_key'])),
-        ('mc_check_call', ('admin', 'policy', 'attach', 'cwm', f'{bucket_name}_delete', '--user', created_credentials['access_key'])),
+        ('mc_check_call', ('admin', 'policy', 'attach', 'cwm', f'{bucket_name}_write', f'{bucket_name}_delete', '--user', created_credentials['access_key'])),
     }
+    updated_credentials = await buckets_api.credentials_update(
+        instance_id,
+        bucket_name,
+        created_credentials['access_key'],
+        read=False,
+        write=True,
+        delete=True,
+    )
+    assert updated_credentials['plan'] == {'attach': [], 'detach': [], 'minio_operations': 0}
+    assert tracker_get_calls() == []
 
     await buckets_api.credentials_delete(instance_id, bucket_name, created_credentials['access_key'])
     assert set(tracker_get_calls()) == {
-        ('mc_check_call', ('admin', 'policy', 'detach', 'cwm', f'{bucket_name}_read', '--user', created_credentials['access_key'])),
-        ('mc_check_call', ('admin', 'policy', 'detach', 'cwm', f'{bucket_name}_write', '--user', created_credentials['access_key'])),
-        ('mc_check_call', ('admin', 'policy', 'detach', 'cwm', f'{bucket_name}_delete', '--user', created_credentials['access_key'])),
+        ('mc_check_call', ('admin', 'policy', 'detach', 'cwm', f'{bucket_name}_read', f'{bucket_name}_write', f'{bucket_name}_delete', '--user', created_credentials['access_key'])),
     }
 
     await credentials_api.delete(created_credentials['access_key'])
@@ -0,0 +1,41 @@
+import time
+
+import pytest
+
+from cwm_minio_api import db, common
+
+
+async def test_uncommitted_changes_rolled_back(cwm_test_db):
+    async with db.connection_cursor() as (conn, cur):
+        await cur.execute("INSERT INTO access_keys (access_key) VALUES ('uncommitted')")
+    async with db.connection_cursor() as (conn, cur):
+        await cur.execute("SELECT 1 FROM access_keys WHERE access_key = 'uncommitted'")
+        assert await cur.fetchone() is None
+
+
+async def test_pool_timeout(cwm_test_db, monkeypatch):
+    monkeypatch.setattr('cwm_minio_api.config.DB_POOL_MIN_SIZE', 1)
+    monkeypatch.setattr('cwm_minio_api.config.DB_POOL_MAX_SIZE', 1)
+    monkeypatch.setattr('cwm_minio_api.config.DB_POOL_TIMEOUT_SECONDS', 0.1)
+    await db.close_pool()
+    async with db.connection_cursor() as (conn, cur):
+        with pytest.raises(common.ServerOverloadedException):
+            async with db.connection_cursor():
+                pass
+        await cur.execute('SELECT 1')
+    async with db.connection_cursor() as (conn, cur):
+        await cur.execute('SELECT 1')
+
+
+async def test_query_deadline(cwm_test_db):
+    common.request_deadline.set(time.monotonic() + 0.3)
+    async with db.connection_cursor() as (conn, cur):
+        with pytest.raises(common.DeadlineExceededException):
+            await cur.execute('SELECT pg_sleep(5)')
+    common.request_deadline.set(time.monotonic() + 0.3)
+    async with db.connection_cursor() as (conn, cur):
+        with pytest.raises(common.DeadlineExceededException):
+            await cur.executemany('SELECT pg_sleep(%s)', [(5,)])
+    common.request_deadline.set(None)
+    async with db.connection_cursor() as (conn, cur):
+        await cur.execute('SELECT 1')
@@ -1,3 +1,5 @@
+import asyncio
+
 import pytest
 
 from cwm_minio_api.instances import api as instances_api
@@ -73,9 +75,7 @@ async def test_instance_lock_unlock(cwm_test_db):
         ("mc_check_call", ('admin', 'policy', 'create', 'cwm', f'{private_bucket_name}_read', bucket_policy_arg('read', private_bucket_name))),
         ("mc_check_call", ('admin', 'policy', 'create', 'cwm', f'{private_bucket_name}_write', bucket_policy_arg('write', private_bucket_name))),
         ("mc_check_call", ('admin', 'policy', 'create', 'cwm', f'{private_bucket_name}_delete', bucket_policy_arg('delete', private_bucket_name))),
-        ("mc_check_call", ('admin', 'policy', 'attach', 'cwm', f'{private_bucket_name}_read', '--user', access_key)),
-        ("mc_check_call", ('admin', 'policy', 'attach', 'cwm', f'{private_bucket_name}_write', '--user', access_key)),
-        ("mc_check_call", ('admin', 'policy', 'attach', 'cwm', f'{private_bucket_name}_delete', '--user', access_key)),
+        ("mc_check_call", ('admin', 'policy', 'attach', 'cwm', f'{private_bucket_name}_read', f'{private_bucket_name}_write', f'{private_bucket_name}_delete', '--user', access_key)),
     ]
     await buckets_api.create(instance_id, public_bucket_name, public=True)
     assert tw() == [
@@ -84,9 +84,7 @@ async def test_instance_lock_unlock(cwm_test_db):
         ("mc_check_call", ('admin', 'policy', 'create', 'cwm', f'{public_bucket_name}_read', bucket_policy_arg('read', public_bucket_name))),
         ("mc_check_call", ('admin', 'policy', 'create', 'cwm', f'{public_bucket_name}_write', bucket_policy_arg('write', public_bucket_name))),
         ("mc_check_call", ('admin', 'policy', 'create', 'cwm', f'{public_bucket_name}_delete', bucket_policy_arg('delete', public_bucket_name))),
-        ("mc_check_call", ('admin', 'policy', 'attach', 'cwm', f'{public_bucket_name}_read', '--user', access_key)),
-        ("mc_check_call", ('admin', 'policy', 'attach', 'cwm', f'{public_bucket_name}_write', '--user', access_key)),
-        ("mc_check_call", ('admin', 'policy', 'attach', 'cwm', f'{public_bucket_name}_delete', '--user', access_key)),
+        ("mc_check_call", ('admin', 'policy', 'attach', 'cwm', f'{public_bucket_name}_read', f'{public_bucket_name}_write', f'{public_bucket_name}_delete', '--user', access_key)),
     ]
     private_read_creds = await credentials_api.create(instance_id)
     assert tw() == [
@@ -140,28 +138,18 @@ async def test_instance_lock_unlock(cwm_test_db):
         # remove public download access
         ("mc_check_call", ('anonymous', 'set', 'none', f'cwm/{public_bucket_name}')),
 
-        ## Private bucket ##
-        # Detach policies from main user
-        ("mc_check_call", ('admin', 'policy', 'detach', 'cwm', f'{private_bucket_name}_read', '--user', access_key)),
-        ("mc_check_call", ('admin', 'policy', 'detach', 'cwm', f'{private_bucket_name}_write', '--user', access_key)),
-        ("mc_check_call", ('admin', 'policy', 'detach', 'cwm', f'{private_bucket_name}_delete', '--user', access_key)),
-
-        ## Public bucket ##
-        # Detach policies from main user
-        ("mc_check_call", ('admin', 'policy', 'detach', 'cwm', f'{public_bucket_name}_read', '--user', access_key)),
-        ("mc_check_call", ('admin', 'policy', 'detach', 'cwm', f'{public_bucket_name}_write', '--user', access_key)),
-        ("mc_check_call", ('admin', 'policy', 'detach', 'cwm', f'{public_bucket_name}_delete', '--user', access_key)),
+        # Detach policies of all buckets from main user
+        ("mc_check_call", (
+            'admin', 'policy', 'detach', 'cwm',
+            f'{private_bucket_name}_read', f'{private_bucket_name}_write', f'{private_bucket_name}_delete',
+            f'{public_bucket_name}_read', f'{public_bucket_name}_write', f'{public_bucket_name}_delete',
+            '--user', access_key,
+        )),
 
         ## Detach credentials ##
-        ("mc_check_call", ('admin', 'policy', 'detach', 'cwm', f'{private_bucket_name}_read', '--user', private_read_creds['access_key'])),
-        ("mc_check_call", ('admin', 'policy', 'detach', 'cwm', f'{private_bucket_name}_write', '--user', private_read_creds['access_key'])),
-        ("mc_check_call", ('admin', 'policy', 'detach', 'cwm', f'{private_bucket_name}_delete', '--user', private_read_creds['access_key'])),
-        ("mc_check_call", ('admin', 'policy', 'detach', 'cwm', f'{private_bucket_name}_read', '--user', private_write_creds['access_key'])),
-        ("mc_check_call", ('admin', 'policy', 'detach', 'cwm', f'{private_bucket_name}_write', '--user', private_write_creds['access_key'])),
-        ("mc_check_call", ('admin', 'policy', 'detach', 'cwm', f'{private_bucket_name}_delete', '--user', private_write_creds['access_key'])),
-        ("mc_check_call", ('admin', 'policy', 'detach', 'cwm', f'{public_bucket_name}_read', '--user', public_write_creds['access_key'])),
-        ("mc_check_call", ('admin', 'policy', 'detach', 'cwm', f'{public_bucket_name}_write', '--user', public_write_creds['access_key'])),
-        ("mc_check_call", ('admin', 'policy', 'detach', 'cwm', f'{public_bucket_name}_delete', '--user', public_write_creds['access_key'])),
+        ("mc_check_call", ('admin', 'policy', 'detach', 'cwm', f'{private_bucket_name}_read', f'{private_bucket_name}_write', f'{private_bucket_name}_delete', '--user', private_read_creds['access_key'])),
+        ("mc_check_call", ('admin', 'policy', 'detach', 'cwm', f'{private_bucket_name}_read', f'{private_bucket_name}_write', f'{private_bucket_name}_delete', '--user', private_write_creds['access_key'])),
+        ("mc_check_call", ('admin', 'policy', 'detach', 'cwm', f'{public_bucket_name}_read', f'{public_bucket_name}_write', f'{public_bucket_name}_delete', '--user', public_write_creds['access_key'])),
     }
     await instances_api.update(instance_id, blocked=False)
     assert set(tw()) == {
@@ -169,15 +157,96 @@ async def test_instance_lock_unlock(cwm_test_db):
         ("mc_check_call", ('anonymous', "set", 'download', f'cwm/{public_bucket_name}')),
 
         # Re-attach policies to main user
-        ("mc_check_call", ('admin', 'policy', 'attach', 'cwm', f'{public_bucket_name}_read', '--user', access_key)),
-        ("mc_check_call", ('admin', 'policy', 'attach', 'cwm', f'{public_bucket_name}_write', '--user', access_key)),
-        ("mc_check_call", ('admin', 'policy', 'attach', 'cwm', f'{public_bucket_name}_delete', '--user', access_key)),
-        ("mc_check_call", ('admin', 'policy', 'attach', 'cwm', f'{private_bucket_name}_read', '--user', access_key)),
-        ("mc_check_call", ('admin', 'policy', 'attach', 'cwm', f'{private_bucket_name}_write', '--user', access_key)),
-        ("mc_check_call", ('admin', 'policy', 'attach', 'cwm', f'{private_bucket_name}_delete', '--user', access_key)),
+        ("mc_check_call", (
+            'admin', 'policy', 'attach', 'cwm',
+            f'{private_bucket_name}_read', f'{private_bucket_name}_write', f'{private_bucket_name}_delete',
+            f'{public_bucket_name}_read', f'{public_bucket_name}_write', f'{public_bucket_name}_delete',
+            '--user', access_key,
+        )),
 
         # Re-attach credentials policies
         ("mc_check_call", ('admin', 'policy', 'attach', 'cwm', f'{public_bucket_name}_write', '--user', public_write_creds['access_key'])),
         ("mc_check_call", ('admin', 'policy', 'attach', 'cwm', f'{private_bucket_name}_read', '--user', private_read_creds['access_key'])),
         ("mc_check_call", ('admin', 'policy', 'attach', 'cwm', f'{private_bucket_name}_write', '--user', private_write_creds['access_key'])),
     }
+
+
+async def test_instance_block_rollback(cwm_test_db):
+    tw = cwm_test_db["tracker_get_calls"]
+    instance_id = 'test_instance'
+    await instances_api.create(instance_id)
+    await buckets_api.create(instance_id, 'public', public=True)
+    await buckets_api.create(instance_id, 'private', public=False)
+    tw()
+
+    async def intercept(f, n, *args):
+        if n == 'mc_check_call' and args[0:3] == ('admin', 'policy', 'detach'):
+            raise Exception('detach failed')
+        return await f(*args)
+
+    cwm_test_db['intercept'] = intercept
+    with pytest.raises(BaseExceptionGroup):
+        await instances_api.update(instance_id, blocked=True)
+    # all buckets are updated in one transaction, so none of them is blocked and the applied MinIO changes are reverted
+    assert [(await buckets_api.get(instance_id, name))['blocked'] for name in ['public', 'private']] == [False, False]
+    assert (await instances_api.get(instance_id))['blocked'] is False
+    calls = tw()
+    assert ('mc_check_call', ('anonymous', 'set', 'download', 'cwm/public')) in calls
+    assert ('mc_check_call', ('anonymous', 'set', 'none', 'cwm/public')) in calls
+
+
+async def test_instance_block_users_strategy(cwm_test_db, monkeypatch):
+    monkeypatch.setattr('cwm_minio_api.config.INSTANCES_BLOCK_STRATEGY', 'users')
+    tw = cwm_test_db["tracker_get_calls"]
+    instance_id = 'test_instance'
+    access_key = (await instances_api.create(instance_id))['access_key']
+    await buckets_api.create(instance_id, 'public', public=True)
+    await buckets_api.create(instance_id, 'private', public=False)
+    credentials_access_key = (await credentials_api.create(instance_id))['access_key']
+    await buckets_api.credentials_create(instance_id, 'private', credentials_access_key, read=True, write=False, delete=False)
+    tw()
+    await instances_api.update(instance_id, blocked=True)
+    assert sorted(tw()) == sorted([
+        ('mc_check_call', ('anonymous', 'set', 'none', 'cwm/public')),
+        ('mc_check_call', ('admin', 'user', 'disable', 'cwm', access_key)),
+        ('mc_check_call', ('admin', 'user', 'disable', 'cwm', credentials_access_key)),
+    ])
+    assert (await instances_api.get(instance_id))['blocked'] is True
+    assert await instances_api.get_block_strategy(instance_id) == 'users'
+    # credentials created while blocked are disabled too
+    new_credentials = await credentials_api.create(instance_id)
+    assert tw()[-1] == ('mc_check_call', ('admin', 'user', 'disable', 'cwm', new_credentials['access_key']))
+    with pytest.raises(Exception, match='Instance is blocked'):
+        await buckets_api.update(instance_id, 'private', public=True, blocked=False)
+    # unblock reverses the applied strategy even if the configured strategy changed
+    monkeypatch.setattr('cwm_minio_api.config.INSTANCES_BLOCK_STRATEGY', 'policies')
+    await instances_api.update(instance_id, blocked=False)
+    assert sorted(tw()) == sorted([
+        ('mc_check_call', ('anonymous', 'set', 'download', 'cwm/public')),
+        ('mc_check_call', ('admin', 'user', 'enable', 'cwm', access_key)),
+        ('mc_check_call', ('admin', 'user', 'enable', 'cwm', credentials_access_key)),
+        ('mc_check_call', ('admin', 'user', 'enable', 'cwm', new_credentials['access_key'])),
+    ])
+    assert await instances_api.get_block_strategy(instance_id) is None
+
+
+async def test_concurrent_create_delete_small_pool(cwm_test_db, monkeypatch):
+    # nested pool checkouts would exhaust a small pool and fail with a pool timeout
+    monkeypatch.setattr('cwm_minio_api.config.DB_POOL_MIN_SIZE', 1)
+    monkeypatch.setattr('cwm_minio_api.config.DB_POOL_MAX_SIZE', 2)
+    monkeypatch.setattr('cwm_minio_api.config.DB_POOL_TIMEOUT_SECONDS', 5)
+    await db.close_pool()
+    instance_ids = [f'test_instance_pool_{i}' for i in range(4)]
+
+    async def create(instance_id):
+        await instances_api.create(instance_id)
+        await credentials_api.create(instance_id)
+        for bucket_num in range(3):
+            await buckets_api.create(instance_id, f'{instance_id.replace("_", "-")}-{bucket_num}')
+
+    await asyncio.gather(*(create(instance_id) for instance_id in instance_ids))
+    await asyncio.gather(*(instances_api.delete(instance_id) for instance_id in instance_ids))
+    assert [i async for i in instances_api.list_iterator()] == []
+    async with db.connection_cursor() as (conn, cur):
+        await cur.execute('SELECT count(*) AS num_access_keys FROM access_keys')
+        assert (await cur.fetchone())['num_access_keys'] == 0
@@ -0,0 +1,89 @@
+import httpx
+
+from cwm_minio_api.app import app
+from cwm_minio_api import db
+from cwm_minio_api.instances import api as instances_api
+from cwm_minio_api.buckets import api as buckets_api
+from cwm_minio_api.credentials import api as credentials_api
+from cwm_minio_api.jobs import api as jobs_api
+
+
+async def test_jobs(cwm_test_db):
+    instance_id = 'test_instance_1'
+    await instances_api.create(instance_id)
+    await buckets_api.create(instance_id, 'test-bucket-1')
+    await buckets_api.create(instance_id, 'test-bucket-2')
+    await credentials_api.create(instance_id)
+    job = await jobs_api.submit('instances_delete', instance_id=instance_id)
+    assert (job['kind'], job['status'], job['items_done'], job['items_total']) == ('instances_delete', 'queued', 0, 0)
+    # same job is returned while it is not finished
+    assert (await jobs_api.submit('instances_delete', instance_id=instance_id))['job_id'] == job['job_id']
+    assert await jobs_api.run_pending() == {'jobs': 1}
+    job = await jobs_api.get(job['job_id'])
+    assert (job['status'], job['items_done'], job['items_total'], job['error']) == ('done', 3, 3, None)
+    assert await instances_api.get(instance_id) is None
+    assert [j['job_id'] async for j in jobs_api.list_iterator(status='done')] == [job['job_id']]
+    # a finished job can be submitted again
+    job = await jobs_api.submit('instances_delete', instance_id=instance_id)
+    assert await jobs_api.run_pending() == {'jobs': 1}
+    job = await jobs_api.get(job['job_id'])
+    assert (job['status'], job['error']) == ('failed', 'Exception: Instance not found')
+
+
+async def test_jobs_http_async(cwm_test_db):
+    instance_id = 'test_instance_1'
+    await instances_api.create(instance_id)
+    await buckets_api.create(instance_id, 'test-bucket-1')
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app()), base_url='http://test') as client:
+        res = await client.delete('/buckets/delete', params={'instance_id': instance_id, 'bucket_name': 'test-bucket-1', 'async': 'true'})
+        assert res.status_code == 202
+        job = res.json()
+        assert (job['kind'], job['params'], job['items_total']) == ('buckets_delete', {'instance_id': instance_id, 'bucket_name': 'test-bucket-1'}, 1)
+        await jobs_api.run_pending()
+        res = await client.get('/jobs/get', params={'job_id': job['job_id']})
+        assert res.status_code == 200
+        assert (res.json()['status'], res.json()['items_done']) == ('done', 1)
+    assert await buckets_api.get(instance_id, 'test-bucket-1') is None
+
+
+async def test_jobs_reset_access_key(cwm_test_db, monkeypatch):
+    instance_id = 'test_instance_1'
+    old_access_key = (await instances_api.create(instance_id))['access_key']
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app()), base_url='http://test') as client:
+        res = await client.put('/instances/update', params={'async': 'true'}, json={'instance_id': instance_id, 'blocked': False, 'reset_access_key': True})
+        assert res.status_code == 202
+        job_id = res.json()['job_id']
+        assert res.json()['secret_key_available'] is False
+        await jobs_api.run_pending()
+        job = (await client.get('/jobs/get', params={'job_id': job_id})).json()
+        # the secret key is not stored in the result and can be fetched once
+        assert (job['status'], job['secret_key_available']) == ('done', True)
+        assert 'secret_key' not in job['result'] and job['result']['access_key'] != old_access_key
+        res = await client.post('/jobs/pop_secret_key', params={'job_id': job_id})
+        assert res.status_code == 200 and len(res.json()['secret_key']) == 40
+        assert await jobs_api.pop_secret_key(job_id) is None
+        assert (await client.get('/jobs/get', params={'job_id': job_id})).json()['secret_key_available'] is False
+    # secret keys which were not fetched expire
+    job = await jobs_api.submit('instances_update', instance_id=instance_id, blocked=False, reset_access_key=True)
+    await jobs_api.run_pending()
+    assert (await jobs_api.get(job['job_id']))['secret_key_available'] is True
+    monkeypatch.setattr('cwm_minio_api.config.JOBS_SECRET_KEY_TTL_SECONDS', 0)
+    assert await jobs_api.pop_secret_key(job['job_id']) is None
+    await jobs_api.clear_expired_secret_keys()
+    assert (await jobs_api.get(job['job_id']))['secret_key_available'] is False
+
+
+async def test_jobs_progress_single_connection_pool(cwm_test_db, monkeypatch):
+    instance_id = 'test_instance_1'
+    await instances_api.create(instance_id)
+    await buckets_api.create(instance_id, 'test-bucket-1')
+    await buckets_api.create(instance_id, 'test-bucket-2')
+    # progress updates must not check out a second connection while the job holds one
+    monkeypatch.setattr('cwm_minio_api.config.DB_POOL_MIN_SIZE', 1)
+    monkeypatch.setattr('cwm_minio_api.config.DB_POOL_MAX_SIZE', 1)
+    monkeypatch.setattr('cwm_minio_api.config.DB_POOL_TIMEOUT_SECONDS', 2)
+    await db.close_pool()
+    job = await jobs_api.submit('instances_update', instance_id=instance_id, blocked=True)
+    assert await jobs_api.run_pending() == {'jobs': 1}
+    job = await jobs_api.get(job['job_id'])
+    assert (job['status'], job['items_done'], job['items_total'], job['error']) == ('done', 2, 2, None)
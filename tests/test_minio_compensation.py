@@ -0,0 +1,57 @@
+import asyncio
+
+import pytest
+
+from cwm_minio_api.minio import scheduler
+from cwm_minio_api.minio.compensation import CompensationStack
+
+
+async def test_compensation_groups():
+    events = []
+    running = {'max': 0, 'now': 0}
+
+    async def undo(name, fail=False):
+        running['now'] += 1
+        running['max'] = max(running['max'], running['now'])
+        await asyncio.sleep(0.01)
+        running['now'] -= 1
+        events.append(name)
+        if fail:
+            raise Exception(f'{name} failed')
+
+    async def delete_bucket(name):
+        await undo(name)
+
+    async def delete_policy(name, fail=False):
+        await undo(name, fail)
+
+    with pytest.raises(ValueError) as e:
+        async with CompensationStack() as stack:
+            stack.push_async_callback(scheduler.run_compensation, delete_bucket, 'bucket')
+            for policy in ['read', 'write', 'delete']:
+                stack.push_async_callback(scheduler.run_compensation, delete_policy, policy, fail=policy == 'write')
+            assert [len(group) for group in stack.groups()] == [3, 1]
+            raise ValueError('step failed')
+    # policies are deleted concurrently before the bucket, the original exception is raised with the failed compensations
+    assert sorted(events[:3]) == ['delete', 'read', 'write']
+    assert events[3] == 'bucket'
+    assert running['max'] == 3
+    assert str(e.value) == 'step failed'
+    assert e.value.__notes__ == ['Failed compensations:\ndelete_policy(write): Exception: write failed']
+
+
+async def test_compensation_pop_all():
+    events = []
+
+    async def undo(name):
+        events.append(name)
+
+    async with CompensationStack() as stack:
+        stack.push_async_callback(undo, 'a')
+        stack.pop_all()
+    assert events == []
+    stack = CompensationStack()
+    stack.push_async_callback(undo, 'a')
+    stack.push_async_callback(undo, 'b')
+    assert await stack.aclose() == []
+    assert sorted(events) == ['a', 'b']
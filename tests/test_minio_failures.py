@@ -1,7 +1,13 @@
+import os
+import time
+import asyncio
+
 import pytest
 
 from cwm_minio_api.instances import api as instances_api
 from cwm_minio_api.buckets import api as buckets_api
+from cwm_minio_api import common, config
+from cwm_minio_api.minio import api as minio_api, scheduler
 
 
 class MinioFailureException(Exception):
@@ -109,10 +115,6 @@ async def test_bucket_create_failures(cwm_test_db,mb_failure,rb_failure,policy_c
                 assert policy_attach_failure
                 expected += [
                     ('mc_check_call', 'admin', 'policy', 'attach', 'cwm'),
-                    ('mc_check_call', 'admin', 'policy', 'attach', 'cwm'),
-                    ('mc_check_call', 'admin', 'policy', 'attach', 'cwm'),
-                    ('mc_check_call', 'admin', 'policy', 'detach', 'cwm'),
-                    ('mc_check_call', 'admin', 'policy', 'detach', 'cwm'),
                     ('mc_check_call', 'admin', 'policy', 'detach', 'cwm'),
                 ]
             expected += [
@@ -125,3 +127,77 @@ async def test_bucket_create_failures(cwm_test_db,mb_failure,rb_failure,policy_c
     expected += [('mc_check_call', 'rb', 'cwm/bucket', '--force')]
     cwm_test_db['tracker_assert_calls'](expected)
     assert [b async for b in buckets_api.list_iterator(instance_id)] == []
+
+
+async def test_policy_attach_coalesce(cwm_test_db, monkeypatch):
+    monkeypatch.setattr(config, 'MINIO_POLICY_COALESCE_WINDOW_SECONDS', 0.005)
+    tw = cwm_test_db['tracker_get_calls']
+    await asyncio.gather(
+        minio_api.attach_policies_to_user(['bucket1_read'], 'user1'),
+        minio_api.attach_policies_to_user(['bucket2_read', 'bucket2_write'], 'user1'),
+        minio_api.attach_policies_to_user(['bucket1_read'], 'user2'),
+    )
+    assert sorted(tw()) == sorted([
+        ('mc_check_call', ('admin', 'policy', 'attach', 'cwm', 'bucket1_read', 'bucket2_read', 'bucket2_write', '--user', 'user1')),
+        ('mc_check_call', ('admin', 'policy', 'attach', 'cwm', 'bucket1_read', '--user', 'user2')),
+    ])
+
+    async def intercept(f, n, *args):
+        if n == 'mc_check_call' and 'bucket2_write' in args:
+            raise MinioFailureException()
+        return await f(*args)
+
+    cwm_test_db['intercept'] = intercept
+    # merged call failed, each caller retried its own policies so only the failing one fails
+    results = await asyncio.gather(
+        minio_api.attach_policies_to_user(['bucket1_read'], 'user1'),
+        minio_api.attach_policies_to_user(['bucket2_read', 'bucket2_write'], 'user1'),
+        return_exceptions=True,
+    )
+    assert results[0] is None
+    assert isinstance(results[1], MinioFailureException)
+    calls = tw()
+    assert calls[0] == ('mc_check_call', ('admin', 'policy', 'attach', 'cwm', 'bucket1_read', 'bucket2_read', 'bucket2_write', '--user', 'user1'))
+    assert sorted(calls[1:]) == [
+        ('mc_check_call', ('admin', 'policy', 'attach', 'cwm', 'bucket1_read', '--user', 'user1')),
+        ('mc_check_call', ('admin', 'policy', 'attach', 'cwm', 'bucket2_read', 'bucket2_write', '--user', 'user1')),
+    ]
+
+
+async def test_mc_retry_transient_failure(cwm_test_db, monkeypatch, tmp_path):
+    monkeypatch.setattr('cwm_minio_api.config.MINIO_MC_BINARY', 'bash')
+    monkeypatch.setattr('cwm_minio_api.config.MINIO_MC_RETRY_BASE_SECONDS', 0.01)
+    counter = tmp_path / 'attempts'
+    # fails with a transient error on the first 2 attempts
+    script = f'echo x >> {counter}; if [ $(wc -l < {counter}) -le 2 ]; then echo "read: connection reset by peer"; exit 1; fi; echo ok'
+    assert await minio_api.mc_check_call('-c', script, operation='stat', return_output=True) == 'ok'
+    assert len(counter.read_text().splitlines()) == 3
+    # non idempotent operations are not retried
+    counter.unlink()
+    with pytest.raises(AssertionError, match='connection reset'):
+        await minio_api.mc_check_call('-c', script, operation='admin_policy_attach')
+    assert len(counter.read_text().splitlines()) == 1
+    # retries are limited by the request budget
+    counter.unlink()
+    monkeypatch.setattr('cwm_minio_api.config.MINIO_MC_RETRY_BUDGET', 1)
+    minio_api.start_retry_budget()
+    with pytest.raises(AssertionError, match='connection reset'):
+        await minio_api.mc_check_call('-c', script, operation='stat')
+    assert len(counter.read_text().splitlines()) == 2
+
+
+async def test_mc_deadline(cwm_test_db, monkeypatch, tmp_path):
+    monkeypatch.setattr('cwm_minio_api.config.MINIO_MC_BINARY', 'bash')
+    pid_file = tmp_path / 'pid'
+    common.request_deadline.set(time.monotonic() + 0.5)
+    start = time.monotonic()
+    with pytest.raises(common.DeadlineExceededException):
+        await minio_api.mc_check_call('-c', f'echo $$ > {pid_file}; sleep 10')
+    assert time.monotonic() - start < 2
+    # the hung process was killed
+    with pytest.raises(ProcessLookupError):
+        os.kill(int(pid_file.read_text()), 0)
+    # compensations run after the deadline expired
+    await scheduler.run_compensation(minio_api.mc_check_call, '-c', 'true')
+    with pytest.raises(common.DeadlineExceededException):
+        await minio_api.mc_check_call('-c', 'true')
@@ -0,0 +1,38 @@
+import orjson
+
+from cwm_minio_api.instances import api as instances_api
+from cwm_minio_api.buckets import api as buckets_api
+from cwm_minio_api.minio import api as minio_api, http_backend
+from cwm_minio_api import common, config
+
+
+async def mc_json(*args):
+    return orjson.loads(await common.async_subprocess_check_output(config.MINIO_MC_BINARY, *args, '--json'))
+
+
+async def test_http_backend(cwm_test_minio, monkeypatch):
+    profile, prefix = cwm_test_minio
+    monkeypatch.setattr('cwm_minio_api.config.MINIO_API_BACKEND', 'http')
+    monkeypatch.setattr('cwm_minio_api.config.MINIO_HTTP_URL', 'http://localhost:9000')
+    monkeypatch.setattr('cwm_minio_api.config.MINIO_HTTP_ACCESS_KEY', 'cwm')
+    monkeypatch.setattr('cwm_minio_api.config.MINIO_HTTP_SECRET_KEY', '12345678')
+    try:
+        instance_id = f'{prefix}-instance'
+        bucket_name = f'{prefix}-bucket'
+        instance = await instances_api.create(instance_id)
+        access_key = instance['access_key']
+        assert (await mc_json('admin', 'user', 'info', profile, access_key))['userStatus'] == 'enabled'
+        await buckets_api.create(instance_id, bucket_name, public=True)
+        assert await minio_api.bucket_exists(bucket_name)
+        assert (await mc_json('anonymous', 'get', f'{profile}/{bucket_name}'))['permission'] == 'download'
+        assert set((await mc_json('admin', 'user', 'info', profile, access_key))['policyName'].split(',')) == {
+            f'{bucket_name}_read', f'{bucket_name}_write', f'{bucket_name}_delete',
+        }
+        assert await minio_api.get_bucket_size(bucket_name) == 0
+        await buckets_api.update(instance_id, bucket_name, public=True, blocked=True)
+        assert (await mc_json('anonymous', 'get', f'{profile}/{bucket_name}'))['permission'] == 'private'
+        assert not (await mc_json('admin', 'user', 'info', profile, access_key)).get('policyName')
+        await instances_api.delete(instance_id)
+        assert not await minio_api.bucket_exists(bucket_name)
+    finally:
+        await http_backend.close()
@@ -0,0 +1,101 @@
+import time
+import asyncio
+
+import pytest
+
+from cwm_minio_api import common
+from cwm_minio_api.minio import scheduler
+
+
+async def test_max_in_flight_and_priority_order():
+    controller = scheduler.AdmissionController(max_in_flight=1, max_queue_wait_seconds=10)
+    started = []
+    release = asyncio.Event()
+
+    async def op(name, priority=None):
+        token = scheduler.current_priority.set(priority) if priority is not None else None
+        try:
+            async with controller.slot(name):
+                started.append(name)
+                await release.wait()
+        finally:
+            if token:
+                scheduler.current_priority.reset(token)
+
+    async with asyncio.TaskGroup() as tg:
+        tg.create_task(op('mb'))
+        await asyncio.sleep(0)
+        tg.create_task(op('stat'))
+        tg.create_task(op('admin_policy_create'))
+        tg.create_task(op('rb', scheduler.PRIORITY_COMPENSATION))
+        await asyncio.sleep(0.01)
+        assert started == ['mb']
+        assert controller.in_flight == 1
+        release.set()
+    assert started == ['mb', 'rb', 'admin_policy_create', 'stat']
+    assert controller.in_flight == 0
+
+
+async def test_shed_on_queue_wait():
+    controller = scheduler.AdmissionController(max_in_flight=1, max_queue_wait_seconds=0.05)
+    release = asyncio.Event()
+
+    async def op(name):
+        async with controller.slot(name):
+            await release.wait()
+
+    task = asyncio.create_task(op('mb'))
+    await asyncio.sleep(0)
+    with pytest.raises(common.ServerOverloadedException):
+        await op('admin_policy_create')
+    # compensations are not shed
+    compensation = asyncio.create_task(scheduler.run_compensation(op, 'rb'))
+    await asyncio.sleep(0.1)
+    assert not compensation.done()
+    release.set()
+    await task
+    await compensation
+    assert controller.in_flight == 0
+
+
+async def test_queue_wait_capped_by_deadline():
+    controller = scheduler.AdmissionController(max_in_flight=1, max_queue_wait_seconds=10)
+    release = asyncio.Event()
+
+    async def op(name):
+        async with controller.slot(name):
+            await release.wait()
+
+    task = asyncio.create_task(op('mb'))
+    await asyncio.sleep(0)
+    token = common.request_deadline.set(time.monotonic() + 0.05)
+    try:
+        start_time = time.monotonic()
+        with pytest.raises(common.DeadlineExceededException):
+            await op('admin_policy_create')
+        assert time.monotonic() - start_time < 1
+    finally:
+        common.request_deadline.reset(token)
+    release.set()
+    await task
+    assert controller.in_flight == 0
+
+
+async def test_cancelled_waiter_does_not_leak_slot():
+    controller = scheduler.AdmissionController(max_in_flight=1, max_queue_wait_seconds=10)
+    release = asyncio.Event()
+
+    async def op(name):
+        async with controller.slot(name):
+            await release.wait()
+
+    task = asyncio.create_task(op('mb'))
+    await asyncio.sleep(0)
+    waiter = asyncio.create_task(op('mb'))
+    await asyncio.sleep(0)
+    waiter.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await waiter
+    release.set()
+    await task
+    assert controller.in_flight == 0
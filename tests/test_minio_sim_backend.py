@@ -0,0 +1,48 @@
+import pytest
+
+from cwm_minio_api.instances import api as instances_api
+from cwm_minio_api.buckets import api as buckets_api
+from cwm_minio_api.credentials import api as credentials_api
+from cwm_minio_api.minio import api as minio_api, sim_backend, http_backend
+
+
+@pytest.fixture
+def sim_state(monkeypatch):
+    monkeypatch.setattr('cwm_minio_api.config.MINIO_API_BACKEND', 'sim')
+    monkeypatch.setattr('cwm_minio_api.config.MINIO_SIM_LATENCY', {'default': [0.001, 0.001]})
+    sim_backend.reset()
+    yield sim_backend.get_state()
+    sim_backend.reset()
+
+
+async def test_sim_backend(test_db, sim_state):
+    instance_id = 'test_instance_1'
+    bucket_name = 'test-bucket-1'
+    access_key = (await instances_api.create(instance_id))['access_key']
+    await buckets_api.create(instance_id, bucket_name, public=True)
+    credentials = await credentials_api.create(instance_id)
+    await buckets_api.credentials_create(instance_id, bucket_name, credentials['access_key'], True, False, False)
+    assert sim_state.buckets == {bucket_name: {'anonymous': True, 'size': 0}}
+    assert set(sim_state.policies) == {f'{bucket_name}_read', f'{bucket_name}_write', f'{bucket_name}_delete'}
+    assert sim_state.users[access_key]['policies'] == set(sim_state.policies)
+    assert sim_state.users[credentials['access_key']]['policies'] == {f'{bucket_name}_read'}
+    assert await minio_api.get_buckets_sizes([bucket_name, 'missing']) == {bucket_name: 0, 'missing': None}
+    await buckets_api.update(instance_id, bucket_name, public=True, blocked=True)
+    assert not sim_state.buckets[bucket_name]['anonymous']
+    assert not sim_state.users[access_key]['policies']
+    await instances_api.delete(instance_id)
+    assert (sim_state.buckets, sim_state.policies, sim_state.users) == ({}, {}, {})
+    with pytest.raises(http_backend.MinioHttpException, match='NoSuchBucket'):
+        await sim_backend.delete_bucket(bucket_name)
+
+
+async def test_sim_backend_failure_rollback(test_db, sim_state, monkeypatch):
+    instance_id = 'test_instance_1'
+    access_key = (await instances_api.create(instance_id))['access_key']
+    monkeypatch.setattr('cwm_minio_api.config.MINIO_SIM_FAILURE_RATES', {'admin_policy_attach_batch': 1})
+    with pytest.raises(http_backend.MinioHttpException, match='Simulated failure'):
+        await buckets_api.create(instance_id, 'test-bucket-1', public=True)
+    # all the MinIO changes were compensated
+    assert (sim_state.buckets, sim_state.policies, sim_state.users[access_key]['policies']) == ({}, {}, set())
+    assert sim_state.calls['rb'] == 1
+    assert await buckets_api.get(instance_id, 'test-bucket-1') is None
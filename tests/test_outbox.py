@@ -0,0 +1,115 @@
+import pytest
+
+from cwm_minio_api.instances import api as instances_api
+from cwm_minio_api.buckets import api as buckets_api
+from cwm_minio_api.outbox import api as outbox_api
+from cwm_minio_api import db
+
+
+class MinioFailureException(Exception):
+    pass
+
+
+async def test_outbox(cwm_test_db, monkeypatch):
+    monkeypatch.setattr('cwm_minio_api.config.MINIO_OUTBOX_ENABLED', True)
+    tw = cwm_test_db["tracker_get_calls"]
+    instance_id = 'test_instance_1'
+    bucket_name = 'test-bucket-1'
+    access_key = (await instances_api.create(instance_id))['access_key']
+    tw()
+    failures = {'attach': 1}
+
+    async def intercept(f, n, *args):
+        if n == 'mc_check_call' and args[0:3] == ('admin', 'policy', 'attach') and failures['attach']:
+            failures['attach'] -= 1
+            raise MinioFailureException()
+        return await f(*args)
+
+    cwm_test_db['intercept'] = intercept
+    # DB changes are committed together with the MinIO operations, which are not executed yet
+    assert (await buckets_api.create(instance_id, bucket_name))['bucket_name'] == bucket_name
+    await buckets_api.update(instance_id, bucket_name, blocked=True, public=False)
+    assert tw() == []
+    assert [(b['status'], b['operations_done'], b['operations_total']) async for b in outbox_api.list_iterator()] == [
+        ('pending', 0, 5),
+        ('pending', 0, 1),
+    ]
+    monkeypatch.setattr('cwm_minio_api.config.MINIO_OUTBOX_MAX_ATTEMPTS', 1)
+    # first batch fails on the attach step, the second batch waits for it
+    assert await outbox_api.process_pending() == {'processed_batches': 1}
+    assert [c[1][0:3] for c in tw()] == [('mb', f'cwm/{bucket_name}')] + [('admin', 'policy', 'create')] * 3 + [('admin', 'policy', 'attach')]
+    batches = [b async for b in outbox_api.list_iterator()]
+    assert [(b['status'], b['operations_done']) for b in batches] == [('failed', 4), ('pending', 0)]
+    assert 'MinioFailureException' in batches[0]['last_error']
+    # retry continues from the failed step
+    await outbox_api.retry(batches[0]['id'])
+    assert await outbox_api.process_pending() == {'processed_batches': 2}
+    assert tw() == [
+        ('mc_check_call', ('admin', 'policy', 'attach', 'cwm', f'{bucket_name}_read', f'{bucket_name}_write', f'{bucket_name}_delete', '--user', access_key)),
+        ('mc_check_call', ('admin', 'policy', 'detach', 'cwm', f'{bucket_name}_read', f'{bucket_name}_write', f'{bucket_name}_delete', '--user', access_key)),
+    ]
+    assert [b['status'] async for b in outbox_api.list_iterator()] == ['done', 'done']
+
+
+async def test_outbox_already_applied(cwm_test_db, monkeypatch):
+    monkeypatch.setattr('cwm_minio_api.config.MINIO_OUTBOX_ENABLED', True)
+    instance_id = 'test_instance_1'
+    bucket_name = 'test-bucket-1'
+    await instances_api.create(instance_id)
+    await buckets_api.create(instance_id, bucket_name)
+    await buckets_api.delete(instance_id, bucket_name)
+
+    async def intercept(f, n, *args):
+        # simulate a retry after the worker was killed after deleting the bucket
+        if n == 'mc_check_call' and args[0] == 'rb':
+            raise Exception('mc: <ERROR> Unable to validate target. Bucket `test-bucket-1` does not exist.')
+        return await f(*args)
+
+    cwm_test_db['intercept'] = intercept
+    assert await outbox_api.process_pending() == {'processed_batches': 2}
+    assert [b['status'] async for b in outbox_api.list_iterator()] == ['done', 'done']
+
+
+async def test_outbox_lease_lost(cwm_test_db, monkeypatch):
+    monkeypatch.setattr('cwm_minio_api.config.MINIO_OUTBOX_ENABLED', True)
+    tw = cwm_test_db["tracker_get_calls"]
+    instance_id = 'test_instance_1'
+    await instances_api.create(instance_id)
+    await buckets_api.create(instance_id, 'test-bucket-1')
+    tw()
+    stale_batch = await outbox_api.claim()
+
+    async def intercept(f, n, *args):
+        if args[0] == 'mb':
+            # the lease expired while creating the bucket and another worker claimed the batch
+            async with db.connection_cursor() as (conn, cur):
+                await cur.execute('UPDATE minio_outbox SET attempts = attempts + 1 WHERE id = %s', (stale_batch['id'],))
+                await conn.commit()
+        return await f(*args)
+
+    cwm_test_db['intercept'] = intercept
+    assert await outbox_api.process(stale_batch) is False
+    # the stale worker stopped after the first group and didn't update the new owner's batch
+    assert [c[1][0] for c in tw()] == ['mb']
+    assert [(b['status'], b['operations_done'], b['attempts']) async for b in outbox_api.list_iterator()] == [('pending', 0, 2)]
+
+
+async def test_outbox_rollback_compensation(cwm_test_db, monkeypatch):
+    monkeypatch.setattr('cwm_minio_api.config.MINIO_OUTBOX_ENABLED', True)
+    tw = cwm_test_db["tracker_get_calls"]
+    instance_id = 'test_instance_1'
+    old_access_key = (await instances_api.create(instance_id))['access_key']
+    tw()
+
+    async def delete_access_key(*args, **kwargs):
+        raise MinioFailureException()
+
+    monkeypatch.setattr('cwm_minio_api.access_keys.delete_access_key', delete_access_key)
+    with pytest.raises(MinioFailureException):
+        await instances_api.update(instance_id, reset_access_key=True)
+    # the user was created right away, so its compensation is executed right away instead of being deferred
+    calls = tw()
+    assert [c[1][0:3] for c in calls] == [('admin', 'user', 'add'), ('admin', 'user', 'rm')]
+    assert calls[0][1][4] == calls[1][1][4] != old_access_key
+    assert [b async for b in outbox_api.list_iterator()] == []
+    assert (await instances_api.get(instance_id))['access_key'] == old_access_key
@@ -0,0 +1,26 @@
+import datetime
+
+from botocore.auth import SigV4Auth
+from botocore.awsrequest import AWSRequest
+from botocore.credentials import Credentials
+
+from cwm_minio_api.load_tests import s3_signing
+
+
+def test_sign_same_as_botocore(monkeypatch):
+    monkeypatch.setattr('botocore.auth.get_current_datetime', lambda: datetime.datetime(2026, 1, 2, 3, 4, 5))
+    body, payload_hash = s3_signing.get_payload(1024)
+    assert s3_signing.get_payload(1024)[0] is body
+    for method, url, headers, payload_hash in [
+        ('PUT', 'https://minio.example.com/bucket/file-1024.md', {}, payload_hash),
+        ('GET', 'http://minio.example.com:9000/bucket/file.md', {}, s3_signing.EMPTY_PAYLOAD_HASH),
+        ('POST', 'https://minio.example.com:443/bucket/?delete=', {'Content-MD5': 'abc==', 'Content-Type': 'application/xml'}, payload_hash),
+        ('PUT', 'https://minio.example.com/bucket/file.md', {}, s3_signing.UNSIGNED_PAYLOAD),
+        ('POST', 'https://minio.example.com/bucket/file.md?uploads', {}, s3_signing.EMPTY_PAYLOAD_HASH),
+        ('PUT', 'https://minio.example.com/bucket/file.md?uploadId=abc-123_x&partNumber=2', {}, payload_hash),
+    ]:
+        request = AWSRequest(method=method, url=url, headers={**headers, 'x-amz-content-sha256': payload_hash})
+        SigV4Auth(Credentials('access', 'secret'), 's3', 'us-east-1').add_auth(request)
+        assert s3_signing.sign(
+            method, url, 'access', 'secret', 'us-east-1', payload_hash, headers, timestamp='20260102T030405Z'
+        ) == dict(request.headers)